@@ -0,0 +1,130 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from bson.objectid import ObjectId
+from pymongo import ReturnDocument
+from mongo import db
+
+# Number of search responses kept in memory and how long they are served (in seconds).
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE", 1024))
+SEARCH_CACHE_TTL = float(os.getenv("SEARCH_CACHE_TTL", 300))
+
+# How long (in seconds) the registry generation read from the database is trusted.
+# Writes made by this process are seen immediately, writes of other processes
+# (e.g. validate.py) within this interval.
+GENERATION_REFRESH_INTERVAL = float(os.getenv("GENERATION_REFRESH_INTERVAL", 1))
+
+_generation = {"value": None, "fetched_at": 0.0}
+_generation_lock = threading.Lock()
+
+
+def registry_generation():
+    """
+    Function to get the registry generation counter, which is incremented on every change
+    to the packages that can affect the search results.
+
+    Parameters:
+    None
+
+    Returns:
+    tuple: The epoch of the counter (which changes if the counter document is recreated,
+    e.g. when the database is dropped) and the current registry generation.
+    """
+    now = time.monotonic()
+    with _generation_lock:
+        if _generation["value"] is not None and now - _generation["fetched_at"] < GENERATION_REFRESH_INTERVAL:
+            return _generation["value"]
+
+    registry_doc = db.registry.find_one({"_id": "generation"})
+    value = (registry_doc.get("epoch"), registry_doc["value"]) if registry_doc else (None, 0)
+
+    with _generation_lock:
+        _generation["value"] = value
+        _generation["fetched_at"] = now
+    return value
+
+
+def bump_registry_generation():
+    """
+    Function to increment the registry generation counter. This invalidates every cached
+    search response in every process.
+
+    Parameters:
+    None
+
+    Returns:
+    tuple: The epoch of the counter and the new registry generation.
+    """
+    registry_doc = db.registry.find_one_and_update(
+        {"_id": "generation"},
+        {"$inc": {"value": 1}, "$setOnInsert": {"epoch": ObjectId()}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER,
+    )
+    value = (registry_doc.get("epoch"), registry_doc["value"])
+
+    with _generation_lock:
+        _generation["value"] = value
+        _generation["fetched_at"] = time.monotonic()
+    return value
+
+
+class SearchCache:
+    """
+    Bounded LRU cache with a time to live for the search responses.
+    Keys start with the registry generation they were computed for, so the entries of
+    older generations are never served again and are evicted as least recently used.
+    """
+
+    def __init__(self, max_size=SEARCH_CACHE_SIZE, ttl=SEARCH_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def key(self, *args):
+        return (registry_generation(),) + args
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + self.ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+search_cache = SearchCache()
+
+
+def clear_search_cache():
+    """
+    Function to drop every cached search response and forget the registry generation
+    read from the database (e.g. after the database has been dropped).
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    search_cache.clear()
+    with _generation_lock:
+        _generation["value"] = None
+        _generation["fetched_at"] = 0.0
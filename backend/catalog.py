@@ -0,0 +1,223 @@
+import json
+import zlib
+from datetime import datetime
+from app import app
+from mongo import db
+from flask import request, jsonify, Response
+from flasgger.utils import swag_from
+from models.package import Package
+
+# Maximum number of packages resolved by a single batch request.
+MAX_BATCH_SIZE = 200
+
+# Number of package documents fetched from the server side cursor per round trip.
+CATALOG_BATCH_SIZE = 500
+
+
+def catalog_records(package):
+    """
+    Function to convert a package document to the catalog records of its versions.
+
+    Parameters:
+    package (dict): The package document, projected on the catalog fields.
+
+    Returns:
+    list: One record per version of the package.
+    """
+    return [
+        {
+            "namespace": package.get("namespace_name"),
+            "name": package.get("name"),
+            "version": version.get("version"),
+            "latest_version": package.get("latest_version"),
+            "license": package.get("license"),
+            "description": package.get("description"),
+            "download_url": version.get("download_url"),
+            "sha256": version.get("sha256"),
+            "created_at": version.get("created_at"),
+            "is_verified": version.get("is_verified"),
+            "is_deprecated": bool(package.get("is_deprecated") or version.get("is_deprecated")),
+        }
+        for version in package.get("versions", [])
+    ]
+
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+
+def generate_catalog(compress=False):
+    """
+    Generator yielding the registry catalog as newline delimited JSON, one record per
+    package version. Packages are read from a server side cursor in batches, so the memory
+    used does not depend on the size of the registry.
+
+    Parameters:
+    compress (bool): Whether the output is gzip compressed.
+
+    Returns:
+    generator: The chunks of the response body.
+    """
+    compressor = zlib.compressobj(wbits=31) if compress else None
+
+    packages = db.packages.find(
+        {},
+        {
+            "_id": 0,
+            "name": 1,
+            "namespace_name": 1,
+            "license": 1,
+            "description": 1,
+            "is_deprecated": 1,
+            "latest_version": 1,
+            "versions.version": 1,
+            "versions.download_url": 1,
+            "versions.sha256": 1,
+            "versions.created_at": 1,
+            "versions.is_verified": 1,
+            "versions.is_deprecated": 1,
+        },
+        batch_size=CATALOG_BATCH_SIZE,
+    ).sort("_id", 1)
+
+    for package in packages:
+        chunk = "".join(
+            json.dumps(record, default=json_default, separators=(",", ":")) + "\n"
+            for record in catalog_records(package)
+        ).encode("utf-8")
+        if compressor:
+            chunk = compressor.compress(chunk)
+        if chunk:
+            yield chunk
+
+    if compressor:
+        yield compressor.flush()
+
+
+@app.route("/packages/catalog", methods=["GET"])
+@swag_from("documentation/get_catalog.yaml", methods=["GET"])
+def get_catalog():
+    compress = request.accept_encodings["gzip"] > 0
+
+    response = Response(generate_catalog(compress=compress), mimetype="application/x-ndjson")
+    response.headers["Vary"] = "Accept-Encoding"
+    if compress:
+        response.headers["Content-Encoding"] = "gzip"
+    return response
+
+
+def parse_batch_item(item):
+    """
+    Function to parse a package requested in a batch, either a {namespace, name, version}
+    object or a [namespace, name, version] list. The version is optional.
+
+    Parameters:
+    item: The requested package.
+
+    Returns:
+    tuple: The namespace, name and version (None for the latest version) of the package.
+
+    Raises:
+    ValueError: If the item is malformed.
+    """
+    if isinstance(item, dict):
+        item = [item.get("namespace"), item.get("name"), item.get("version")]
+    if not isinstance(item, list) or len(item) not in [2, 3]:
+        raise ValueError("Every package should be a [namespace, name, version] list or object")
+
+    namespace, name, version = (item + [None])[:3]
+    if not isinstance(namespace, str) or not isinstance(name, str):
+        raise ValueError("Package namespace and name are required")
+    if version is not None and not isinstance(version, str):
+        raise ValueError("Package version should be a string")
+    return namespace, name, version
+
+
+@app.route("/packages/batch", methods=["POST"])
+@swag_from("documentation/get_packages_batch.yaml", methods=["POST"])
+def get_packages_batch():
+    request_data = request.get_json(silent=True) or {}
+    items = request_data.get("packages") if isinstance(request_data, dict) else None
+
+    if not isinstance(items, list) or not items:
+        return jsonify({"code": 400, "message": "Packages are missing"}), 400
+
+    if len(items) > MAX_BATCH_SIZE:
+        return (
+            jsonify({"code": 400, "message": f"At most {MAX_BATCH_SIZE} packages can be requested at once"}),
+            400,
+        )
+
+    try:
+        items = [parse_batch_item(item) for item in items]
+    except ValueError as e:
+        return jsonify({"code": 400, "message": str(e)}), 400
+
+    # Fetch every requested package and their authors with one query each.
+    packages = db.packages.find(
+        {
+            "namespace_name": {"$in": list({i[0] for i in items})},
+            "name": {"$in": list({i[1] for i in items})},
+        },
+        {
+            "name": 1,
+            "namespace_name": 1,
+            "author": 1,
+            "keywords": 1,
+            "categories": 1,
+            "license": 1,
+            "created_at": 1,
+            "updated_at": 1,
+            "description": 1,
+            "latest_version": 1,
+            "versions": 1,
+        },
+    )
+    packages = {(i["namespace_name"], i["name"]): Package.from_json(i) for i in packages}
+
+    authors = db.users.find(
+        {"_id": {"$in": list({i.author for i in packages.values()})}}, {"username": 1}
+    )
+    authors = {i["_id"]: i["username"] for i in authors}
+
+    results = []
+    for namespace, name, version in items:
+        package_obj = packages.get((namespace, name))
+        version_data = None
+        if package_obj and package_obj.versions:
+            version = version or package_obj.latest_version or package_obj.versions[-1].version
+            version_data = next(
+                (i for i in package_obj.versions if i.version == version), None
+            )
+
+        if not version_data:
+            results.append({
+                "code": 404,
+                "message": "Package not found",
+                "namespace": namespace,
+                "name": name,
+                "version": version,
+            })
+            continue
+
+        version_data = version_data.to_json()
+        version_data["oid"] = str(version_data["oid"])
+        results.append({
+            "code": 200,
+            "data": {
+                "name": package_obj.name,
+                "namespace": package_obj.namespace_name,
+                "author": authors.get(package_obj.author),
+                "keywords": package_obj.keywords,
+                "categories": package_obj.categories,
+                "license": package_obj.license,
+                "created_at": package_obj.created_at,
+                "version_data": version_data,
+                "updatedAt": package_obj.updated_at,
+                "description": package_obj.description,
+            },
+        })
+
+    return jsonify({"code": 200, "packages": results}), 200
@@ -0,0 +1,506 @@
+import os
+import atexit
+import threading
+from datetime import datetime, timedelta
+from app import app
+from mongo import db
+from flask import request, jsonify
+from flasgger.utils import swag_from
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+
+# Granularities of the download rollups and the number of buckets returned by default.
+ROLLUP_PERIODS = {"day": 30, "week": 12, "month": 12}
+
+# Maximum number of buckets returned by a single range query.
+MAX_ROLLUP_BUCKETS = 366
+
+# Downloads are counted in memory and written to the database every DOWNLOADS_FLUSH_INTERVAL
+# seconds, or as soon as DOWNLOADS_FLUSH_SIZE distinct (tarball, day) counters are buffered.
+DOWNLOADS_FLUSH_INTERVAL = float(os.getenv("DOWNLOADS_FLUSH_INTERVAL", 5))
+DOWNLOADS_FLUSH_SIZE = int(os.getenv("DOWNLOADS_FLUSH_SIZE", 1000))
+
+
+def bucket_start(day, period):
+    """
+    Function to get the first day of the day, week (ISO, starting on monday) or month bucket of a day.
+
+    Parameters:
+    day (datetime): The day.
+    period (str): The granularity of the bucket.
+
+    Returns:
+    datetime: The start of the bucket.
+    """
+    day = datetime(day.year, day.month, day.day)
+    if period == "week":
+        return day - timedelta(days=day.weekday())
+    if period == "month":
+        return day.replace(day=1)
+    return day
+
+
+def next_bucket_start(start, period):
+    if period == "week":
+        return start + timedelta(weeks=1)
+    if period == "month":
+        return start.replace(year=start.year + start.month // 12, month=start.month % 12 + 1)
+    return start + timedelta(days=1)
+
+
+def bucket_name(start, period):
+    """
+    Function to get the name of a bucket, e.g. 2024-03-18, 2024-W12 or 2024-03.
+
+    Parameters:
+    start (datetime): The start of the bucket.
+    period (str): The granularity of the bucket.
+
+    Returns:
+    str: The name of the bucket.
+    """
+    if period == "week":
+        year, week, _ = start.isocalendar()
+        return f"{year}-W{week:02d}"
+    if period == "month":
+        return start.strftime("%Y-%m")
+    return start.strftime("%Y-%m-%d")
+
+
+def rollup_keys(namespace, package, version, day):
+    """
+    Function to get the keys of the rollups of a package and of one of its versions which
+    count the downloads of a day, for every granularity.
+
+    Parameters:
+    namespace (str): The namespace name of the package.
+    package (str): The name of the package.
+    version (str): The downloaded version.
+    day (datetime): The day of the downloads.
+
+    Returns:
+    list: The (namespace, package, version, period, start) keys of the rollups.
+    """
+    keys = []
+    for period in ROLLUP_PERIODS:
+        start = bucket_start(day, period)
+        # The package wide rollup is stored with a null version.
+        for rollup_version in [None, version]:
+            keys.append((namespace, package, rollup_version, period, start))
+    return keys
+
+
+def rollup_filter(key):
+    namespace, package, version, period, start = key
+    return {"namespace": namespace, "package": package, "version": version, "period": period, "start": start}
+
+
+def rollup_updates(namespace, package, version, day, count=1):
+    """
+    Function to build the updates incrementing the rollups of a package and of one of its
+    versions for every granularity.
+
+    Parameters:
+    namespace (str): The namespace name of the package.
+    package (str): The name of the package.
+    version (str): The downloaded version.
+    day (datetime): The day of the downloads.
+    count (int): The number of downloads.
+
+    Returns:
+    list: The UpdateOne operations to apply on the download_rollups collection.
+    """
+    return [
+        UpdateOne(
+            rollup_filter(key),
+            {"$inc": {"downloads": count}, "$setOnInsert": {"bucket": bucket_name(key[4], key[3])}},
+            upsert=True,
+        )
+        for key in rollup_keys(namespace, package, version, day)
+    ]
+
+
+def download_identity(file):
+    """
+    Function to get the package version a tarball belongs to. Tarballs uploaded before the
+    identity was stored in their metadata are looked up once and their metadata is updated.
+
+    Parameters:
+    file (dict): The tarballs.files document.
+
+    Returns:
+    tuple: The namespace name, package name and version, or None if no package has the tarball.
+    """
+    metadata = file.get("metadata", {})
+    if all(k in metadata for k in ["namespace", "package", "version"]):
+        return metadata["namespace"], metadata["package"], metadata["version"]
+
+    package = db.packages.find_one(
+        {"versions.oid": file["_id"]},
+        {"name": 1, "namespace_name": 1, "versions.$": 1},
+    )
+    if not package:
+        return None
+
+    identity = (package["namespace_name"], package["name"], package["versions"][0]["version"])
+    db.tarballs.files.update_one(
+        {"_id": file["_id"]},
+        {
+            "$set": {
+                "metadata.namespace": identity[0],
+                "metadata.package": identity[1],
+                "metadata.version": identity[2],
+            }
+        },
+    )
+    return identity
+
+
+class DownloadCounter:
+    """
+    Write behind buffer of the tarball downloads. Downloads are aggregated in memory per
+    (tarball, day) and a background thread writes them with one bulk write per collection,
+    so serving a tarball does not wait on the database nor contend on its document.
+    """
+
+    def __init__(self, flush_interval=DOWNLOADS_FLUSH_INTERVAL, flush_size=DOWNLOADS_FLUSH_SIZE):
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.counts = dict()
+        self.files = dict()
+        # Writes which failed, retried as they are by the next flush.
+        self.retries = {"files": [], "rollups": []}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def add(self, file, day):
+        with self.lock:
+            key = (file["_id"], day.strftime("%Y-%m-%d"))
+            self.counts[key] = self.counts.get(key, 0) + 1
+            self.files[file["_id"]] = file
+            if len(self.counts) >= self.flush_size:
+                self.wakeup.set()
+            self.start()
+
+    def start(self):
+        # The thread is (re)started lazily, so that forked worker processes get their own.
+        if self.thread is None or self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.thread = threading.Thread(target=self.run, name="download-counter", daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while True:
+            self.wakeup.wait(self.flush_interval)
+            self.wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Failed to flush the download counters: {e}")
+
+    def flush(self):
+        """
+        Function to write the buffered downloads to the tarball download stats and the rollups.
+        The writes which fail (and only those, so that no download is counted twice) are retried
+        by the next flush.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+        """
+        with self.flush_lock:
+            with self.lock:
+                counts, self.counts = self.counts, dict()
+                files, self.files = self.files, dict()
+                retries, self.retries = self.retries, {"files": [], "rollups": []}
+            if not counts and not any(retries.values()):
+                return
+
+            try:
+                file_updates = []
+                rollups = []
+                identities = dict()
+                for (oid, date), count in counts.items():
+                    file_updates.append(UpdateOne(
+                        {"_id": oid},
+                        {
+                            "$inc": {
+                                "downloads_stats.total_downloads": count,
+                                f"downloads_stats.dates.{date}": count,
+                            }
+                        },
+                    ))
+                    if oid not in identities:
+                        identities[oid] = download_identity(files[oid])
+                    if identities[oid]:
+                        rollups.extend(rollup_updates(*identities[oid], datetime.strptime(date, "%Y-%m-%d"), count))
+            except Exception:
+                # Nothing has been written yet, the downloads are put back in the buffer.
+                with self.lock:
+                    for key, count in counts.items():
+                        self.counts[key] = self.counts.get(key, 0) + count
+                    for oid, file in files.items():
+                        self.files.setdefault(oid, file)
+                    for name, updates in retries.items():
+                        self.retries[name][:0] = updates
+                raise
+
+            errors = []
+            for name, collection, updates in [
+                ("files", db.tarballs.files, retries["files"] + file_updates),
+                ("rollups", db.download_rollups, retries["rollups"] + rollups),
+            ]:
+                if not updates:
+                    continue
+                try:
+                    collection.bulk_write(updates, ordered=False)
+                except BulkWriteError as e:
+                    # The other writes of an unordered bulk write have been applied.
+                    failed = [updates[i["index"]] for i in e.details["writeErrors"]]
+                    errors.append(e)
+                except Exception as e:
+                    failed = updates
+                    errors.append(e)
+                else:
+                    continue
+                with self.lock:
+                    self.retries[name][:0] = failed
+            if errors:
+                raise errors[0]
+
+    def clear(self):
+        with self.lock:
+            self.counts.clear()
+            self.files.clear()
+            self.retries = {"files": [], "rollups": []}
+
+
+download_counter = DownloadCounter()
+atexit.register(download_counter.flush)
+
+
+def record_download(file, day):
+    """
+    Function to count a download of a tarball. The download is written to the database
+    by the next flush of the download counter.
+
+    Parameters:
+    file (dict): The tarballs.files document.
+    day (datetime): The day of the download.
+
+    Returns:
+    None
+    """
+    download_counter.add(file, day)
+
+
+def flush_downloads():
+    """
+    Function to write the buffered downloads to the database immediately.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    download_counter.flush()
+
+
+def backfill_download_rollups():
+    """
+    Function to build the rollups from the per tarball daily download counters recorded before
+    the rollups existed. The downloads of a tarball are added to each rollup at most once, so a
+    backfill interrupted (e.g. by a crash) is resumed by the next start. Once it has completed,
+    it is marked as done in the registry and later starts skip it.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    if db.registry.find_one({"_id": "download_rollups"}):
+        return
+
+    identities = dict()
+    for package in db.packages.find({}, {"name": 1, "namespace_name": 1, "versions.oid": 1, "versions.version": 1}):
+        for version in package.get("versions", []):
+            identities[version["oid"]] = (package["namespace_name"], package["name"], version["version"])
+
+    updates = []
+    for file in db.tarballs.files.find({"downloads_stats.dates": {"$exists": True}}, {"downloads_stats.dates": 1}):
+        identity = identities.get(file["_id"])
+        if not identity:
+            continue
+        # The downloads of the tarball are summed per rollup, which records the tarballs added to it.
+        rollups = dict()
+        for date, downloads in file["downloads_stats"]["dates"].items():
+            for key in rollup_keys(*identity, datetime.strptime(date, "%Y-%m-%d")):
+                rollups[key] = rollups.get(key, 0) + downloads
+        for key, downloads in rollups.items():
+            updates.append(UpdateOne(
+                {**rollup_filter(key), "backfilled_files": {"$ne": file["_id"]}},
+                {
+                    "$inc": {"downloads": downloads},
+                    "$addToSet": {"backfilled_files": file["_id"]},
+                    "$setOnInsert": {"bucket": bucket_name(key[4], key[3])},
+                },
+                upsert=True,
+            ))
+        if len(updates) >= 1000:
+            write_backfilled_rollups(updates)
+            updates = []
+    if updates:
+        write_backfilled_rollups(updates)
+
+    try:
+        db.registry.insert_one({"_id": "download_rollups", "backfilled_at": datetime.utcnow()})
+    except DuplicateKeyError:
+        # Another process completed the backfill concurrently.
+        pass
+
+
+def write_backfilled_rollups(updates):
+    """
+    Function to write the rollup updates of the backfill. The updates of the rollups which
+    already have the downloads of their tarball do not match, and fail to insert a duplicate.
+
+    Parameters:
+    updates (list): The UpdateOne operations of the backfill.
+
+    Returns:
+    None
+    """
+    try:
+        db.download_rollups.bulk_write(updates, ordered=False)
+    except BulkWriteError as e:
+        if any(i["code"] != 11000 for i in e.details["writeErrors"]):
+            raise
+
+
+db.download_rollups.create_index(
+    [
+        ("namespace", ASCENDING),
+        ("package", ASCENDING),
+        ("version", ASCENDING),
+        ("period", ASCENDING),
+        ("start", ASCENDING),
+    ],
+    unique=True,
+)
+backfill_download_rollups()
+
+
+def get_download_stats(namespace, package, version_oids):
+    """
+    Function to get the download stats of a package from its rollups: the total downloads of the
+    package and of its versions, and the daily downloads of the last ROLLUP_PERIODS["day"] days.
+
+    Parameters:
+    namespace (str): The namespace name of the package.
+    package (str): The name of the package.
+    version_oids (dict): The tarball oid of each version, by which the versions are reported.
+
+    Returns:
+    dict: The total downloads, the downloads of each version and the downloads of each day, per version.
+    """
+    stats = {"versions": {oid: 0 for oid in version_oids.values()}, "dates": dict(), "total_downloads": 0}
+
+    # The monthly rollups are the fewest documents covering all the downloads.
+    totals = db.download_rollups.aggregate([
+        {"$match": {"namespace": namespace, "package": package, "period": "month"}},
+        {"$group": {"_id": "$version", "downloads": {"$sum": "$downloads"}}},
+    ])
+    for total in totals:
+        if total["_id"] is None:
+            stats["total_downloads"] = total["downloads"]
+        elif total["_id"] in version_oids:
+            stats["versions"][version_oids[total["_id"]]] = total["downloads"]
+
+    start = bucket_start(datetime.now(), "day") - timedelta(days=ROLLUP_PERIODS["day"] - 1)
+    rollups = db.download_rollups.find(
+        {"namespace": namespace, "package": package, "period": "day", "start": {"$gte": start}},
+        {"_id": 0, "version": 1, "start": 1, "downloads": 1},
+    ).sort("start", ASCENDING)
+    for rollup in rollups:
+        date_stats = stats["dates"].setdefault(rollup["start"].strftime("%Y-%m-%d"), {"total_downloads": 0})
+        if rollup["version"] is None:
+            date_stats["total_downloads"] = rollup["downloads"]
+        elif rollup["version"] in version_oids:
+            date_stats[version_oids[rollup["version"]]] = rollup["downloads"]
+    return stats
+
+
+@app.route("/packages/<namespace_name>/<package_name>/downloads", methods=["GET"])
+@swag_from("documentation/get_package_downloads.yaml", methods=["GET"])
+def get_package_downloads(namespace_name, package_name):
+    period = request.args.get("period", "day")
+    version = request.args.get("version")
+
+    if period not in ROLLUP_PERIODS:
+        return jsonify({"code": 400, "message": "Period should be one of day, week or month"}), 400
+
+    try:
+        end = datetime.strptime(request.args["to"], "%Y-%m-%d") if request.args.get("to") else datetime.now()
+        start = datetime.strptime(request.args["from"], "%Y-%m-%d") if request.args.get("from") else None
+    except ValueError:
+        return jsonify({"code": 400, "message": "Dates should be in the YYYY-MM-DD format"}), 400
+
+    end = bucket_start(end, period)
+    if start is None:
+        start = end
+        for _ in range(ROLLUP_PERIODS[period] - 1):
+            start = bucket_start(start - timedelta(days=1), period)
+    start = bucket_start(start, period)
+
+    if start > end:
+        return jsonify({"code": 400, "message": "Start date should not be after the end date"}), 400
+
+    buckets = [start]
+    while buckets[-1] < end:
+        buckets.append(next_bucket_start(buckets[-1], period))
+        if len(buckets) > MAX_ROLLUP_BUCKETS:
+            return (
+                jsonify({"code": 400, "message": f"At most {MAX_ROLLUP_BUCKETS} buckets can be requested at once"}),
+                400,
+            )
+
+    package = db.packages.find_one(
+        {"name": package_name, "namespace_name": namespace_name}, {"versions.version": 1}
+    )
+    if not package:
+        return jsonify({"code": 404, "message": "Package not found"}), 404
+
+    if version and version not in [i["version"] for i in package.get("versions", [])]:
+        return jsonify({"code": 404, "message": "Package version not found"}), 404
+
+    rollups = db.download_rollups.find(
+        {
+            "namespace": namespace_name,
+            "package": package_name,
+            "version": version or None,
+            "period": period,
+            "start": {"$gte": start, "$lte": end},
+        },
+        {"_id": 0, "start": 1, "downloads": 1},
+    )
+    downloads = {i["start"]: i["downloads"] for i in rollups}
+
+    # Buckets without downloads have no rollup document and are reported as 0.
+    data = [
+        {"bucket": bucket_name(i, period), "start": i.strftime("%Y-%m-%d"), "downloads": downloads.get(i, 0)}
+        for i in buckets
+    ]
+    return jsonify({
+        "code": 200,
+        "period": period,
+        "version": version,
+        "downloads": data,
+        "total_downloads": sum(i["downloads"] for i in data),
+    }), 200
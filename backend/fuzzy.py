@@ -0,0 +1,203 @@
+import os
+import threading
+import time
+from mongo import db
+from cache import registry_generation
+
+# Maximum edit distance of a suggestion and the length of the prefix of the names whose
+# deletes are indexed (longer names are matched on their prefix, then fully compared).
+MAX_EDIT_DISTANCE = int(os.getenv("FUZZY_MAX_EDIT_DISTANCE", 2))
+PREFIX_LENGTH = 7
+MAX_SUGGESTIONS = 10
+# Minimum number of seconds between two rebuilds of the fuzzy index, so that a burst of uploads
+# triggers one scan of the packages. The suggestions may miss the names changed in the meantime.
+FUZZY_REBUILD_INTERVAL = float(os.getenv("FUZZY_REBUILD_INTERVAL", 60))
+
+
+def edit_distance(source, target, max_distance):
+    """
+    Function to compute the Damerau-Levenshtein (optimal string alignment) distance of two strings.
+
+    Parameters:
+    source (str): The first string.
+    target (str): The second string.
+    max_distance (int): The distance above which the computation is abandoned.
+
+    Returns:
+    int: The edit distance, or max_distance + 1 if it is larger than max_distance.
+    """
+    if abs(len(source) - len(target)) > max_distance:
+        return max_distance + 1
+
+    previous_row = None
+    row = list(range(len(target) + 1))
+    for i in range(1, len(source) + 1):
+        previous_row, row = row, [i] + [0] * len(target)
+        for j in range(1, len(target) + 1):
+            cost = 0 if source[i - 1] == target[j - 1] else 1
+            row[j] = min(row[j - 1] + 1, previous_row[j] + 1, previous_row[j - 1] + cost)
+            if (
+                i > 1 and j > 1
+                and source[i - 1] == target[j - 2]
+                and source[i - 2] == target[j - 1]
+            ):
+                row[j] = min(row[j], transposition_row[j - 2] + 1)
+        transposition_row = previous_row
+        if min(row) > max_distance:
+            return max_distance + 1
+    return row[-1]
+
+
+def deletes(term, max_distance):
+    """
+    Function to generate every string obtained by deleting up to max_distance characters of a term.
+
+    Parameters:
+    term (str): The term.
+    max_distance (int): The maximum number of deleted characters.
+
+    Returns:
+    set: The deletes of the term, including the term itself.
+    """
+    result = {term}
+    edits = {term}
+    for _ in range(max_distance):
+        edits = {edit[:i] + edit[i + 1:] for edit in edits for i in range(len(edit))}
+        result |= edits
+    return result
+
+
+class SymSpellIndex:
+    """
+    Symmetric delete spelling correction index over the package and namespace names.
+    Every name is stored under the deletes of its prefix, so the candidates for a term are
+    found by looking up the deletes of the term instead of comparing it with every name.
+    """
+
+    def __init__(self, max_distance=MAX_EDIT_DISTANCE, prefix_length=PREFIX_LENGTH):
+        self.max_distance = max_distance
+        self.prefix_length = prefix_length
+        self.deletes = dict()
+        self.entries = dict()
+
+    def add(self, term, entry):
+        term = term.lower()
+        if term not in self.entries:
+            self.entries[term] = []
+            for delete in deletes(term[:self.prefix_length], self.max_distance):
+                self.deletes.setdefault(delete, []).append(term)
+        self.entries[term].append(entry)
+
+    def lookup(self, term, max_suggestions=MAX_SUGGESTIONS):
+        term = term.lower()
+        candidates = set()
+        for delete in deletes(term[:self.prefix_length], self.max_distance):
+            candidates.update(self.deletes.get(delete, []))
+
+        suggestions = []
+        for candidate in candidates:
+            distance = edit_distance(term, candidate, self.max_distance)
+            if distance <= self.max_distance:
+                suggestions.extend(
+                    {**entry, "distance": distance} for entry in self.entries[candidate]
+                )
+
+        suggestions.sort(key=lambda x: (x["distance"], x["namespace"], x.get("name", "")))
+        return suggestions[:max_suggestions]
+
+
+_index = {"generation": None, "index": None, "rebuild": None, "built_at": None}
+_index_lock = threading.Lock()
+_first_build_lock = threading.Lock()
+
+
+def build_fuzzy_index():
+    """
+    Function to build the fuzzy index from the package and namespace names in the database.
+
+    Parameters:
+    None
+
+    Returns:
+    SymSpellIndex: The fuzzy index.
+    """
+    index = SymSpellIndex()
+    for package in db.packages.find({"is_deprecated": False}, {"_id": 0, "name": 1, "namespace_name": 1}):
+        index.add(package["name"], {"namespace": package["namespace_name"], "name": package["name"]})
+    for namespace in db.namespaces.find({}, {"_id": 0, "namespace": 1}):
+        index.add(namespace["namespace"], {"namespace": namespace["namespace"]})
+    return index
+
+
+def rebuild_fuzzy_index(generation):
+    """
+    Function to rebuild the fuzzy index in the background and swap it in once it is complete.
+
+    Parameters:
+    generation (tuple): The registry generation the index is rebuilt for.
+
+    Returns:
+    None
+    """
+    try:
+        built_at = time.monotonic()
+        index = build_fuzzy_index()
+        with _index_lock:
+            _index["index"] = index
+            _index["generation"] = generation
+            _index["built_at"] = built_at
+    except Exception as e:
+        print(f"Failed to rebuild the fuzzy index: {e}")
+    finally:
+        with _index_lock:
+            _index["rebuild"] = None
+
+
+def clear_fuzzy_index():
+    with _index_lock:
+        _index["index"] = None
+        _index["generation"] = None
+        _index["built_at"] = None
+
+
+def suggest(term):
+    """
+    Function to get the "did you mean" suggestions for a mistyped package or namespace name.
+    The index is built once per process. When the registry generation changes, it is rebuilt
+    by a background thread, at most once per FUZZY_REBUILD_INTERVAL, and the previous index is
+    used until the new one is complete, so the requests never wait on a scan of the packages
+    after the first one.
+
+    Parameters:
+    term (str): The mistyped name.
+
+    Returns:
+    list: The closest packages ({namespace, name, distance}) and namespaces
+    ({namespace, distance}), closest first.
+    """
+    generation = registry_generation()
+    with _index_lock:
+        index = _index["index"]
+        if (
+            index is not None
+            and _index["generation"] != generation
+            and _index["rebuild"] is None
+            and time.monotonic() - _index["built_at"] >= FUZZY_REBUILD_INTERVAL
+        ):
+            _index["rebuild"] = threading.Thread(
+                target=rebuild_fuzzy_index, args=(generation,), name="fuzzy-index", daemon=True
+            )
+            _index["rebuild"].start()
+
+    if index is None:
+        with _first_build_lock:
+            with _index_lock:
+                index = _index["index"]
+            if index is None:
+                built_at = time.monotonic()
+                index = build_fuzzy_index()
+                with _index_lock:
+                    _index["index"] = index
+                    _index["generation"] = generation
+                    _index["built_at"] = built_at
+    return index.lookup(term)
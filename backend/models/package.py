@@ -1,7 +1,10 @@
+import semantic_version
+
+
 class Package:
     def __init__(self, name, namespace, namespace_name, description, homepage, repository,
                     copyright, license, created_at, updated_at, author, maintainers, keywords, categories, is_deprecated, versions=[], id=None,unable_to_verify=False,
-                        malicious_report={},  registry_description=None,is_verified=False, is_malicious=False, security_status="No security issues found", ratings={"users": {}, "avg_ratings": 0}):
+                        malicious_report={},  registry_description=None,is_verified=False, is_malicious=False, security_status="No security issues found", ratings={"users": {}, "avg_ratings": 0}, latest_version=None):
         self.id = id
         self.name = name
         self.namespace = namespace
@@ -27,6 +30,7 @@ class Package:
         self.ratings = ratings
         self.categories = categories
         self.unable_to_verify = unable_to_verify
+        self.latest_version = latest_version
 
         # Ensure that versions list only contains instances of Version class
         for v in self.versions:
@@ -67,6 +71,7 @@ class Package:
             "security_status": self.security_status,
             "ratings": self.ratings,
             "unable_to_verify": self.unable_to_verify,
+            "latest_version": self.latest_version,
         }
     
     # Create a from_json method.
@@ -103,10 +108,11 @@ class Package:
             security_status=json_data.get("security_status"),
             ratings=json_data.get("ratings"),
             unable_to_verify=json_data.get("unable_to_verify"),
+            latest_version=json_data.get("latest_version"),
         )
     
 class Version:
-    def __init__(self, version, tarball, dependencies, created_at, oid , is_deprecated, download_url, is_verified=False):
+    def __init__(self, version, tarball, dependencies, created_at, oid , is_deprecated, download_url, is_verified=False, sha256=None):
         self.version = version
         self.tarball = tarball
         self.dependencies = dependencies
@@ -115,6 +121,7 @@ class Version:
         self.download_url = download_url
         self.is_verified = is_verified
         self.oid = oid
+        self.sha256 = sha256
 
     # Create a to_json method.
     def to_json(self):
@@ -127,6 +134,7 @@ class Version:
             "download_url": self.download_url,
             "is_verified": self.is_verified,
             "oid": self.oid,
+            "sha256": self.sha256,
         }
     
     # Create a from_json method.
@@ -141,4 +149,19 @@ class Version:
             download_url=json_data.get("download_url"),
             is_verified=json_data.get("is_verified"),
             oid=json_data.get("oid"),
-        )
\ No newline at end of file
+            sha256=json_data.get("sha256"),
+        )
+
+
+def find_latest_version(versions):
+    """
+    Function to find the latest of the versions of a package. Versions are compared in the
+    semantic version order (0.10.0 is after 0.9.0), not in the string order.
+
+    Parameters:
+    versions (list): The version strings.
+
+    Returns:
+    str: The latest version, None if there is no version.
+    """
+    return max(versions, key=lambda x: semantic_version.Version.coerce(x), default=None)
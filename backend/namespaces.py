@@ -9,8 +9,8 @@ from flask_jwt_extended import jwt_required, get_jwt_identity
 from models.namespace import Namespace
 from models.user import User
 
-from datetime import datetime
-from auth import generate_uuid
+from cache import bump_registry_generation
+from upload_tokens import issue_upload_token
 
 # Regular expression pattern for namespace name validation.
 NAMESPACE_NAME_PATTERN = r'^[a-zA-Z0-9_-]+$'
@@ -60,6 +60,7 @@ def create_namespace():
     ).to_json()
 
     db.namespaces.insert_one(namespace_obj)
+    bump_registry_generation()
 
     return jsonify({"code": 200, "message": "Namespace created successfully"}), 200
 
@@ -92,18 +93,7 @@ def create_upload_token(namespace_name):
         return jsonify({"code": 401, "message": "Unauthorized"}), 401
     
     # Generate an upload token for upload packages to the namespace.
-    upload_token = generate_uuid()
-    
-    upload_token_obj = {
-        "token": upload_token,
-        "createdAt": datetime.utcnow(),
-        "createdBy": user_obj.id
-    }
-
-    db.namespaces.update_one(
-        {"namespace": namespace_name},
-        {"$addToSet": {"upload_tokens": upload_token_obj}}
-    )
+    upload_token = issue_upload_token(user_obj.id, namespace_obj.id)
 
     return jsonify({"code": 200, "message": "Upload token created", "uploadToken": upload_token})
 
@@ -147,6 +137,8 @@ def delete_namespace(namespace_name):
     namespace_deleted = db.namespaces.delete_one({"namespace": namespace_obj.id})
 
     if namespace_deleted.deleted_count > 0:
+        db.upload_tokens.delete_many({"namespace": namespace_obj.id})
+        bump_registry_generation()
         return jsonify({"message": "Namespace deleted successfully","code":200}), 200
     else:
         return jsonify({"message": "Internal Server Error", "code": 500}),200
@@ -0,0 +1,134 @@
+import os
+import shutil
+import subprocess
+import tarfile
+import toml
+from check_digests import check_digests
+from typing import Union, List, Tuple
+
+# The checks of the package contents run in the processes of the validation pool. This module
+# has no side effect at import, so that the processes do not connect to the database.
+
+# Files of the tarballs which are extracted for the validation: the manifest and the model
+# dumped by fpm, the README and the sources and include files which make up the fpm model.
+# Everything else (documentation, data, build artifacts, ...) is skipped.
+MANIFEST_FILES = {'fpm.toml', 'fpm_model.json'}
+SOURCE_EXTENSIONS = {
+    '.f', '.for', '.ftn', '.f77', '.f90', '.f95', '.f03', '.f08', '.fpp', '.fypp', '.inc',
+    '.c', '.h', '.cpp', '.cxx', '.cc', '.hpp', '.hxx',
+}
+
+
+def run_command(command: List[str], cwd: str) -> Union[str, None]:
+    """
+    Execute a command, without a shell, and return its output.
+
+    Args:
+        command (List[str]): The command and its arguments.
+        cwd (str): The working directory of the command.
+
+    Returns:
+        Union[str, None]: The standard output of the command if successful,
+                          otherwise standard error.
+    """
+    result = subprocess.run(command, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+    if result.returncode != 0:
+        print(f"Error executing command: {' '.join(command)}")
+        print(result.stderr)
+    return result.stdout if result.stdout else result.stderr
+
+
+def is_validated_file(name: str) -> bool:
+    """
+    Check whether a file of a tarball is needed by the validation.
+
+    Args:
+        name (str): The normalized path of the file in the tarball.
+
+    Returns:
+        bool: True for the manifests, the README at the root of the package and the sources.
+    """
+    if os.path.basename(name) in MANIFEST_FILES:
+        return True
+    # Only the README files at the root, not e.g. README_assets/ and its contents.
+    if '/' not in name and name.upper().startswith('README'):
+        return True
+    return os.path.splitext(name)[1].lower() in SOURCE_EXTENSIONS
+
+
+def extract_package(tarball_path: str, destination: str) -> int:
+    """
+    Extracts the files of a tarball needed by the validation, reading it as a stream.
+    Only regular files with a relative path inside the destination are extracted: links,
+    devices and paths escaping the destination are skipped.
+
+    Args:
+        tarball_path (str): The path of the gzip compressed tarball.
+        destination (str): The directory to extract the files to.
+
+    Returns:
+        int: The number of files extracted.
+    """
+    extracted = 0
+    with tarfile.open(tarball_path, 'r|gz') as tar:
+        for member in tar:
+            name = os.path.normpath(member.name)
+            if not member.isfile() or os.path.isabs(name) or name == '..' or name.startswith('../'):
+                continue
+            if not is_validated_file(name):
+                continue
+            path = os.path.join(destination, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with tar.extractfile(member) as source, open(path, 'wb') as target:
+                shutil.copyfileobj(source, target)
+            extracted += 1
+    return extracted
+
+
+def process_package(workspace: str) -> Tuple[bool, Union[dict, None], str]:
+    """
+    This function extracts the package contents of the tarball of a workspace, reads and
+    parses 'fpm.toml' and checks digests. It runs in the process pool of the worker, and
+    the workspace is cleaned up by the caller.
+
+    Args:
+        workspace (str): The workspace directory, containing the tarball 'package.tar.gz'.
+
+    Returns:
+        Tuple[bool, Union[dict, None], str]: A tuple containing:
+            - bool: Whether the package processing was successful.
+            - Union[dict, None]: Parsed 'fpm.toml' content if successful, None otherwise.
+            - str: Message describing the result of the package processing.
+    """
+    package_dir = os.path.join(workspace, 'package')
+    os.makedirs(package_dir, exist_ok=True)
+    try:
+        extract_package(os.path.join(workspace, 'package.tar.gz'), package_dir)
+    except (tarfile.TarError, OSError, EOFError):
+        return False, None, "Error extracting tarball"
+
+    generate_model = ['fpm', 'build', '--dump=fpm_model.json'] # TODO: interim bug fix, disable after fpm v0.10.2
+    try:
+        run_command(generate_model, cwd=package_dir)
+    except OSError as e:
+        print(f"Error executing command: {' '.join(generate_model)}")
+        print(e)
+    
+    # Read fpm.toml
+    toml_path = os.path.join(package_dir, 'fpm.toml')
+    try:
+        with open(toml_path, 'r') as file:
+            file_content = file.read()
+        parsed_toml = toml.loads(file_content) # handle toml parsing errors
+    except:
+        return False, None,"Error parsing toml file"
+    
+    result = check_digests(package_dir + '/')
+    # print(result)
+
+    if result[0]==-1:
+        # Package verification failed 
+        return False, parsed_toml, "Digests do not match or file not found."
+    else:
+        # Package verification success
+        return True, parsed_toml, "Package verified successfully."
@@ -2,27 +2,64 @@ from app import app
 from mongo import db
 from mongo import file_storage
 from bson.objectid import ObjectId
-from flask import request, jsonify, abort, send_from_directory
+from pymongo import ReturnDocument
+from flask import Request, request, jsonify, abort, send_file, redirect, make_response
+from werkzeug.wsgi import wrap_file
+from werkzeug.http import is_resource_modified
 from gridfs.errors import NoFile
 from datetime import datetime, timedelta
-from auth import generate_uuid, IS_VERCEL
+from auth import IS_VERCEL
 from app import swagger
-import tarfile
 import os
 import toml
 import shutil
 import json
 from flasgger.utils import swag_from
-from urllib.parse import unquote
+from urllib.parse import unquote, quote
 import math
 import semantic_version
+import hashlib
+import base64
+import time
 from license_expression import get_spdx_licensing
 from flask_jwt_extended import jwt_required, get_jwt_identity
 from models.namespace import Namespace
 from models.user import User
 from models.package import Package
-from models.package import Version
+from models.package import Version, find_latest_version
 from bson import json_util
+from search import search_query, search_index_fields, update_search_statistics, relevance_score
+from search import encode_cursor, cursor_query, facet_pipeline, format_facets
+from search import substring_query, index_package_trigrams
+from cache import search_cache, bump_registry_generation
+from fuzzy import suggest
+from downloads import record_download, get_download_stats
+import storage
+from upload_tokens import find_upload_token, issue_upload_token
+from validation_jobs import enqueue_validation
+from storage import receive_tarball, TarballTooLarge, UploadSpool, BLOB_CHUNK_SIZE, MAX_TARBALL_SIZE
+
+
+# How the tarball bytes of the local blob store are sent once a download has been authorized
+# and counted:
+#   - "" (default): by Flask with send_file.
+#   - "accel": by nginx, with an X-Accel-Redirect to the internal TARBALL_ACCEL_LOCATION.
+#   - "secure_link": by nginx, with a redirect to a link of the TARBALL_SECURE_LINK_LOCATION
+#     signed with TARBALL_SECURE_LINK_SECRET and valid for TARBALL_SECURE_LINK_TTL seconds.
+TARBALL_OFFLOAD = os.getenv("TARBALL_OFFLOAD", "")
+TARBALL_ACCEL_LOCATION = os.getenv("TARBALL_ACCEL_LOCATION", "/internal/packages/")
+TARBALL_SECURE_LINK_LOCATION = os.getenv("TARBALL_SECURE_LINK_LOCATION", "/secure/packages/")
+TARBALL_SECURE_LINK_SECRET = os.getenv("TARBALL_SECURE_LINK_SECRET", "")
+TARBALL_SECURE_LINK_TTL = int(os.getenv("TARBALL_SECURE_LINK_TTL", 300))
+
+# Content addressed tarballs never change, so clients and CDNs may cache them forever.
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Maximum number of packages in a page of the cli search.
+MAX_PAGE_SIZE = int(os.getenv("MAX_PAGE_SIZE", 100))
+
+# Maximum number of attempts to set the latest version of a package updated concurrently.
+LATEST_VERSION_ATTEMPTS = 10
 
 
 parameters = {
@@ -31,6 +68,7 @@ parameters = {
     "createdat": "createdAt",
     "updatedat": "updatedAt",
     "downloads": "downloads",
+    "relevance": "score",
 }
 
 
@@ -75,6 +113,8 @@ def is_valid_license_identifier(license_str):
 def search_packages():
     query = request.args.get("query")
     page = request.args.get("page")
+    cursor = request.args.get("cursor")
+    fuzzy = request.args.get("fuzzy") in ["1", "true"]
     sorted_by = request.args.get("sorted_by")
     sort = request.args.get("sort")
     sorted_by = sorted_by.lower() if sorted_by else "name"
@@ -85,72 +125,85 @@ def search_packages():
         if sorted_by.lower() in parameters.keys()
         else "name"
     )
+    # The most relevant packages come first unless asked otherwise.
+    if sorted_by == "score" and request.args.get("sort") != "asc":
+        sort = -1
     page = int_validation(page,0)
     query = unquote(query.strip().lower())
     packages_per_page = 10
 
+    cache_key = search_cache.key("packages", query, page, cursor, fuzzy, sorted_by, sort)
+    cached_response = search_cache.get(cache_key)
+    if cached_response is not None:
+        return jsonify(cached_response), 200
+
     mongo_db_query = {
         "$and": [
-            {
-                "$or": [
-                    {"name": {"$regex": query}},
-                    {"keywords": {"$in": [query]}},
-                    {"categories": {"$in": [query]}},
-                    {"description": {"$regex": query}},
-                ]
-            },
+            search_query(query),
             {"is_deprecated": False},
         ]
     }
 
-    packages = (
-        db.packages.find(
-            mongo_db_query,
-            {
-                "_id": 0,
-                "name": 1,
-                "namespace": 1,
-                "namespace_name": 1,
-                "author": 1,
-                "description": 1,
-                "keywords": 1,
-                "categories": 1,
-                "updated_at": 1,
-            },
-        )
-        .sort(sorted_by, sort)
-        .limit(packages_per_page)
-        .skip(page * packages_per_page)
+    # Resume from the cursor of the previous page instead of skipping over it.
+    cursor_filter = None
+    if cursor:
+        try:
+            cursor_filter = cursor_query(sorted_by, sort, cursor)
+        except ValueError as e:
+            return jsonify({"code": 400, "message": str(e)}), 400
+
+    packages, total_documents, facets = find_search_page(
+        mongo_db_query,
+        sorted_by,
+        sort,
+        page,
+        cursor_filter,
+        packages_per_page,
+        {
+            "_id": 1,
+            sorted_by: 1,
+            "name": 1,
+            "namespace": 1,
+            "namespace_name": 1,
+            "author": 1,
+            "description": 1,
+            "keywords": 1,
+            "categories": 1,
+            "updated_at": 1,
+        },
+        relevance_score(query) if sorted_by == "score" else None,
     )
 
-    if packages:
-        # Count the number of documents in the database related to query.
-        total_documents = db.packages.count_documents(mongo_db_query)
+    search_packages = []
+    last_package = None
+    for i in packages:
+        package_obj = Package.from_json(i)
+        last_package = i
 
-        total_pages = math.ceil(total_documents / packages_per_page)
+        search_packages.append({
+            "name": package_obj.name,
+            "namespace": package_obj.namespace_name,
+            "description": package_obj.description,
+            "keywords": package_obj.keywords+package_obj.categories,
+            "updated_at": package_obj.updated_at,
+        })
+
+    response = {
+        "code": 200,
+        "packages": search_packages,
+        "next_cursor": next_page_cursor(last_package, sorted_by, len(search_packages), packages_per_page),
+    }
 
-        search_packages = []
-        for i in packages:
-            package_obj = Package.from_json(i)
+    # Counting is skipped while walking the results with a cursor.
+    if total_documents is not None:
+        response["total_pages"] = math.ceil(total_documents / packages_per_page)
+        response["facets"] = facets
 
-            search_packages.append({
-                "name": package_obj.name,
-                "namespace": package_obj.namespace_name,
-                "description": package_obj.description,
-                "keywords": package_obj.keywords+package_obj.categories,
-                "updated_at": package_obj.updated_at,
-            })
-        return (
-            jsonify(
-                {"code": 200, "packages": search_packages, "total_pages": total_pages}
-            ),
-            200,
-        )
-    else:
-        return (
-            jsonify({"status": "error", "message": "packages not found", "code": 404}),
-            404,
-        )
+    if fuzzy:
+        response["did_you_mean"] = suggest(query)
+
+    search_cache.set(cache_key, response)
+    return jsonify(response), 200
 
 def int_validation(param,default_value):
     try:
@@ -158,11 +211,82 @@ def int_validation(param,default_value):
     except:
         return default_value
 
+def find_search_page(mongo_db_query, sorted_by, sort, page, cursor_filter, packages_per_page, projection=None, score=None):
+    """
+    Function to fetch a page of search results.
+
+    Page based requests are answered with a single `$facet` aggregation returning the page,
+    the total number of results and the facet counts. Cursor based requests only fetch the
+    page from the indexed range following the cursor.
+
+    Parameters:
+    mongo_db_query (dict): The mongo filter of the search.
+    sorted_by (str): The field the packages are sorted by.
+    sort (int): 1 for ascending and -1 for descending order.
+    page (int): The page number, ignored when a cursor filter is passed.
+    cursor_filter (dict): The filter selecting the packages after the cursor of the previous page.
+    packages_per_page (int): The maximum number of packages in a page.
+    projection (dict): The fields of the packages to be returned, all fields if None.
+    score (dict): The expression of the relevance `score` field, when sorted by relevance.
+
+    Returns:
+    tuple: The list of package documents, the total number of results and the facets.
+    The total and the facets are None for cursor based requests.
+    """
+    sort_order = [(sorted_by, sort), ("_id", sort)]
+
+    if cursor_filter is not None and score is None:
+        packages = (
+            db.packages.find({"$and": [mongo_db_query, cursor_filter]}, projection)
+            .sort(sort_order)
+            .limit(packages_per_page)
+        )
+        return list(packages), None, None
+
+    if cursor_filter is not None:
+        # The score has to be computed before the cursor filter can be applied on it.
+        pipeline = [
+            {"$match": mongo_db_query},
+            {"$addFields": {"score": score}},
+            {"$match": cursor_filter},
+            {"$sort": dict(sort_order)},
+        ]
+        pipeline.append({"$limit": packages_per_page})
+        if projection:
+            pipeline.append({"$project": projection})
+        return list(db.packages.aggregate(pipeline)), None, None
+
+    pipeline = facet_pipeline(
+        mongo_db_query, sort_order, max(page, 0) * packages_per_page, packages_per_page, projection, score
+    )
+    result = next(db.packages.aggregate(pipeline))
+    total_documents = result["total"][0]["count"] if result["total"] else 0
+    return result["packages"], total_documents, format_facets(result)
+
+def next_page_cursor(last_package, sorted_by, packages_count, packages_per_page):
+    """
+    Function to create the cursor of the page following a page of search results.
+
+    Parameters:
+    last_package (dict): The last package document of the current page.
+    sorted_by (str): The field the packages are sorted by.
+    packages_count (int): The number of packages in the current page.
+    packages_per_page (int): The maximum number of packages in a page.
+
+    Returns:
+    str: The cursor of the next page, None if the current page is the last one.
+    """
+    if last_package is None or packages_count < packages_per_page:
+        return None
+    return encode_cursor(last_package.get(sorted_by), last_package["_id"])
+
 @app.route("/packages_cli", methods=["GET"])
 @swag_from("documentation/search_packages_cli.yaml", methods=["GET"])
 def search_packages_cli():
     query = request.args.get("query")
     page = request.args.get("page")
+    cursor = request.args.get("cursor")
+    fuzzy = request.args.get("fuzzy") in ["1", "true"]
     license = request.args.get("license")
     namespace = "" if request.args.get("namespace")== '*' else request.args.get("namespace")
     package = "" if request.args.get("package") == "*" else request.args.get("package")
@@ -178,67 +302,118 @@ def search_packages_cli():
         else "name"
     )
     query = unquote(query.strip().lower())
+    # The most relevant packages come first unless asked otherwise.
+    if sorted_by == "score" and request.args.get("sort") != "asc":
+        sort = -1
     page = int_validation(page,0)-1
-    packages_per_page = int_validation(packages_per_page,10)
+    # The page is returned in a single aggregation result document, so its size is bounded.
+    packages_per_page = min(max(int_validation(packages_per_page,10), 1), MAX_PAGE_SIZE)
 
-    conditions = [
-    {"namespace_name": {"$regex": namespace, "$options": "i"}} if namespace else None,
-    {"license": {"$regex": license, "$options": "i"}} if license else None,
-    {"name": {"$regex": package, "$options": "i"}} if package else None,
+    cache_key = search_cache.key(
+        "packages_cli", query, page, cursor, fuzzy, namespace, package, license, packages_per_page, sorted_by, sort
+    )
+    cached_response = search_cache.get(cache_key)
+    if cached_response is not None:
+        return jsonify(cached_response), 200
+
+    # Case insensitive substring filters, resolved through the trigram index.
+    filters = [
+        (["registry_description", "description"], query),
+        (["namespace_name"], namespace) if namespace else None,
+        (["license"], license) if license else None,
+        (["name"], package) if package else None,
     ]
 
     mongo_db_query = {
         "$and": [
-          {
-            "$or": [
-                    {"registry_description": {"$regex": query, "$options": "i"}},
-                    {"description": {"$regex": query, "$options": "i"}},
-                   ]
-            },
+            substring_query([i for i in filters if i]),
             {"is_deprecated": False},
         ]
     }
-    mongo_db_query["$and"].extend(cond for cond in conditions if cond)
-    total_documents = db.packages.count_documents(mongo_db_query)
 
-    packages_per_page = total_documents if packages_per_page > total_documents else packages_per_page
-
-    packages = (
-        db.packages.find(mongo_db_query)
-        .sort(sorted_by, sort)
-        .limit(packages_per_page)
-        .skip(page * packages_per_page)
+    # Resume from the cursor of the previous page, the total is not counted.
+    cursor_filter = None
+    if cursor:
+        try:
+            cursor_filter = cursor_query(sorted_by, sort, cursor)
+        except ValueError as e:
+            return jsonify({"code": 400, "message": str(e)}), 400
+
+    # Only the fields of the response are fetched, READMEs and version histories are never loaded.
+    packages, total_documents, facets = find_search_page(
+        mongo_db_query,
+        sorted_by,
+        sort,
+        page,
+        cursor_filter,
+        packages_per_page,
+        {
+            "_id": 1,
+            sorted_by: 1,
+            "name": 1,
+            "namespace_name": 1,
+            "description": 1,
+            "latest_version": 1,
+        },
+        relevance_score(query) if sorted_by == "score" else None,
     )
 
-    if packages:
-        total_pages = math.ceil(total_documents / packages_per_page)
+    search_packages = []
+    last_package = None
+    for i in packages:
+        package_obj = Package.from_json(i)
+        last_package = i
 
-        search_packages = []
-        for i in packages:
-            package_obj = Package.from_json(i)
+        search_packages.append({
+            "name": package_obj.name,
+            "namespace": package_obj.namespace_name,
+            "description": package_obj.description,
+            "version": package_obj.latest_version,
+        })
+
+    response = {
+        "code": 200,
+        "packages": search_packages,
+        "next_cursor": next_page_cursor(last_package, sorted_by, len(search_packages), packages_per_page),
+    }
+    if total_documents is not None:
+        response["total_pages"] = math.ceil(total_documents / packages_per_page)
+        response["facets"] = facets
+
+    # Suggest the names closest to the package (or namespace) the user was looking for.
+    if fuzzy:
+        response["did_you_mean"] = suggest(package or namespace or query)
+
+    search_cache.set(cache_key, response)
+    return jsonify(response), 200
+
+
+# Room for the other form fields of an upload besides the tarball.
+UPLOAD_FORM_SIZE = 1024 * 1024
+
+
+class UploadRequest(Request):
+    """
+    Request whose uploaded files are written by the multipart parser straight into the spool
+    directory of the blob store, from which the tarball is committed without another copy.
+    """
+
+    def _get_file_stream(self, total_content_length, content_type, filename=None, content_length=None):
+        return UploadSpool()
 
-            search_packages.append({
-                "name": package_obj.name,
-                "namespace": package_obj.namespace_name,
-                "description": package_obj.description,
-                "version": package_obj.versions[-1].version,
-            })
-        return (
-            jsonify(
-                {"code": 200, "packages": search_packages, "total_pages": total_pages}
-            ),
-            200,
-        )
-    else:
-        return (
-            jsonify({"status": "error", "message": "packages not found", "code": 404}),
-            404,
-        )
+
+# Werkzeug stops reading larger request bodies (413), including the chunked ones without a length.
+app.config["MAX_CONTENT_LENGTH"] = MAX_TARBALL_SIZE + UPLOAD_FORM_SIZE
+app.request_class = UploadRequest
 
 
 @app.route("/packages", methods=["POST"])
 @swag_from("documentation/package_upload.yaml", methods=["POST"])
 def upload():
+    # Reject oversized uploads before their body is parsed.
+    if request.content_length and request.content_length > MAX_TARBALL_SIZE + UPLOAD_FORM_SIZE:
+        return jsonify({"code": 413, "message": f"Tarball is larger than {MAX_TARBALL_SIZE} bytes"}), 413
+
     upload_token = request.form.get("upload_token")
     package_name = request.form.get("package_name")
     package_version = request.form.get("package_version")
@@ -248,21 +423,52 @@ def upload():
 
     dry_run = True if dry_run == "true" else False
 
+    error, upload_context = authorize_upload(upload_token, package_name, package_version, package_license)
+    if error:
+        return error
+
+    if tarball.content_type not in [
+        "application/gzip",
+        "application/zip",
+        "application/octet-stream",
+        "application/x-tar",
+    ]:
+        return jsonify({"code": 400, "message": "Invalid file type"}), 400
+
+    return publish_package(tarball.stream, upload_context, dry_run)
+
+
+def authorize_upload(upload_token, package_name, package_version, package_license):
+    """
+    Function to check the metadata of a package upload and whether its upload token allows it.
+
+    Parameters:
+    upload_token (str): The upload token.
+    package_name (str): The name of the package.
+    package_version (str): The version of the package.
+    package_license (str): The license of the package.
+
+    Returns:
+    tuple: The error response (None if the upload is authorized, and the version does not exist
+    yet) and the upload context, with
+    the namespace, the user, the package document (None for a new package), the name, the
+    version and the license of the package.
+    """
     if not upload_token:
-        return jsonify({"code": 400, "message": "Upload token missing"}), 400
+        return (jsonify({"code": 400, "message": "Upload token missing"}), 400), None
 
     if not package_name:
-        return jsonify({"code": 400, "message": "Package name is missing"}), 400
+        return (jsonify({"code": 400, "message": "Package name is missing"}), 400), None
 
     if not package_version:
-        return jsonify({"code": 400, "message": "Package version is missing"}), 400
+        return (jsonify({"code": 400, "message": "Package version is missing"}), 400), None
 
     if not package_license:
-        return jsonify({"code": 400, "message": "Package license is missing"}), 400
+        return (jsonify({"code": 400, "message": "Package license is missing"}), 400), None
 
     # Check whether version string is valid or not.
     if package_version == "0.0.0" or not is_valid_version_str(package_version):
-        return jsonify({"code": 400, "message": "Version is not valid"}), 400
+        return (jsonify({"code": 400, "message": "Version is not valid"}), 400), None
 
     # Check whether license identifier is valid or not.
     if not is_valid_license_identifier(license_str=package_license):
@@ -274,30 +480,34 @@ def upload():
                 }
             ),
             400,
-        )
+        ), None
 
-    # Find the document that contains the upload token.
-    namespace_doc = db.namespaces.find_one(
-        {"upload_tokens": {"$elemMatch": {"token": upload_token}}}
-    )
+    # Find the upload token from its hash.
+    upload_token_doc = find_upload_token(upload_token)
+
+    if not upload_token_doc:
+        return (jsonify({"code": 401, "message": "Invalid upload token"}), 401), None
+
+    namespace_doc = db.namespaces.find_one({"_id": upload_token_doc["namespace"]})
 
     if not namespace_doc:
-        return jsonify({"code": 401, "message": "Invalid upload token"}), 401
-
-    if namespace_doc:
-        namespace_obj = Namespace.from_json(namespace_doc)
-        upload_token_doc = next(
-            item
-            for item in namespace_doc["upload_tokens"]
-            if item["token"] == upload_token
-        )
-        package_doc = db.packages.find_one(
-            {"name": package_name, "namespace": namespace_obj.id}
-        )
+        return (jsonify({"code": 401, "message": "Invalid upload token"}), 401), None
+
+    namespace_obj = Namespace.from_json(namespace_doc)
+    # Only the fields needed to authorize and publish the upload are read, not the whole package.
+    package_doc = db.packages.find_one(
+        {"name": package_name, "namespace": namespace_obj.id},
+        {"maintainers": 1, "versions.version": 1, "latest_version": 1},
+    )
+
+    # Package upload tokens only allow uploads of their package.
+    if upload_token_doc.get("package") and (not package_doc or package_doc["_id"] != upload_token_doc["package"]):
+        return (jsonify({"code": 401, "message": "Upload token is not valid for this package"}), 401), None
 
     # Check if the token is expired.
-    # Expire the token after one week of it's creation.
-    if check_token_expiry(upload_token_created_at=upload_token_doc["createdAt"]):
+    # Expire the token after one week of it's creation. The TTL index removes expired tokens
+    # in the background, so they may still be found for a short while.
+    if check_token_expiry(upload_token_created_at=upload_token_doc["created_at"]):
         return (
             jsonify(
                 {
@@ -306,14 +516,14 @@ def upload():
                 }
             ),
             401,
-        )
+        ), None
 
     # Get the user connected to the upload token.
-    user_id = upload_token_doc["createdBy"]
+    user_id = upload_token_doc["created_by"]
     user = db.users.find_one({"_id": user_id})
 
     if not user:
-        return jsonify({"code": 404, "message": "User not found"}), 404
+        return (jsonify({"code": 404, "message": "User not found"}), 404), None
     
     user_obj = User.from_json(user)
 
@@ -322,7 +532,7 @@ def upload():
         if checkUserUnauthorizedForNamespaceTokenCreation(
             user_id=user_obj.id, namespace_obj=namespace_obj
         ):
-            return jsonify({"code": 401, "message": "Unauthorized"}), 401
+            return (jsonify({"code": 401, "message": "Unauthorized"}), 401), None
     else:
         # User should be either namespace maintainer or namespace admin or package maintainer to upload a package.
         package_obj = Package.from_json(package_doc)
@@ -331,19 +541,42 @@ def upload():
             package_namespace=namespace_obj,
             package_obj=package_obj,
         ):
-            return jsonify({"message": "Unauthorized", "code": 401}), 401
+            return (jsonify({"message": "Unauthorized", "code": 401}), 401), None
+
+        # Check if version of the package already exists in the backend, before the tarball is
+        # received.
+        if package_version in [i["version"] for i in package_doc.get("versions", [])]:
+            return (jsonify({"message": "Version already exists", "code": 400}), 400), None
+
+    return None, {
+        "namespace_obj": namespace_obj,
+        "user_obj": user_obj,
+        "package_doc": package_doc,
+        "package_name": package_name,
+        "package_version": package_version,
+        "package_license": package_license,
+    }
 
-    package_doc = db.packages.find_one(
-        {"name": package_name, "namespace": namespace_obj.id}
-    )
 
-    if tarball.content_type not in [
-        "application/gzip",
-        "application/zip",
-        "application/octet-stream",
-        "application/x-tar",
-    ]:
-        return jsonify({"code": 400, "message": "Invalid file type"}), 400
+def publish_package(stream, upload_context, dry_run, sha256=None):
+    """
+    Function to receive the tarball of an authorized upload and publish the package version.
+
+    Parameters:
+    stream (file): The tarball.
+    upload_context (dict): The upload context returned by authorize_upload.
+    dry_run (bool): Whether the upload is only checked.
+    sha256 (str): The expected hex SHA-256 digest of the tarball, if known.
+
+    Returns:
+    tuple: The response to the upload.
+    """
+    namespace_obj = upload_context["namespace_obj"]
+    user_obj = upload_context["user_obj"]
+    package_name = upload_context["package_name"]
+    package_version = upload_context["package_version"]
+    package_license = upload_context["package_license"]
+    package_doc = upload_context["package_doc"]
 
     tarball_name = "{}-{}.tar.gz".format(package_name, package_version)
 
@@ -355,26 +588,20 @@ def upload():
         "registry_description": "Package Under Verification",
     }
 
-    file_url = f"{package_name}_{package_version}_{tarball_name}"
-    file_object_id = file_storage.put(
-        data=file_url, content_type="application/text", filename=tarball_name, encoding="utf-8", metadata={'url':file_url}
-    )
-
-    static_dir = os.path.join("static", "packages")
-    if not os.path.exists(static_dir):
-        os.makedirs(static_dir)
-    file_path = os.path.join(static_dir, file_url)
-    tarball.save(file_path)
-
+    # The tarball is read once: it is hashed, checked against the size limit and its tar headers
+    # are parsed while it is received (or read back from the spool the request parser wrote it
+    # to). It is stored only once the upload is accepted.
     try:
-        # Save the tarball to the directory
-
-        # Optionally verify the tarball (e.g., check if it's a valid tar.gz file)
-        with tarfile.open(file_path, "r:gz") as tar:
-            tar.getnames()
+        pending_tarball = receive_tarball(stream)
+    except TarballTooLarge as e:
+        return jsonify({"code": 413, "message": str(e)}), 413
     except Exception as e:
         return jsonify({"code": 400, "message": f"Invalid tarball file. {e}"}), 400
 
+    if sha256 and pending_tarball.digest != sha256.lower():
+        pending_tarball.discard()
+        return jsonify({"code": 400, "message": "Tarball SHA-256 digest does not match"}), 400
+
     # No previous recorded versions of the package found.
     if not package_doc:
         try:
@@ -397,6 +624,7 @@ def upload():
                 versions=[],
             )
         except KeyError as e:
+            pending_tarball.discard()
             return (
                 jsonify(
                     {
@@ -406,7 +634,13 @@ def upload():
                 ),
                 400,
             )
-        
+
+        if dry_run:
+            pending_tarball.discard()
+            return jsonify({"message": "Dry run Successful.", "code": 200}), 200
+
+        file_object_id = commit_tarball(pending_tarball, tarball_name, namespace_obj, package_name, package_version)
+
         version_obj = Version(
             version=package_version,
             tarball=tarball_name,
@@ -415,15 +649,19 @@ def upload():
             is_deprecated=False,
             oid= file_object_id,
             download_url=f"/tarballs/{file_object_id}",
+            sha256=pending_tarball.digest,
         )
 
         # Append the first version document.
         package_obj.versions.append(version_obj)
+        package_obj.latest_version = version_obj.version
 
-        if dry_run:
-            return jsonify({"message": "Dry run Successful.", "code": 200}), 200
-
-        db.packages.insert_one(package_obj.to_json())
+        package_json = package_obj.to_json()
+        package_json.update(search_index_fields(package_json))
+        db.packages.insert_one(package_json)
+        update_search_statistics(None, package_json)
+        index_package_trigrams(package_json)
+        bump_registry_generation()
 
         package = db.packages.find_one(
             {
@@ -438,21 +676,15 @@ def upload():
 
         update_user_obj_with_package_id(user_obj, package["_id"])
 
+        enqueue_validation(package["_id"], package_version, file_object_id)
+
         return jsonify({"message": "Package Uploaded Successfully.", "code": 200})
     else:
-        # Check if version of the package already exists in the backend.
-        package_version_doc = db.packages.find_one(
-            {
-                "name": package_name,
-                "namespace": namespace_obj.id,
-                "versions.version": package_version,
-            }
-        )
-
-        if package_version_doc:
-            return jsonify({"message": "Version already exists", "code": 400}), 400  
+        if dry_run:
+            pending_tarball.discard()
+            return jsonify({"message": "Dry run Successful.", "code": 200}), 200
 
-        package_obj = Package.from_json(package_doc)
+        file_object_id = commit_tarball(pending_tarball, tarball_name, namespace_obj, package_name, package_version)
 
         new_version = Version(
             version=package_version,
@@ -462,25 +694,96 @@ def upload():
             is_deprecated=False,
             oid = file_object_id,
             download_url=f"/tarballs/{file_object_id}",
+            sha256=pending_tarball.digest,
         )
 
+        # Append the version only if it is still absent, in a single atomic update which leaves
+        # the rest of the package untouched. A version after the latest version read with the
+        # package becomes the latest version in the same update, if that one is still the latest.
+        latest_version = package_doc.get("latest_version")
+        query = {"_id": package_doc["_id"], "versions.version": {"$ne": package_version}}
+        update = {"$push": {"versions": new_version.to_json()}, "$set": {"updated_at": datetime.utcnow()}}
+        is_latest_version = find_latest_version(list(filter(None, [latest_version, package_version]))) == package_version
+        if is_latest_version:
+            query["latest_version"] = latest_version
+            update["$set"]["latest_version"] = package_version
+        package_updated = db.packages.update_one(query, update)
+
+        if package_updated.matched_count == 0 and is_latest_version:
+            # The latest version changed concurrently, it is compared again once the version is appended.
+            del query["latest_version"]
+            del update["$set"]["latest_version"]
+            package_updated = db.packages.update_one(query, update)
+            if package_updated.matched_count == 1:
+                update_latest_version(package_doc["_id"])
+
+        if package_updated.matched_count == 0:
+            # The same version has been uploaded concurrently.
+            file_storage.delete(file_object_id)
+            return jsonify({"message": "Version already exists", "code": 400}), 400
+
+        bump_registry_generation()
+        enqueue_validation(package_doc["_id"], package_version, file_object_id)
 
-        package_obj.versions.append(new_version)
-        
-        package_obj.versions = sorted(
-            package_obj.versions, key=lambda x: x.version
-        )
-        package_obj.updatedAt = datetime.utcnow()
+        return jsonify({"message": "Package Uploaded Successfully.", "code": 200}), 200
 
-        if dry_run:
-            return jsonify({"message": "Dry run Successful.", "code": 200}), 200
 
-        db.packages.update_one(
-            {"_id": ObjectId(package_obj.id)},
-            {"$set": package_obj.to_json()},
+def update_latest_version(package_id):
+    """
+    Function to set the latest version of a package from its versions, in the semantic version
+    order (which MongoDB cannot compare). The version is set only if the latest version is still
+    the one it was compared against, or compared again with the versions added meanwhile.
+
+    Parameters:
+    package_id (ObjectId): The id of the package.
+
+    Returns:
+    None
+
+    Raises:
+    RuntimeError: If the package is updated concurrently by LATEST_VERSION_ATTEMPTS attempts.
+    """
+    for _ in range(LATEST_VERSION_ATTEMPTS):
+        package = db.packages.find_one({"_id": package_id}, {"versions.version": 1, "latest_version": 1})
+        if not package:
+            return
+        latest_version = find_latest_version([i["version"] for i in package.get("versions", [])])
+        if package.get("latest_version") == latest_version:
+            return
+        updated = db.packages.update_one(
+            {"_id": package_id, "latest_version": package.get("latest_version")},
+            {"$set": {"latest_version": latest_version}},
         )
+        if updated.matched_count == 1:
+            return
+    raise RuntimeError(f"Failed to set the latest version of package {package_id}")
+
+
+def commit_tarball(pending_tarball, tarball_name, namespace_obj, package_name, package_version):
+    """
+    Function to store an accepted tarball in the blob store and create the GridFS record of the version.
+
+    Parameters:
+    pending_tarball (PendingTarball): The received tarball.
+    tarball_name (str): The file name of the tarball.
+    namespace_obj (Namespace): The namespace of the package.
+    package_name (str): The name of the package.
+    package_version (str): The version of the package.
+
+    Returns:
+    ObjectId: The id of the GridFS record of the version.
+    """
+    pending_tarball.commit()
+    return file_storage.put(
+        data=pending_tarball.key, content_type="application/text", filename=tarball_name, encoding="utf-8", metadata={
+            'url': pending_tarball.key,
+            'sha256': pending_tarball.digest,
+            'namespace': namespace_obj.namespace,
+            'package': package_name,
+            'version': package_version,
+        }
+    )
 
-        return jsonify({"message": "Package Uploaded Successfully.", "code": 200}), 200
 
 def update_namespace_obj_with_package_id(namespace_obj, package):
     namespace_obj.packages.append(package["_id"])
@@ -516,32 +819,144 @@ def check_token_expiry(upload_token_created_at):
     return False
 
 
+def secure_link(uri, expires):
+    """
+    Function to sign a link for the nginx secure_link module, configured with
+    secure_link_md5 "$secure_link_expires$uri $secret".
+
+    Parameters:
+    uri (str): The path of the link.
+    expires (int): The unix timestamp after which the link is rejected.
+
+    Returns:
+    str: The signed link.
+    """
+    digest = hashlib.md5(f"{expires}{uri} {TARBALL_SECURE_LINK_SECRET}".encode("utf-8")).digest()
+    signature = base64.urlsafe_b64encode(digest).decode("utf-8").rstrip("=")
+    return f"{quote(uri)}?md5={signature}&expires={expires}"
+
+
+def tarball_response(file, size):
+    """
+    Function to send a tarball from the blob store. Tarballs of the local store are sent by
+    Flask, or by nginx with sendfile if the transfer is offloaded. Tarballs of the other stores
+    are redirected to their direct download URL if the store has one, or streamed otherwise.
+
+    Parameters:
+    file (dict): The tarballs.files document of the tarball.
+    size (int): The size of the tarball in bytes.
+
+    Returns:
+    Response: The response sending the tarball.
+    """
+    file_url = file['metadata']['url']
+    download_name = file.get('filename') or os.path.basename(file_url)
+    digest = file['metadata'].get('sha256')
+    etag = f"sha256-{digest}" if digest else None
+    local_path = storage.blob_store.local_path(file_url)
+
+    # Tarballs are immutable: conditional requests matching the digest (or the upload date) are
+    # answered here, before the transfer is offloaded to nginx or the blob store.
+    if not is_resource_modified(request.environ, etag=etag, last_modified=file.get('uploadDate')):
+        response = make_response("", 304)
+        if etag:
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+    if local_path and TARBALL_OFFLOAD == "accel":
+        # nginx sends this ETag (and no ETag of its own) with the tarball.
+        response = make_response("")
+        response.headers["X-Accel-Redirect"] = quote(TARBALL_ACCEL_LOCATION + file_url)
+        response.headers["Content-Type"] = "application/gzip"
+        response.headers["Content-Disposition"] = f'attachment; filename="{download_name}"'
+        if etag:
+            response.set_etag(etag)
+            response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+        return response
+
+    if local_path and TARBALL_OFFLOAD == "secure_link":
+        expires = int(time.time()) + TARBALL_SECURE_LINK_TTL
+        return redirect(secure_link(TARBALL_SECURE_LINK_LOCATION + file_url, expires))
+
+    # Range, If-Range and conditional requests are answered from the ETag and Last-Modified
+    # headers of the tarball. Content addressed tarballs use their digest as ETag.
+    if local_path:
+        response = send_file(
+            local_path,
+            mimetype="application/gzip",
+            as_attachment=True,
+            download_name=download_name,
+            conditional=True,
+            etag=f"sha256-{digest}" if digest else True,
+        )
+        response.headers["Accept-Ranges"] = "bytes"
+    else:
+        url = storage.blob_store.url(file_url, download_name)
+        if url:
+            return redirect(url)
+
+        response = app.response_class(
+            wrap_file(request.environ, storage.blob_store.open(file_url), BLOB_CHUNK_SIZE),
+            mimetype="application/gzip",
+            direct_passthrough=True,
+        )
+        response.content_length = size
+        response.headers["Content-Disposition"] = f'attachment; filename="{download_name}"'
+        if digest:
+            response.set_etag(f"sha256-{digest}")
+        response.last_modified = file.get('uploadDate')
+        response.make_conditional(request.environ, accept_ranges=True, complete_length=size)
+
+    if digest:
+        response.headers["Cache-Control"] = IMMUTABLE_CACHE_CONTROL
+    return response
+
+
+def is_complete_download(response, size):
+    """
+    Function to check whether a response to a tarball request completes a download. Resumed
+    downloads are counted once, by the request fetching the last byte of the tarball. HEAD
+    requests, and conditional requests answered with 304, are not counted.
+
+    Parameters:
+    response (Response): The response sending the tarball.
+    size (int): The size of the tarball in bytes.
+
+    Returns:
+    bool: True if the download should be counted.
+    """
+    if request.method == "HEAD":
+        return False
+
+    if response.status_code == 302 or "X-Accel-Redirect" in response.headers:
+        # nginx or the blob store answer the range and conditional requests, so the requested
+        # range is checked here.
+        if request.range is None:
+            return True
+        return any(end is None or end >= size for _, end in request.range.ranges)
+
+    if response.status_code == 206:
+        return response.content_range is not None and response.content_range.stop == size
+    return response.status_code == 200
+
+
 @app.route("/tarballs/<oid>", methods=["GET"])
 @swag_from("documentation/get_tarball.yaml", methods=["GET"])
 def serve_gridfs_file(oid):
     try:
-        file = list(db.tarballs.files.find({'_id':ObjectId(oid)}))[0]
-        
-        file_path = os.path.join("static/packages/", file['metadata']['url'])
-        package_version_doc = db.tarballs.files.update_one(
-            {"_id": ObjectId(oid)},
-            {
-                "$inc": {
-                    "downloads_stats.total_downloads": 1,
-                    f"downloads_stats.dates.{str(datetime.now())[:10]}": 1,
-                }
-            },
+        file = db.tarballs.files.find_one(
+            {'_id': ObjectId(oid)}, {'filename': 1, 'uploadDate': 1, 'metadata': 1}
         )
-        if package_version_doc.modified_count > 0:
-            if os.path.exists(file_path):
-                return send_from_directory("static/packages/", file['metadata']['url'], as_attachment=True)
-            # Return the file data as a Flask response object
-            # return send_file(
-            #     file,
-            #     download_name=file.filename,
-            #     as_attachment=True,
-            #     mimetype=file.content_type,
-            # )
+
+        if file:
+            size = storage.blob_store.size(file['metadata']['url'])
+            if size is not None:
+                response = tarball_response(file, size)
+                # The download is counted in memory and written to the database in the background.
+                if is_complete_download(response, size):
+                    record_download(file, datetime.now())
+                return response
         return jsonify({"message": "Package version not found", "code": 404}), 404
 
     except NoFile:
@@ -579,37 +994,25 @@ def get_package(namespace_name, package_name):
         ratings = 0
         rating_count = {}
 
-    # package_obj.downloads_stats Data Model
+    # Download stats Data Model, read from the download rollups
     # downloads_stats:
     #     total_downloads:1
     #     versions:
     #         oid1:1 
     #         oid2:1
-    #     dates:
+    #     dates: (the last 30 days)
     #         date1:
     #             oid1:1
     #             oid2:1
     #             total_downloads:1
-    
-    downloads_stats = dict()
-    downloads_stats['versions'] = dict()
-    downloads_stats['dates'] = dict()
-    downloads_stats['total_downloads'] = 0
-    try:
-        for i in package_obj.versions:
-            version_oid =  db.tarballs.files.find_one({"_id": ObjectId(i.oid)})
-            downloads_stats['versions'][str(i.oid)] = version_oid['downloads_stats']['total_downloads']
-            downloads_stats['total_downloads'] += version_oid['downloads_stats']['total_downloads']
-            for DATE_VALUE in version_oid['downloads_stats']['dates']:
-                downloads_stats['dates'][DATE_VALUE] = dict()
-                downloads_stats['dates'][DATE_VALUE][str(i.oid)] = version_oid['downloads_stats']['dates'][DATE_VALUE]
-            for i in downloads_stats['dates']:
-                downloads_stats['dates'][i]['total_downloads'] = sum(downloads_stats['dates'][i].values())
-    except:
-        downloads_stats = dict()
+    downloads_stats = get_download_stats(
+        namespace_name, package_name, {i.version: str(i.oid) for i in package_obj.versions}
+    )
 
     version_history = [{k: v for k, v in i.items() if k != 'tarball'} for i in package_obj.to_json()["versions"]]
-    latest_version_data = package_obj.versions[-1].to_json()
+    latest_version_data = next(
+        (i for i in package_obj.versions if i.version == package_obj.latest_version), package_obj.versions[-1]
+    ).to_json()
     latest_version_data['oid'] = str(latest_version_data['oid'])
     for i in version_history:
         i['oid'] = str(i['oid'])
@@ -772,6 +1175,11 @@ def delete_package(namespace_name, package_name):
     )
 
     if package_deleted.deleted_count > 0:
+        update_search_statistics(package, None)
+        db.package_trigrams.delete_one({"_id": package["_id"]})
+        db.upload_tokens.delete_many({"package": package["_id"]})
+        db.validation_jobs.delete_many({"package": package["_id"]})
+        bump_registry_generation()
         return jsonify({"message": "Package deleted successfully", "code": 200}), 200
     else:
         return jsonify({"message": "Internal Server Error", "code": 500}), 500
@@ -813,12 +1221,17 @@ def delete_package_version(namespace_name, package_name, version):
         return jsonify({"message": "Namespace does not found", "code": 404}), 404
 
     # Perform the pull operation.
-    result = db.packages.update_one(
+    package = db.packages.find_one_and_update(
         {"name": package_name, "namespace": namespace["_id"]},
         {"$pull": {"versions": {"version": version}}},
+        projection={"versions.version": 1},
+        return_document=ReturnDocument.AFTER,
     )
 
-    if result.matched_count:
+    if package:
+        update_latest_version(package["_id"])
+        db.validation_jobs.delete_one({"package": package["_id"], "version": version})
+        bump_registry_generation()
         return jsonify({"message": "Package version deleted successfully"}), 200
     else:
         return (
@@ -873,17 +1286,7 @@ def create_token_upload_token_package(namespace_name, package_name):
         )
 
     # Generate the token.
-    upload_token = generate_uuid()
-
-    upload_token_obj = {
-        "token": upload_token,
-        "created_at": datetime.utcnow(),
-        "created_by": user_doc["_id"],
-    }
-
-    db.packages.update_one(
-        {"_id": package_obj.id}, {"$addToSet": {"upload_tokens": upload_token_obj}}
-    )
+    upload_token = issue_upload_token(user_doc["_id"], namespace_obj.id, package_doc["_id"])
 
     return (
         jsonify(
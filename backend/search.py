@@ -0,0 +1,511 @@
+import re
+import math
+import base64
+import binascii
+from bson import json_util
+from datetime import datetime
+from collections import Counter
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from mongo import db
+from models.package import find_latest_version
+
+# Fields of a package document that are tokenized into `search_terms`.
+SEARCH_FIELDS = ["name", "keywords", "categories", "description"]
+
+# Fields of a package document scored by the BM25 relevance ranking, with their weights
+# (a term in the name counts as three occurrences of the term).
+RELEVANCE_FIELDS = {"name": 3, "keywords": 2, "categories": 2, "description": 1, "registry_description": 1}
+
+# BM25 parameters, and the maximum number of indexed terms a query token is expanded to.
+BM25_K1 = 1.2
+BM25_B = 0.75
+MAX_TERM_EXPANSIONS = 32
+
+# Facets counted for the search results and the package fields they are counted on.
+FACET_FIELDS = {"licenses": "license", "namespaces": "namespace_name", "categories": "categories"}
+FACET_SIZE = 20
+
+# Fields of a package document indexed by trigrams in the `package_trigrams` collection,
+# used by the case insensitive substring filters of the cli search.
+TRIGRAM_FIELDS = ["namespace_name", "license", "name", "registry_description", "description"]
+
+# Above this number of trigram candidates a filter is resolved by the regexes alone.
+TRIGRAM_CANDIDATE_LIMIT = 10000
+
+# A token is a run of word characters, optionally joined by `-` (e.g. `test_package`, `json-fortran`).
+TOKEN_PATTERN = re.compile(r"\w+(?:-\w+)*")
+TOKEN_SEPARATOR_PATTERN = re.compile(r"[_-]+")
+
+
+def tokenize(text):
+    """
+    Function to split a text into lowercase search tokens.
+
+    Compound tokens like `test_package` or `json-fortran` are kept as a whole and are also
+    split into their parts so that both `test_package` and `package` match the package.
+
+    Parameters:
+    text (str): The text to be tokenized.
+
+    Returns:
+    list: The unique tokens of the text, in order of appearance.
+    """
+    tokens = []
+    for token in TOKEN_PATTERN.findall(str(text).lower()):
+        tokens.append(token)
+        tokens.extend(part for part in TOKEN_SEPARATOR_PATTERN.split(token) if part)
+    return list(dict.fromkeys(tokens))
+
+
+def search_terms(package):
+    """
+    Function to compute the indexed search terms of a package document.
+
+    Parameters:
+    package (dict): The package document (or the fields of it which are being updated).
+
+    Returns:
+    list: The sorted list of unique terms to be stored in the `search_terms` field.
+    """
+    terms = set()
+    for field in SEARCH_FIELDS:
+        value = package.get(field)
+        if not value:
+            continue
+        values = value if isinstance(value, list) else [value]
+        for i in values:
+            terms.update(tokenize(i))
+    return sorted(terms)
+
+
+def term_frequencies(package):
+    """
+    Function to compute the weighted frequencies of the terms of a package document,
+    used by the BM25 relevance ranking.
+
+    Parameters:
+    package (dict): The package document.
+
+    Returns:
+    dict: The frequency of every term in the RELEVANCE_FIELDS of the package.
+    """
+    frequencies = Counter()
+    for field, weight in RELEVANCE_FIELDS.items():
+        value = package.get(field)
+        if not value:
+            continue
+        values = value if isinstance(value, list) else [value]
+        for i in values:
+            for token in TOKEN_PATTERN.findall(str(i).lower()):
+                frequencies[token] += weight
+                for part in TOKEN_SEPARATOR_PATTERN.split(token):
+                    if part and part != token:
+                        frequencies[part] += weight
+    return dict(frequencies)
+
+
+def search_index_fields(package):
+    """
+    Function to compute the fields of a package document maintained for the search.
+
+    Parameters:
+    package (dict): The package document (merged with the fields of it which are being updated).
+
+    Returns:
+    dict: The `search_terms`, `term_frequencies` and `document_length` fields.
+    """
+    frequencies = term_frequencies(package)
+    return {
+        "search_terms": search_terms(package),
+        "term_frequencies": frequencies,
+        "document_length": sum(frequencies.values()),
+    }
+
+
+def update_search_statistics(previous, current):
+    """
+    Function to incrementally update the corpus statistics of the BM25 relevance ranking,
+    the number of packages containing every term and the total length of the packages.
+
+    Parameters:
+    previous (dict): The search fields of the package before the update, None for a new package.
+    current (dict): The search fields of the package after the update, None for a deleted package.
+
+    Returns:
+    None
+    """
+    previous = previous if previous and "term_frequencies" in previous else {}
+    current = current or {}
+    previous_terms = set(previous.get("term_frequencies", {}))
+    current_terms = set(current.get("term_frequencies", {}))
+
+    operations = [
+        UpdateOne({"_id": term}, {"$inc": {"documents": 1}}, upsert=True)
+        for term in current_terms - previous_terms
+    ] + [
+        UpdateOne({"_id": term}, {"$inc": {"documents": -1}})
+        for term in previous_terms - current_terms
+    ]
+    if operations:
+        db.search_statistics.bulk_write(operations, ordered=False)
+    if previous_terms - current_terms:
+        db.search_statistics.delete_many({"documents": {"$lte": 0}})
+
+    db.registry.update_one(
+        {"_id": "search_corpus"},
+        {
+            "$inc": {
+                "documents": ("term_frequencies" in current) - ("term_frequencies" in previous),
+                "total_length": current.get("document_length", 0) - previous.get("document_length", 0),
+            }
+        },
+        upsert=True,
+    )
+
+
+def relevance_score(query):
+    """
+    Function to build the aggregation expression computing the BM25 score of a package for a query.
+
+    The query tokens are expanded to the indexed terms they are a prefix of, as the search
+    matches term prefixes. The inverse document frequencies are computed once per query from
+    the precomputed corpus statistics, so scoring a package is a single expression evaluated
+    by mongo on its stored `term_frequencies`.
+
+    Parameters:
+    query (str): The (lowercase) search query.
+
+    Returns:
+    dict: The aggregation expression of the score.
+    """
+    corpus = db.registry.find_one({"_id": "search_corpus"}) or {}
+    documents = max(corpus.get("documents", 0), 1)
+    average_length = max(corpus.get("total_length", 0) / documents, 1)
+
+    terms = dict()
+    for token in TOKEN_PATTERN.findall(query) or [query]:
+        expansions = db.search_statistics.find(
+            {"_id": {"$regex": "^" + re.escape(token)}}
+        ).sort("_id", ASCENDING).limit(MAX_TERM_EXPANSIONS)
+        for term in expansions:
+            terms[term["_id"]] = term["documents"]
+
+    scores = []
+    for term, term_documents in terms.items():
+        idf = math.log(1 + (documents - term_documents + 0.5) / (term_documents + 0.5))
+        frequency = {"$ifNull": [f"$term_frequencies.{term}", 0]}
+        scores.append(
+            {
+                "$divide": [
+                    {"$multiply": [idf * (BM25_K1 + 1), frequency]},
+                    {"$add": [frequency, "$$length_norm"]},
+                ]
+            }
+        )
+
+    return {
+        "$let": {
+            "vars": {
+                "length_norm": {
+                    "$add": [
+                        BM25_K1 * (1 - BM25_B),
+                        {"$multiply": [BM25_K1 * BM25_B / average_length, {"$ifNull": ["$document_length", 0]}]},
+                    ]
+                }
+            },
+            "in": {"$add": scores} if scores else 0,
+        }
+    }
+
+
+def search_query(query):
+    """
+    Function to build the mongo filter matching the packages for a search query.
+
+    Every token of the query has to match the prefix of an indexed term of the package.
+    Anchored, case sensitive regexes on the lowercase `search_terms` are resolved
+    as range scans on the `search_terms` index instead of collection scans.
+
+    Parameters:
+    query (str): The (lowercase) search query.
+
+    Returns:
+    dict: The mongo filter for the query.
+    """
+    terms = TOKEN_PATTERN.findall(query) or [query]
+    return {
+        "$and": [
+            {"search_terms": {"$regex": "^" + re.escape(term)}} for term in terms
+        ]
+    }
+
+
+def trigrams(text):
+    """
+    Function to compute the set of lowercase trigrams (3 character substrings) of a text.
+
+    Parameters:
+    text (str): The text.
+
+    Returns:
+    list: The sorted list of unique trigrams of the text.
+    """
+    text = str(text).lower()
+    return sorted({text[i:i + 3] for i in range(len(text) - 2)})
+
+
+def index_package_trigrams(package):
+    """
+    Function to store the trigrams of the substring searchable fields of a package.
+
+    Parameters:
+    package (dict): The package document, including its `_id`.
+
+    Returns:
+    None
+    """
+    db.package_trigrams.update_one(
+        {"_id": package["_id"]},
+        {"$set": {field: trigrams(package.get(field) or "") for field in TRIGRAM_FIELDS}},
+        upsert=True,
+    )
+
+
+def wildcard_regex(pattern):
+    """
+    Function to convert a substring pattern, where `*` matches any run of characters,
+    to a regex. Every other character is matched literally.
+
+    Parameters:
+    pattern (str): The substring pattern.
+
+    Returns:
+    str: The regex matching the pattern anywhere in a string.
+    """
+    return ".*".join(re.escape(fragment) for fragment in pattern.split("*"))
+
+
+def substring_query(filters):
+    """
+    Function to build the mongo filter for case insensitive substring filters.
+
+    The trigrams of every filter are looked up in the `package_trigrams` index, and only the
+    packages containing all of them (the intersection of the posting lists) are checked
+    against the regexes. Filters shorter than three characters cannot be resolved by trigrams.
+
+    Parameters:
+    filters (list): The (fields, pattern) pairs, a package matches a pair if any of the fields
+    contains the pattern.
+
+    Returns:
+    dict: The mongo filter matching the packages which satisfy every filter.
+    """
+    conditions = []
+    trigram_conditions = []
+    for fields, pattern in filters:
+        regex = {"$regex": wildcard_regex(pattern), "$options": "i"}
+        conditions.append({"$or": [{field: regex} for field in fields]})
+
+        pattern_trigrams = sorted(
+            set().union(*(trigrams(fragment) for fragment in pattern.split("*")))
+        )
+        if pattern_trigrams:
+            trigram_conditions.append(
+                {"$or": [{field: {"$all": pattern_trigrams}} for field in fields]}
+            )
+
+    if trigram_conditions:
+        candidates = [
+            i["_id"]
+            for i in db.package_trigrams.find({"$and": trigram_conditions}, {"_id": 1})
+            .limit(TRIGRAM_CANDIDATE_LIMIT + 1)
+        ]
+        if len(candidates) <= TRIGRAM_CANDIDATE_LIMIT:
+            conditions.append({"_id": {"$in": candidates}})
+
+    return {"$and": conditions}
+
+
+def encode_cursor(sort_value, object_id):
+    """
+    Function to encode the position of the last package of a page into an opaque cursor.
+
+    Parameters:
+    sort_value: The value of the sort field of the last package.
+    object_id (ObjectId): The id of the last package.
+
+    Returns:
+    str: The url safe cursor token.
+    """
+    data = json_util.dumps([sort_value, object_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(data).decode("ascii")
+
+
+def decode_cursor(cursor):
+    """
+    Function to decode a cursor created by `encode_cursor`.
+
+    Parameters:
+    cursor (str): The cursor token.
+
+    Returns:
+    tuple: The sort value and the id of the last package of the previous page.
+
+    Raises:
+    ValueError: If the cursor is malformed.
+    """
+    try:
+        sort_value, object_id = json_util.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except (binascii.Error, UnicodeError, TypeError, ValueError) as e:
+        raise ValueError(f"Invalid cursor. {e}")
+    return sort_value, object_id
+
+
+def cursor_query(sorted_by, sort, cursor):
+    """
+    Function to build the mongo filter selecting the packages after a cursor, for packages
+    sorted by `[(sorted_by, sort), ("_id", sort)]`.
+
+    Missing sort values sort before every other value in ascending order and after every
+    other value in descending order, so they are handled separately.
+
+    Parameters:
+    sorted_by (str): The field the packages are sorted by.
+    sort (int): 1 for ascending and -1 for descending order.
+    cursor (str): The cursor token of the previous page.
+
+    Returns:
+    dict: The mongo filter for the next page.
+    """
+    sort_value, object_id = decode_cursor(cursor)
+    operator = "$gt" if sort == 1 else "$lt"
+    conditions = [{sorted_by: sort_value, "_id": {operator: object_id}}]
+
+    if sort_value is None:
+        if sort == 1:
+            conditions.append({sorted_by: {"$ne": None}})
+    else:
+        conditions.append({sorted_by: {operator: sort_value}})
+        if sort == -1:
+            conditions.append({sorted_by: None})
+
+    return {"$or": conditions}
+
+
+def facet_pipeline(mongo_db_query, sort_order, skip, limit, projection=None, score=None):
+    """
+    Function to build the aggregation pipeline returning a page of search results, the total
+    number of matching packages and the facet counts in a single round trip.
+
+    Parameters:
+    mongo_db_query (dict): The mongo filter of the search.
+    sort_order (list): The (field, direction) pairs the results are sorted by.
+    skip (int): The number of results to skip.
+    limit (int): The maximum number of results in the page, at least 1.
+    projection (dict): The fields of the results to be returned, all fields if None.
+    score (dict): The expression of the `score` field added to the results, if any.
+
+    Returns:
+    list: The aggregation pipeline, it yields a single document with the `packages`,
+    `total` and facet fields.
+    """
+    packages_stages = [{"$addFields": {"score": score}}] if score else []
+    # The page is part of the single result document, which is limited to 16 MB.
+    packages_stages += [{"$sort": dict(sort_order)}, {"$skip": skip}, {"$limit": limit}]
+    if projection:
+        packages_stages.append({"$project": projection})
+
+    facets = {"packages": packages_stages, "total": [{"$count": "count"}]}
+    for facet, field in FACET_FIELDS.items():
+        facets[facet] = [
+            {"$unwind": f"${field}"},
+            {"$group": {"_id": f"${field}", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1, "_id": 1}},
+            {"$limit": FACET_SIZE},
+        ]
+
+    return [{"$match": mongo_db_query}, {"$facet": facets}]
+
+
+def format_facets(result):
+    """
+    Function to convert the facet fields of a `facet_pipeline` result to the response format.
+
+    Parameters:
+    result (dict): The document returned by the `facet_pipeline` aggregation.
+
+    Returns:
+    dict: The list of {value, count} buckets of every facet, most frequent first.
+    """
+    return {
+        facet: [{"value": i["_id"], "count": i["count"]} for i in result.get(facet, [])]
+        for facet in FACET_FIELDS
+    }
+
+
+def build_search_index():
+    """
+    Function to create the search indexes and backfill the search fields, the relevance
+    statistics, the trigrams and `latest_version` for the packages uploaded before they existed.
+    Every step of the backfill only updates the packages it has not reached yet, so a backfill
+    interrupted (e.g. by a crash) is resumed by the next start. Once it has completed, it is
+    marked as done in the registry and later starts skip it.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    db.packages.create_index([("search_terms", ASCENDING), ("is_deprecated", ASCENDING)])
+    db.packages.create_index([("is_deprecated", ASCENDING), ("name", ASCENDING), ("_id", ASCENDING)])
+    for field in TRIGRAM_FIELDS:
+        db.package_trigrams.create_index(field)
+
+    if db.registry.find_one({"_id": "search_index"}):
+        return
+
+    packages = db.packages.find(
+        {"term_frequencies": {"$exists": False}},
+        {field: 1 for field in SEARCH_FIELDS + list(RELEVANCE_FIELDS)},
+    )
+    for package in packages:
+        fields = search_index_fields(package)
+        # The statistics are counted only by the process which indexed the package.
+        updated = db.packages.update_one(
+            {"_id": package["_id"], "term_frequencies": {"$exists": False}}, {"$set": fields}
+        )
+        if updated.modified_count:
+            update_search_statistics(None, fields)
+
+    indexed_packages = set(db.package_trigrams.distinct("_id"))
+    missing_packages = [
+        i["_id"] for i in db.packages.find({}, {"_id": 1}) if i["_id"] not in indexed_packages
+    ]
+    if missing_packages:
+        packages = db.packages.find(
+            {"_id": {"$in": missing_packages}}, {field: 1 for field in TRIGRAM_FIELDS}
+        )
+        for package in packages:
+            index_package_trigrams(package)
+
+    # The cli search only reads the stored latest version instead of the version history.
+    packages = db.packages.find(
+        {"latest_version": {"$exists": False}, "versions.0": {"$exists": True}},
+        {"versions.version": 1},
+    )
+    for package in packages:
+        db.packages.update_one(
+            {"_id": package["_id"], "latest_version": {"$exists": False}},
+            {"$set": {"latest_version": find_latest_version([i["version"] for i in package["versions"]])}},
+        )
+
+    try:
+        db.registry.insert_one({"_id": "search_index", "backfilled_at": datetime.utcnow()})
+    except DuplicateKeyError:
+        # Another process completed the backfill concurrently.
+        pass
+
+
+build_search_index()
@@ -6,6 +6,9 @@ import auth
 import user
 import packages
 import namespaces
+import catalog
+import downloads
+import uploads
 
 
 @app.route("/")
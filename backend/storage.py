@@ -0,0 +1,399 @@
+import os
+import hashlib
+import shutil
+import tempfile
+import tarfile
+from abc import ABC, abstractmethod
+from gridfs import GridFS
+from mongo import db
+
+# Where the tarball bytes are stored: "local" (TARBALLS_DIR on this node), "gridfs" (chunks in
+# the tarball_blobs GridFS bucket) or "s3" (a bucket of an S3 compatible object store).
+TARBALL_STORAGE = os.getenv("TARBALL_STORAGE", "local")
+
+# Directory of the tarballs of the local store.
+TARBALLS_DIR = os.path.join("static", "packages")
+
+# Settings of the S3 compatible store. S3_ENDPOINT_URL is only needed for stores other than AWS (e.g. MinIO).
+S3_BUCKET = os.getenv("S3_BUCKET", "fpm-registry-tarballs")
+S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")
+S3_REGION = os.getenv("S3_REGION")
+S3_ACCESS_KEY_ID = os.getenv("S3_ACCESS_KEY_ID")
+S3_SECRET_ACCESS_KEY = os.getenv("S3_SECRET_ACCESS_KEY")
+S3_PRESIGNED_URL_TTL = int(os.getenv("S3_PRESIGNED_URL_TTL", 300))
+
+# Size of the chunks in which the blobs are streamed.
+BLOB_CHUNK_SIZE = 1024 * 1024
+
+# Maximum size of an uploaded tarball in bytes.
+MAX_TARBALL_SIZE = int(os.getenv("MAX_TARBALL_SIZE", 100 * 1024 * 1024))
+
+
+class BlobStore(ABC):
+    """
+    Interface of the stores of the tarball bytes. Blobs are identified by a key, a relative
+    path such as sha256/ab/ab...89.tar.gz, and are written and read as streams. A store which
+    does not implement put, open, size and delete cannot be created.
+    """
+
+    # Directory of the temporary files of the uploads, the system one by default.
+    spool_dir = None
+
+    @abstractmethod
+    def put(self, key, stream):
+        pass
+
+    @abstractmethod
+    def open(self, key):
+        pass
+
+    @abstractmethod
+    def size(self, key):
+        pass
+
+    def exists(self, key):
+        return self.size(key) is not None
+
+    def put_file(self, key, path):
+        with open(path, "rb") as f:
+            self.put(key, f)
+
+    @abstractmethod
+    def delete(self, key):
+        pass
+
+    def local_path(self, key):
+        # Path of the blob on this node, for the stores that can be served by Flask or nginx directly.
+        return None
+
+    def url(self, key, download_name):
+        # URL from which the blob can be downloaded directly, for the stores that provide one.
+        return None
+
+
+class LocalBlobStore(BlobStore):
+    """
+    Store of the blobs in a directory of the local filesystem (or of a volume shared by the replicas).
+    """
+
+    def __init__(self, root=TARBALLS_DIR):
+        self.root = root
+        # Uploads are spooled on the same filesystem, so they are committed without a copy.
+        self.spool_dir = root
+
+    def local_path(self, key):
+        return os.path.join(self.root, key)
+
+    def put(self, key, stream):
+        path = self.local_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".upload-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                shutil.copyfileobj(stream, f, BLOB_CHUNK_SIZE)
+            # mkstemp creates the file readable by its owner only, nginx has to read it too.
+            os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    def put_file(self, key, path):
+        target = self.local_path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        # Temporary files are readable by their owner only, nginx has to read the tarballs too.
+        os.chmod(path, 0o644)
+        try:
+            # Linking creates the blob atomically, with its full content.
+            os.link(path, target)
+        except FileExistsError:
+            # An identical tarball has been stored concurrently.
+            pass
+
+    def open(self, key):
+        return open(self.local_path(key), "rb")
+
+    def size(self, key):
+        path = self.local_path(key)
+        return os.path.getsize(path) if os.path.isfile(path) else None
+
+    def delete(self, key):
+        path = self.local_path(key)
+        if os.path.isfile(path):
+            os.remove(path)
+        # Remove the directories left empty, e.g. the one of a finalized or expired upload.
+        root = os.path.normpath(self.root)
+        directory = os.path.dirname(os.path.normpath(path))
+        while directory.startswith(root + os.sep):
+            try:
+                os.rmdir(directory)
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+
+class GridFSBlobStore(BlobStore):
+    """
+    Store of the blobs as GridFS files, whose bytes are chunked in the database.
+    """
+
+    def __init__(self, database=db, collection="tarball_blobs"):
+        self.fs = GridFS(database, collection=collection)
+        self.files = database[collection].files
+
+    def put(self, key, stream):
+        file_id = self.fs.put(stream, filename=key)
+        # If the same blob was written concurrently, the oldest copy is kept.
+        oldest = self.files.find_one({"filename": key}, {"_id": 1}, sort=[("_id", 1)])
+        if oldest and oldest["_id"] != file_id:
+            self.fs.delete(file_id)
+
+    def open(self, key):
+        return self.fs.get_version(key, version=0)
+
+    def size(self, key):
+        file = self.files.find_one({"filename": key}, {"length": 1})
+        return file["length"] if file else None
+
+    def delete(self, key):
+        for file in self.files.find({"filename": key}, {"_id": 1}):
+            self.fs.delete(file["_id"])
+
+
+class S3BlobStore(BlobStore):
+    """
+    Store of the blobs in a bucket of an S3 compatible object store (AWS S3, MinIO, ...).
+    Downloads are redirected to presigned URLs of the objects.
+    """
+
+    def __init__(
+        self,
+        bucket=S3_BUCKET,
+        endpoint_url=S3_ENDPOINT_URL,
+        region=S3_REGION,
+        access_key_id=S3_ACCESS_KEY_ID,
+        secret_access_key=S3_SECRET_ACCESS_KEY,
+    ):
+        try:
+            import boto3
+            from botocore.exceptions import ClientError
+        except ImportError:
+            raise RuntimeError("boto3 is required to store the tarballs in S3. Please install it.")
+
+        self.bucket = bucket
+        self.client_error = ClientError
+        self.client = boto3.client(
+            "s3",
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key_id,
+            aws_secret_access_key=secret_access_key,
+        )
+
+        try:
+            self.client.head_bucket(Bucket=self.bucket)
+        except self.client_error:
+            self.client.create_bucket(Bucket=self.bucket)
+
+    def put(self, key, stream):
+        # upload_fileobj streams the blob in a multipart upload.
+        self.client.upload_fileobj(stream, self.bucket, key, ExtraArgs={"ContentType": "application/gzip"})
+
+    def open(self, key):
+        return self.client.get_object(Bucket=self.bucket, Key=key)["Body"]
+
+    def size(self, key):
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=key)["ContentLength"]
+        except self.client_error as e:
+            if e.response.get("Error", {}).get("Code") in ["404", "NoSuchKey", "NotFound"]:
+                return None
+            # Other errors (e.g. 403 for missing permissions) are errors of the store, and are not
+            # reported as a missing blob, which would be taken for an incomplete tarball.
+            raise
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=key)
+
+    def url(self, key, download_name):
+        return self.client.generate_presigned_url(
+            "get_object",
+            Params={
+                "Bucket": self.bucket,
+                "Key": key,
+                "ResponseContentDisposition": f'attachment; filename="{download_name}"',
+            },
+            ExpiresIn=S3_PRESIGNED_URL_TTL,
+        )
+
+
+def create_blob_store(kind=TARBALL_STORAGE):
+    """
+    Function to create the blob store configured by TARBALL_STORAGE.
+
+    Parameters:
+    kind (str): The kind of store, local, gridfs or s3.
+
+    Returns:
+    BlobStore: The blob store.
+    """
+    if kind == "gridfs":
+        return GridFSBlobStore()
+    if kind == "s3":
+        return S3BlobStore()
+    if kind == "local":
+        return LocalBlobStore()
+    raise ValueError(f"Unknown tarball storage {kind}")
+
+
+blob_store = create_blob_store()
+
+
+def tarball_key(digest):
+    return f"sha256/{digest[:2]}/{digest}.tar.gz"
+
+
+class TarballTooLarge(ValueError):
+    pass
+
+
+class UploadSpool:
+    """
+    Temporary file in the spool directory of a blob store, into which the request parser writes
+    an uploaded file directly. A tarball spooled this way is read back by receive_tarball instead
+    of being copied to another temporary file.
+    """
+
+    def __init__(self, store=None):
+        self.store = store or blob_store
+        if self.store.spool_dir:
+            os.makedirs(self.store.spool_dir, exist_ok=True)
+        self.file = tempfile.NamedTemporaryFile(dir=self.store.spool_dir, prefix=".upload-")
+
+    def __getattr__(self, name):
+        return getattr(self.file, name)
+
+
+class TarballReader:
+    """
+    File-like reader passing the bytes of an uploaded tarball through to tarfile, while they are
+    hashed, counted against the size limit and spooled (unless they already are), so the upload
+    is read only once.
+    """
+
+    def __init__(self, stream, spool, max_size):
+        self.stream = stream
+        self.spool = spool
+        self.max_size = max_size
+        self.size = 0
+        self.sha256 = hashlib.sha256()
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(BLOB_CHUNK_SIZE), b""))
+
+        chunk = self.stream.read(size)
+        self.size += len(chunk)
+        if self.size > self.max_size:
+            raise TarballTooLarge(f"Tarball is larger than {self.max_size} bytes")
+        self.sha256.update(chunk)
+        if self.spool:
+            self.spool.write(chunk)
+        return chunk
+
+
+class BlobsReader:
+    """
+    File-like reader of the concatenation of several blobs, which are opened one after the other.
+    """
+
+    def __init__(self, store, keys):
+        self.store = store
+        self.keys = list(keys)
+        self.blob = None
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            return b"".join(iter(lambda: self.read(BLOB_CHUNK_SIZE), b""))
+
+        while True:
+            if self.blob is None:
+                if not self.keys:
+                    return b""
+                self.blob = self.store.open(self.keys.pop(0))
+            chunk = self.blob.read(size)
+            if chunk:
+                return chunk
+            self.blob.close()
+            self.blob = None
+
+    def close(self):
+        if self.blob is not None:
+            self.blob.close()
+            self.blob = None
+
+
+class PendingTarball:
+    """
+    Uploaded tarball, validated and spooled to a temporary file, which is written to the blob
+    store by commit(). The temporary file is removed when the tarball is discarded.
+    """
+
+    def __init__(self, spool, digest, size, store):
+        self.spool = spool
+        self.digest = digest
+        self.size = size
+        self.key = tarball_key(digest)
+        self.store = store
+
+    def commit(self):
+        if not self.store.exists(self.key):
+            self.spool.flush()
+            self.store.put_file(self.key, self.spool.name)
+        self.discard()
+
+    def discard(self):
+        self.spool.close()
+
+
+def receive_tarball(stream, max_size=MAX_TARBALL_SIZE, store=None):
+    """
+    Function to receive an uploaded tarball in a single pass: it is read in chunks which are
+    hashed with SHA-256, checked against the size limit, decompressed once to parse the tar
+    headers, and spooled next to the blob store. A tarball the request parser already wrote to
+    an UploadSpool of the store is read back from it instead. Nothing is stored until the
+    tarball is committed.
+
+    Parameters:
+    stream (file): The uploaded tarball.
+    max_size (int): The maximum size of the tarball in bytes.
+    store (BlobStore): The blob store, the configured one by default.
+
+    Returns:
+    PendingTarball: The validated tarball.
+
+    Raises:
+    TarballTooLarge: If the tarball is larger than max_size.
+    Exception: If the tarball is not a valid gzip compressed tar archive.
+    """
+    store = store or blob_store
+    if isinstance(stream, UploadSpool) and stream.store is store:
+        spool = stream.file
+        reader = TarballReader(spool, None, max_size)
+    else:
+        if store.spool_dir:
+            os.makedirs(store.spool_dir, exist_ok=True)
+        spool = tempfile.NamedTemporaryFile(dir=store.spool_dir, prefix=".upload-")
+        reader = TarballReader(stream, spool, max_size)
+    try:
+        # Iterating over the members of a stream skips their data without seeking back.
+        with tarfile.open(fileobj=reader, mode="r|gz") as tar:
+            for _ in tar:
+                pass
+        # Bytes after the end of the archive (e.g. padding) are part of the tarball too.
+        reader.read()
+    except BaseException:
+        spool.close()
+        raise
+    return PendingTarball(spool, reader.sha256.hexdigest(), reader.size, store)
@@ -1,6 +1,9 @@
 import unittest
 from mongo import client
 from server import app
+from cache import clear_search_cache
+from downloads import download_counter
+from fuzzy import clear_fuzzy_index
 
 
 class BaseTestClass(unittest.TestCase):
@@ -13,3 +16,6 @@ class BaseTestClass(unittest.TestCase):
     def tearDown(self):
         # tear down any variables or configurations set up in setUp()
         client.drop_database("testregistry")
+        clear_search_cache()
+        download_counter.clear()
+        clear_fuzzy_index()
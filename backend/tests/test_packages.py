@@ -2,8 +2,30 @@ from base_case import BaseTestClass
 from mongo import client
 from server import app
 from packages import check_token_expiry
+from cache import bump_registry_generation, registry_generation
+import packages
+import fuzzy
+import threading
+import storage
+from downloads import flush_downloads
+import downloads
+from search import build_search_index
+import search
+from upload_tokens import find_upload_token, migrate_upload_tokens
+from validation_jobs import claim_validation_job, renew_validation_lease, complete_validation_job, fail_validation_job
+from validation_jobs import enqueue_unverified_versions
 from datetime import datetime
+from bson.objectid import ObjectId
+from pymongo.errors import AutoReconnect
+from botocore.stub import Stubber, ANY
+from botocore.exceptions import ClientError
+from unittest import mock
+import boto3
 import random
+import json
+import gzip
+import hashlib
+import io
 import os
 from dotenv import load_dotenv
 
@@ -69,10 +91,748 @@ class TestPackages(BaseTestClass):
         self.access_token = response_for_login.json["access_token"]
         return response_for_login.json["access_token"]
 
-    def upload(self):
+    def upload(self, tarball=None):
         """
         Helper function to upload a package.
 
+        Parameters:
+        tarball (tuple): The tarball file and its name, static/registry.tar.gz by default.
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response code received from the server is not as expected.
+        """
+        access_token = self.login()
+
+        headers = {"Authorization": f"Bearer {access_token}"}
+
+        # Try to create a namespace.
+        if not self.is_namespace_created:
+            response = self.client.post("/namespaces", data=self.test_namespace_data, headers=headers)
+            self.assertEqual(200, response.json["code"])
+            self.is_namespace_created = True
+
+        # Create an upload token for the namespace.
+        response = self.client.post(
+            f"/namespaces/{self.test_namespace_data['namespace']}/uploadToken",
+            headers=headers,
+        )
+
+        self.assertEqual(200, response.json["code"])
+
+        upload_token = response.json["uploadToken"]
+
+        # Upload the package.
+        response = self.client.post(
+            "/packages",
+            content_type="multipart/form-data",
+            data={
+                "upload_token": upload_token,
+                **self.test_package_data,
+                "dry_run": "false",
+                "tarball": tarball or ("static/registry.tar.gz", "package.tar.gz"),
+            },
+            headers=headers,
+        )
+
+        response_data = response.json
+        response_data["uploadToken"] = upload_token
+        return response_data
+
+    def test_successful_package_upload(self):
+        """
+        Test case to verify the behaviour of the system when a user tries to upload a package successfully.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response code received from the server is not as expected.
+        """
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+        print("test_successful_package_upload passed")
+
+    def test_upload_existing_package(self):
+        """
+        Test case to verify the behaviour of the system when a user tries to upload already existing
+        package in the registry.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response code received from the server is not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        response = self.upload()
+        self.assertEqual(400, response["code"])
+
+        # A new version is appended to the existing package and becomes its latest version.
+        self.test_package_data["package_version"] = "0.0.2"
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        package_url = f"/packages/{self.test_namespace_data['namespace']}/{self.test_package_data['package_name']}"
+        data = self.client.get(package_url).json["data"]
+        self.assertEqual("0.0.2", data["latest_version_data"]["version"])
+        self.assertEqual(["0.0.1", "0.0.2"], [i["version"] for i in data["version_history"]])
+        print("test_upload_existing_package passed")
+
+    def test_latest_version_semantic_order(self):
+        """
+        Test case to verify that the latest version of a package follows the semantic version order
+        (0.10.0 is after 0.9.0), on upload and on deletion of a version.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the latest version is not as expected.
+        """
+
+        for version in ["0.9.0", "0.10.0", "0.2.0"]:
+            self.test_package_data["package_version"] = version
+            response = self.upload()
+            self.assertEqual(200, response["code"])
+
+        package_url = f"/packages/{self.test_namespace_data['namespace']}/{self.test_package_data['package_name']}"
+        data = self.client.get(package_url).json["data"]
+        self.assertEqual("0.10.0", data["latest_version_data"]["version"])
+
+        # Deleting the latest version makes the previous one (not the last uploaded) the latest.
+        client.testregistry.users.update_one({"email": self.email}, {"$set": {"roles": ["admin"]}})
+        headers = {"Authorization": f"Bearer {self.access_token}"}
+        response = self.client.post(f"{package_url}/0.10.0/delete", headers=headers)
+        self.assertEqual(200, response.status_code)
+
+        data = self.client.get(package_url).json["data"]
+        self.assertEqual("0.9.0", data["latest_version_data"]["version"])
+        package = client.testregistry.packages.find_one({"name": self.test_package_data["package_name"]})
+        self.assertEqual("0.9.0", package["latest_version"])
+        print("test_latest_version_semantic_order passed")
+
+    def test_latest_version_concurrent_upload(self):
+        """
+        Test case to verify that the latest version of a package stays the greatest one when another version is published during an upload.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the versions or the latest version are not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        # Version 0.3.0 is published while the tarball of version 0.2.0 is received.
+        receive_tarball = packages.receive_tarball
+
+        def concurrent_receive_tarball(stream, *args, **kwargs):
+            client.testregistry.packages.update_one(
+                {"name": self.test_package_data["package_name"]},
+                {"$push": {"versions": {"version": "0.3.0"}}, "$set": {"latest_version": "0.3.0"}},
+            )
+            return receive_tarball(stream, *args, **kwargs)
+
+        self.test_package_data["package_version"] = "0.2.0"
+        packages.receive_tarball = concurrent_receive_tarball
+        try:
+            response = self.upload()
+        finally:
+            packages.receive_tarball = receive_tarball
+        self.assertEqual(200, response["code"])
+
+        package = client.testregistry.packages.find_one({"name": self.test_package_data["package_name"]})
+        self.assertEqual(["0.0.1", "0.3.0", "0.2.0"], [i["version"] for i in package["versions"]])
+        self.assertEqual("0.3.0", package["latest_version"])
+        print("test_latest_version_concurrent_upload passed")
+
+    def test_invalid_tarball_upload(self):
+        """
+        Test case to verify that a rejected tarball leaves nothing behind in the storage.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response code received from the server is not as expected.
+        """
+
+        invalid_tarball = b"not a gzip compressed tarball"
+        response = self.upload(tarball=(io.BytesIO(invalid_tarball), "package.tar.gz"))
+        self.assertEqual(400, response["code"])
+        self.assertEqual(0, client.testregistry.tarballs.files.count_documents({}))
+        digest = hashlib.sha256(invalid_tarball).hexdigest()
+        self.assertFalse(storage.blob_store.exists(storage.tarball_key(digest)))
+        self.assertEqual([], [i for i in os.listdir("static/packages") if i.startswith(".upload-")])
+        print("test_invalid_tarball_upload passed")
+
+    def test_resumable_package_upload(self):
+        """
+        Test case to verify the upload of a package in chunks, sent out of order and resumed.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response code received from the server is not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+        headers = {"X-Upload-Token": response["uploadToken"]}
+
+        with open("static/registry.tar.gz", "rb") as f:
+            tarball = f.read()
+        chunks = [tarball[i:i + 100] for i in range(0, len(tarball), 100)]
+
+        # A version which already exists is rejected before its chunks are uploaded.
+        response = self.client.post(
+            "/uploads",
+            data={"upload_token": headers["X-Upload-Token"], **self.test_package_data, "size": len(tarball)},
+        )
+        self.assertEqual(400, response.json["code"])
+        self.assertEqual("Version already exists", response.json["message"])
+
+        response = self.client.post(
+            "/uploads",
+            data={
+                "upload_token": headers["X-Upload-Token"],
+                **self.test_package_data,
+                "package_version": "0.0.2",
+                "size": len(tarball),
+                "sha256": hashlib.sha256(tarball).hexdigest(),
+            },
+        )
+        self.assertEqual(200, response.json["code"])
+        upload_url = f"/uploads/{response.json['upload_id']}"
+
+        def put_chunk(number, chunk, digest=None):
+            return self.client.put(
+                f"{upload_url}/chunks/{number}",
+                data=chunk,
+                headers={**headers, "X-Chunk-SHA256": digest or hashlib.sha256(chunk).hexdigest()},
+            )
+
+        for number in reversed(range(1, len(chunks))):
+            self.assertEqual(200, put_chunk(number, chunks[number]).status_code)
+
+        self.assertEqual(400, put_chunk(0, chunks[0], digest="0" * 64).status_code)
+        response = self.client.post(f"{upload_url}/finalize", headers=headers)
+        self.assertEqual(400, response.status_code)
+        self.assertEqual("Chunks are missing", response.json["message"])
+
+        # Resume the upload from the chunks received by the server.
+        response = self.client.get(upload_url, headers=headers)
+        received = {i["number"] for i in response.json["chunks"]}
+        for number in set(range(len(chunks))) - received:
+            self.assertEqual(200, put_chunk(number, chunks[number]).status_code)
+
+        # Chunks are not accepted while the session is being finalized.
+        upload_id = ObjectId(upload_url.split("/")[-1])
+        client.testregistry.upload_sessions.update_one({"_id": upload_id}, {"$set": {"finalizing": True}})
+        self.assertEqual(409, put_chunk(0, chunks[1]).status_code)
+        client.testregistry.upload_sessions.update_one({"_id": upload_id}, {"$unset": {"finalizing": ""}})
+
+        # A chunk sent again replaces the previous one, whose bytes are deleted.
+        self.assertEqual(200, put_chunk(0, chunks[1]).status_code)
+        self.assertEqual(200, put_chunk(0, chunks[0]).status_code)
+        self.assertEqual(len(chunks), len(os.listdir(f"static/packages/uploads/{upload_id}")))
+
+        response = self.client.post(f"{upload_url}/finalize", headers={"X-Upload-Token": "invalid"})
+        self.assertEqual(401, response.status_code)
+        response = self.client.post(f"{upload_url}/finalize", headers=headers)
+        self.assertEqual(200, response.json["code"])
+
+        response = self.client.get(
+            f"/packages/{self.test_namespace_data['namespace']}/{self.test_package_data['package_name']}/0.0.2"
+        )
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual(hashlib.sha256(tarball).hexdigest(), response.json["data"]["version_data"]["sha256"])
+        self.assertEqual(404, self.client.get(upload_url, headers=headers).status_code)
+        # The directory of the chunks is removed with them.
+        self.assertFalse(os.path.exists(f"static/packages/uploads/{upload_id}"))
+        self.assertTrue(os.path.isdir("static/packages"))
+        print("test_resumable_package_upload passed")
+
+    def test_upload_tokens(self):
+        """
+        Test case to verify the package upload tokens and the migration of the tokens embedded in namespaces.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response code received from the server is not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+        namespace_url = f"/namespaces/{self.test_namespace_data['namespace']}"
+        package_url = f"/packages/{self.test_namespace_data['namespace']}/{self.test_package_data['package_name']}"
+        headers = {"Authorization": f"Bearer {self.login()}"}
+
+        # The stored tokens are hashed.
+        self.assertIsNone(client.testregistry.upload_tokens.find_one({"_id": response["uploadToken"]}))
+        self.assertIsNotNone(find_upload_token(response["uploadToken"]))
+
+        # A package token can upload new versions of its package only.
+        response = self.client.post(f"{package_url}/uploadToken", headers=headers)
+        self.assertEqual(200, response.json["code"])
+        package_token = response.json["upload_token"]
+        self.test_package_data["package_version"] = "0.0.2"
+        response = self.client.post(
+            "/packages",
+            data={
+                "upload_token": package_token,
+                **self.test_package_data,
+                "tarball": ("static/registry.tar.gz", "package.tar.gz"),
+            },
+        )
+        self.assertEqual(200, response.json["code"])
+        response = self.client.post(
+            "/packages",
+            data={
+                "upload_token": package_token,
+                **self.test_package_data,
+                "package_name": "other-package",
+                "tarball": ("static/registry.tar.gz", "package.tar.gz"),
+            },
+        )
+        self.assertEqual(401, response.json["code"])
+
+        # Tokens embedded in the namespace documents are moved to the upload_tokens collection.
+        namespace = client.testregistry.namespaces.find_one({"namespace": self.test_namespace_data["namespace"]})
+        client.testregistry.namespaces.update_one(
+            {"_id": namespace["_id"]},
+            {"$set": {"upload_tokens": [
+                {"token": "embedded-token", "createdAt": datetime.utcnow(), "createdBy": namespace["author"]},
+            ]}},
+        )
+        # The migration completed when the module was imported is forgotten, as in a new database.
+        client.testregistry.registry.delete_one({"_id": "upload_tokens"})
+
+        # An interrupted migration leaves the tokens in their documents, and is resumed by the next start.
+        upload_tokens = client.testregistry.upload_tokens
+
+        def interrupted_bulk_write(*args, **kwargs):
+            raise AutoReconnect("connection lost")
+
+        upload_tokens.bulk_write = interrupted_bulk_write
+        try:
+            with self.assertRaises(AutoReconnect):
+                migrate_upload_tokens()
+        finally:
+            del upload_tokens.bulk_write
+        self.assertIn("upload_tokens", client.testregistry.namespaces.find_one({"_id": namespace["_id"]}))
+        self.assertIsNone(client.testregistry.registry.find_one({"_id": "upload_tokens"}))
+        migrate_upload_tokens()
+        self.assertNotIn("upload_tokens", client.testregistry.namespaces.find_one({"_id": namespace["_id"]}))
+        self.assertEqual(namespace["_id"], find_upload_token("embedded-token")["namespace"])
+
+        # The migration runs once, later processes do not scan the documents again.
+        client.testregistry.namespaces.update_one(
+            {"_id": namespace["_id"]},
+            {"$set": {"upload_tokens": [
+                {"token": "late-token", "createdAt": datetime.utcnow(), "createdBy": namespace["author"]},
+            ]}},
+        )
+        migrate_upload_tokens()
+        self.assertIsNone(find_upload_token("late-token"))
+        print("test_upload_tokens passed")
+
+    def test_validation_jobs(self):
+        """
+        Test case to verify that uploads queue a validation job, which is leased to a single worker at a time.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the validation jobs are not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        job = claim_validation_job("worker-1")
+        self.assertEqual(self.test_package_data["package_version"], job["version"])
+        self.assertEqual(1, job["attempts"])
+        self.assertIsNone(claim_validation_job("worker-2"))
+        self.assertTrue(renew_validation_lease(job, "worker-1"))
+        self.assertFalse(renew_validation_lease(job, "worker-2"))
+
+        # A failed job is retried after a backoff, by any worker.
+        fail_validation_job(job, "worker-1", "error")
+        self.assertIsNone(claim_validation_job("worker-2"))
+        client.testregistry.validation_jobs.update_one({"_id": job["_id"]}, {"$set": {"available_at": datetime.utcnow()}})
+        job = claim_validation_job("worker-2")
+        self.assertEqual(2, job["attempts"])
+
+        # Only the worker holding the lease can complete the job.
+        complete_validation_job(job, "worker-1")
+        self.assertEqual("running", client.testregistry.validation_jobs.find_one({"_id": job["_id"]})["status"])
+        complete_validation_job(job, "worker-2")
+        self.assertEqual("done", client.testregistry.validation_jobs.find_one({"_id": job["_id"]})["status"])
+        self.assertIsNone(claim_validation_job("worker-1"))
+
+        # Queueing the unverified versions, again after an interruption, leaves their existing jobs as they are.
+        package = client.testregistry.packages.find_one({"name": self.test_package_data["package_name"]})
+        client.testregistry.packages.update_one({"_id": package["_id"]}, {"$set": {"is_verified": False, "versions.0.is_verified": False}})
+        client.testregistry.registry.delete_one({"_id": "validation_jobs"})
+        enqueue_unverified_versions()
+        self.assertEqual("done", client.testregistry.validation_jobs.find_one({"_id": job["_id"]})["status"])
+        self.assertIsNotNone(client.testregistry.registry.find_one({"_id": "validation_jobs"}))
+        print("test_validation_jobs passed")
+
+    def test_incorrect_version_upload(self):
+        """
+        Test case to verify the behaviour of the system when a user tries to upload a package with
+        incorrect version.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        self.test_package_data["package_version"] = "somerandomstring"
+        # Upload the package again with version change.
+
+        response = self.upload()
+        self.assertEqual(400, response["code"])
+        print("test_incorrect_version_upload passed")
+
+    def test_invalid_token_upload(self):
+        """
+        Test case to verify the behaviour of the system if an invalid token is used to upload a package.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        self.test_package_data["upload_token"] = "somerandomtoken123"
+        self.test_package_data["package_version"] = "0.0.1"
+        response = self.upload()
+        self.assertEqual(401, response["code"])
+        print("test_invalid_token_upload passed")
+
+    def test_search_package(self):
+        """
+        Test case to verify the behaviour of the system while searching for a package.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        response = self.client.get(
+            "/packages", query_string={"query": self.test_package_data["package_name"]}
+        )
+
+        self.assertEqual(200, response.json["code"])
+
+        response = self.client.get(
+            "/packages", query_string={"query": "somerandompackage"}
+        )
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual([], response.json["packages"])
+        print("test_search_package passed")
+
+    def test_search_package_by_term_prefix(self):
+        """
+        Test case to verify that the search matches the prefixes of the tokenized package name.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        for query in ["test_pack", "pack", "TEST"]:
+            response = self.client.get("/packages", query_string={"query": query})
+            self.assertEqual(200, response.json["code"])
+            self.assertEqual(
+                [self.test_package_data["package_name"]],
+                [i["name"] for i in response.json["packages"]],
+            )
+        print("test_search_package_by_term_prefix passed")
+
+    def test_search_package_facets(self):
+        """
+        Test case to verify that the search returns the facet counts along with the results.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        response = self.client.get("/packages", query_string={"query": "test_package"})
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual(1, response.json["total_pages"])
+        self.assertEqual([{"value": "MIT", "count": 1}], response.json["facets"]["licenses"])
+        self.assertEqual(
+            [{"value": self.test_namespace_data["namespace"], "count": 1}],
+            response.json["facets"]["namespaces"],
+        )
+        print("test_search_package_facets passed")
+
+    def test_search_package_cache_invalidation(self):
+        """
+        Test case to verify that cached search results are invalidated by a package upload.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        response = self.client.get("/packages", query_string={"query": "test_package"})
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual([], response.json["packages"])
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        response = self.client.get("/packages", query_string={"query": "test_package"})
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual(1, len(response.json["packages"]))
+        print("test_search_package_cache_invalidation passed")
+
+    def test_search_package_cli_cursor(self):
+        """
+        Test case to verify that the cli search results can be walked page by page with cursors.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+        self.test_package_data["package_name"] = "test_package_2"
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        names = []
+        query_string = {"query": "verification", "limit": 1, "page": 1}
+        while True:
+            response = self.client.get("/packages_cli", query_string=query_string)
+            self.assertEqual(200, response.json["code"])
+            if "cursor" in query_string:
+                self.assertNotIn("total_pages", response.json)
+            names.extend(i["name"] for i in response.json["packages"])
+            if not response.json["next_cursor"]:
+                break
+            query_string["cursor"] = response.json["next_cursor"]
+
+        self.assertEqual(["test_package", "test_package_2"], names)
+
+        response = self.client.get("/packages_cli", query_string={"cursor": "invalid"})
+        self.assertEqual(400, response.json["code"])
+        print("test_search_package_cli_cursor passed")
+
+    def test_search_package_cli_limit(self):
+        """
+        Test case to verify that the page size of the cli search is kept between 1 and MAX_PAGE_SIZE.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+        self.test_package_data["package_name"] = "test_package_2"
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        for limit, packages_count, total_pages in [(0, 1, 2), (-5, 1, 2), (100000, 2, 1)]:
+            response = self.client.get("/packages_cli", query_string={"query": "verification", "limit": limit, "page": 1})
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(packages_count, len(response.json["packages"]))
+            self.assertEqual(total_pages, response.json["total_pages"])
+
+        max_page_size = packages.MAX_PAGE_SIZE
+        packages.MAX_PAGE_SIZE = 1
+        try:
+            response = self.client.get("/packages_cli", query_string={"query": "verification", "limit": 100000, "page": 1})
+        finally:
+            packages.MAX_PAGE_SIZE = max_page_size
+        self.assertEqual(1, len(response.json["packages"]))
+        print("test_search_package_cli_limit passed")
+
+    def test_search_package_cli_latest_version(self):
+        """
+        Test case to verify that the cli search returns the latest version of a package.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+        self.test_package_data["package_version"] = "0.0.2"
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        response = self.client.get("/packages_cli", query_string={"query": "verification", "page": 1})
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual(["0.0.2"], [i["version"] for i in response.json["packages"]])
+        print("test_search_package_cli_latest_version passed")
+
+    def test_search_package_cli_substring_filters(self):
+        """
+        Test case to verify the case insensitive substring and wildcard filters of the cli search.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        for package, count in [("_PACK", 1), ("test*age", 1), ("te", 1), ("package_test", 0)]:
+            response = self.client.get(
+                "/packages_cli",
+                query_string={"query": "under verif", "package": package, "license": "mit", "page": 1},
+            )
+            self.assertEqual(200, response.json["code"])
+            self.assertEqual(count, len(response.json["packages"]))
+        print("test_search_package_cli_substring_filters passed")
+
+    def test_search_package_relevance(self):
+        """
+        Test case to verify that the search results can be ranked by relevance.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+        self.test_package_data["package_name"] = "package_package"
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        response = self.client.get("/packages", query_string={"query": "package", "sorted_by": "relevance"})
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual(
+            ["package_package", "test_package"], [i["name"] for i in response.json["packages"]]
+        )
+
+        response = self.client.get(
+            "/packages", query_string={"query": "package", "sorted_by": "relevance", "sort": "asc"}
+        )
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual(
+            ["test_package", "package_package"], [i["name"] for i in response.json["packages"]]
+        )
+        print("test_search_package_relevance passed")
+
+    def test_search_package_fuzzy(self):
+        """
+        Test case to verify the "did you mean" suggestions for a mistyped package name.
+
         Parameters:
         None
 
@@ -80,47 +840,150 @@ class TestPackages(BaseTestClass):
         None
 
         Raises:
-        AssertionError: If the response code received from the server is not as expected.
+        AssertionError: If the response received from the server is not as expected.
         """
-        access_token = self.login()
 
-        headers = {"Authorization": f"Bearer {access_token}"}
-
-        # Try to create a namespace.
-        if not self.is_namespace_created:
-            response = self.client.post("/namespaces", data=self.test_namespace_data, headers=headers)
-            self.assertEqual(200, response.json["code"])
-            self.is_namespace_created = True
+        response = self.upload()
+        self.assertEqual(200, response["code"])
 
-        # Create an upload token for the namespace.
-        response = self.client.post(
-            f"/namespaces/{self.test_namespace_data['namespace']}/uploadToken",
-            headers=headers,
+        response = self.client.get("/packages", query_string={"query": "tset_pakage", "fuzzy": 1})
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual([], response.json["packages"])
+        self.assertEqual(
+            [{"namespace": self.test_namespace_data["namespace"], "name": "test_package", "distance": 2}],
+            response.json["did_you_mean"],
         )
 
+        response = self.client.get(
+            "/packages_cli", query_string={"package": "test_pakcage", "fuzzy": 1, "page": 1}
+        )
         self.assertEqual(200, response.json["code"])
+        self.assertEqual(["test_package"], [i["name"] for i in response.json["did_you_mean"]])
+        print("test_search_package_fuzzy passed")
 
-        upload_token = response.json["uploadToken"]
+    def test_fuzzy_index_background_rebuild(self):
+        """
+        Test case to verify that a registry change does not make the suggestions wait on a rebuild of the fuzzy index,
+        and that the index is rebuilt at most once per rebuild interval.
 
-        # Upload the package.
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the suggestions wait on the rebuild of the fuzzy index.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+        self.assertEqual(["test_package"], [i["name"] for i in fuzzy.suggest("tset_pakage")])
+
+        build_fuzzy_index = fuzzy.build_fuzzy_index
+        rebuild_interval = fuzzy.FUZZY_REBUILD_INTERVAL
+        release = threading.Event()
+        builds = []
+
+        def blocking_build():
+            builds.append(threading.current_thread())
+            release.wait(10)
+            return build_fuzzy_index()
+
+        fuzzy.build_fuzzy_index = blocking_build
+        try:
+            # The index is not rebuilt before the end of the rebuild interval.
+            bump_registry_generation()
+            fuzzy.suggest("tset_pakage")
+            self.assertIsNone(fuzzy._index["rebuild"])
+
+            fuzzy.FUZZY_REBUILD_INTERVAL = 0
+            # The previous index is used while the new one is built in the background.
+            self.assertEqual(["test_package"], [i["name"] for i in fuzzy.suggest("tset_pakage")])
+            rebuild = fuzzy._index["rebuild"]
+            self.assertIsNotNone(rebuild)
+            fuzzy.suggest("tset_pakage")
+            release.set()
+            rebuild.join(10)
+        finally:
+            fuzzy.build_fuzzy_index = build_fuzzy_index
+            fuzzy.FUZZY_REBUILD_INTERVAL = rebuild_interval
+
+        self.assertEqual([rebuild], builds)
+        self.assertEqual(registry_generation(), fuzzy._index["generation"])
+        print("test_fuzzy_index_background_rebuild passed")
+
+    def test_get_catalog(self):
+        """
+        Test case to verify the behaviour of the system while streaming the registry catalog.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+        self.test_package_data["package_version"] = "0.0.2"
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        response = self.client.get("/packages/catalog")
+        self.assertEqual(200, response.status_code)
+        records = [json.loads(line) for line in response.data.decode().splitlines()]
+        self.assertEqual(["0.0.1", "0.0.2"], [i["version"] for i in records])
+
+        response = self.client.get("/packages/catalog", headers={"Accept-Encoding": "gzip"})
+        self.assertEqual("gzip", response.headers["Content-Encoding"])
+        self.assertEqual(len(records), len(gzip.decompress(response.data).decode().splitlines()))
+        print("test_get_catalog passed")
+
+    def test_get_packages_batch(self):
+        """
+        Test case to verify the behaviour of the system while resolving several packages at once.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        namespace = self.test_namespace_data["namespace"]
         response = self.client.post(
-            "/packages",
-            content_type="multipart/form-data",
-            data={
-                "upload_token": upload_token,
-                **self.test_package_data,
-                "dry_run": "false",
-                "tarball": ("static/registry.tar.gz", "package.tar.gz"),
+            "/packages/batch",
+            json={
+                "packages": [
+                    [namespace, "test_package"],
+                    {"namespace": namespace, "name": "test_package", "version": "0.0.1"},
+                    [namespace, "test_package", "2.0.0"],
+                    [namespace, "test_package_hello_world"],
+                ]
             },
-            headers=headers,
         )
+        self.assertEqual(200, response.json["code"])
+        self.assertEqual([200, 200, 404, 404], [i["code"] for i in response.json["packages"]])
+        self.assertEqual("0.0.1", response.json["packages"][0]["data"]["version_data"]["version"])
+        self.assertEqual(self.username, response.json["packages"][0]["data"]["author"])
 
-        response.json["uploadToken"] = upload_token
-        return response.json
+        response = self.client.post("/packages/batch", json={"packages": [["only_namespace"]]})
+        self.assertEqual(400, response.json["code"])
+        print("test_get_packages_batch passed")
 
-    def test_successful_package_upload(self):
+    def test_get_exisiting_package(self):
         """
-        Test case to verify the behaviour of the system when a user tries to upload a package successfully.
+        Test case to verify the behaviour of the system while trying to get a package.
 
         Parameters:
         None
@@ -129,16 +992,61 @@ class TestPackages(BaseTestClass):
         None
 
         Raises:
-        AssertionError: If the response code received from the server is not as expected.
+        AssertionError: If the response received from the server is not as expected.
+        """
+
+        self.upload()
+        # Get the package.
+        response = self.client.get(
+            f"/packages/{self.test_namespace_data['namespace']}/{self.test_package_data['package_name']}"
+        )
+        self.assertEqual(200, response.json["code"])
+        print("test_get_exisiting_package passed")
+
+    def test_get_package_downloads_stats(self):
+        """
+        Test case to verify the download stats of a package with several downloaded versions.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
         """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+        self.test_package_data["package_version"] = "0.0.2"
         response = self.upload()
         self.assertEqual(200, response["code"])
-        print("test_successful_package_upload passed")
 
-    def test_upload_existing_package(self):
+        package_url = f"/packages/{self.test_namespace_data['namespace']}/{self.test_package_data['package_name']}"
+        response = self.client.get(package_url)
+        oids = [i["oid"] for i in response.json["data"]["version_history"]]
+        for oid in oids:
+            response = self.client.get(f"/tarballs/{oid}")
+            self.assertEqual(200, response.status_code)
+        flush_downloads()
+
+        response = self.client.get(package_url)
+        self.assertEqual(200, response.json["code"])
+        downloads = response.json["data"]["downloads"]
+        self.assertEqual(2, downloads["total_downloads"])
+        self.assertEqual({oid: 1 for oid in oids}, downloads["versions"])
+        self.assertEqual([{**{oid: 1 for oid in oids}, "total_downloads": 2}], list(downloads["dates"].values()))
+
+        # The stats are read from the rollups, not summed from the daily counters of the tarballs.
+        client.testregistry.tarballs.files.update_many({}, {"$set": {"downloads_stats.dates.2020-01-01": 100}})
+        response = self.client.get(package_url)
+        self.assertEqual(downloads, response.json["data"]["downloads"])
+        print("test_get_package_downloads_stats passed")
+
+    def test_get_package_downloads_rollups(self):
         """
-        Test case to verify the behaviour of the system when a user tries to upload already existing
-        package in the registry.
+        Test case to verify the daily, weekly and monthly download counts of a package and its versions.
 
         Parameters:
         None
@@ -147,20 +1055,44 @@ class TestPackages(BaseTestClass):
         None
 
         Raises:
-        AssertionError: If the response code received from the server is not as expected.
+        AssertionError: If the response received from the server is not as expected.
         """
 
         response = self.upload()
         self.assertEqual(200, response["code"])
-
+        self.test_package_data["package_version"] = "0.0.2"
         response = self.upload()
-        self.assertEqual(400, response["code"])
-        print("test_upload_existing_package passed")
+        self.assertEqual(200, response["code"])
 
-    def test_incorrect_version_upload(self):
+        package_url = f"/packages/{self.test_namespace_data['namespace']}/{self.test_package_data['package_name']}"
+        response = self.client.get(package_url)
+        oids = [i["oid"] for i in response.json["data"]["version_history"]]
+        for oid in oids + oids[-1:]:
+            response = self.client.get(f"/tarballs/{oid}")
+            self.assertEqual(200, response.status_code)
+        flush_downloads()
+
+        today = datetime.now().strftime("%Y-%m-%d")
+        for period in ["day", "week", "month"]:
+            response = self.client.get(f"{package_url}/downloads", query_string={"period": period})
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(3, response.json["total_downloads"])
+            self.assertEqual(3, response.json["downloads"][-1]["downloads"])
+            self.assertLessEqual(response.json["downloads"][-1]["start"], today)
+
+        response = self.client.get(
+            f"{package_url}/downloads", query_string={"version": "0.0.2", "from": today, "to": today}
+        )
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([{"bucket": today, "start": today, "downloads": 2}], response.json["downloads"])
+
+        response = self.client.get(f"{package_url}/downloads", query_string={"period": "year"})
+        self.assertEqual(400, response.status_code)
+        print("test_get_package_downloads_rollups passed")
+
+    def test_download_rollups_backfill_resumed(self):
         """
-        Test case to verify the behaviour of the system when a user tries to upload a package with
-        incorrect version.
+        Test case to verify that an interrupted backfill of the download rollups is resumed without counting downloads twice.
 
         Parameters:
         None
@@ -169,22 +1101,148 @@ class TestPackages(BaseTestClass):
         None
 
         Raises:
-        AssertionError: If the response received from the server is not as expected.
+        AssertionError: If the rollups are not as expected.
         """
 
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+        self.test_package_data["package_version"] = "0.0.2"
         response = self.upload()
         self.assertEqual(200, response["code"])
 
-        self.test_package_data["package_version"] = "somerandomstring"
-        # Upload the package again with version change.
+        # Download counters recorded before the rollups existed.
+        package = client.testregistry.packages.find_one({"name": self.test_package_data["package_name"]})
+        counters = [{"2024-03-18": 2, "2024-03-19": 1}, {"2024-03-18": 3}]
+        for version, dates in zip(package["versions"], counters):
+            client.testregistry.tarballs.files.update_one(
+                {"_id": version["oid"]}, {"$set": {"downloads_stats.dates": dates}}
+            )
+        client.testregistry.registry.delete_one({"_id": "download_rollups"})
+
+        # The backfill is interrupted after half of its writes.
+        write_backfilled_rollups = downloads.write_backfilled_rollups
+
+        def interrupted_write_backfilled_rollups(updates):
+            write_backfilled_rollups(updates[:len(updates) // 2])
+            raise RuntimeError("interrupted")
+
+        downloads.write_backfilled_rollups = interrupted_write_backfilled_rollups
+        try:
+            with self.assertRaises(RuntimeError):
+                downloads.backfill_download_rollups()
+        finally:
+            downloads.write_backfilled_rollups = write_backfilled_rollups
+        self.assertIsNone(client.testregistry.registry.find_one({"_id": "download_rollups"}))
+
+        downloads.backfill_download_rollups()
+        self.assertIsNotNone(client.testregistry.registry.find_one({"_id": "download_rollups"}))
+
+        def rollup(version, period, start):
+            return client.testregistry.download_rollups.find_one(
+                {"package": package["name"], "version": version, "period": period, "start": datetime.strptime(start, "%Y-%m-%d")}
+            )["downloads"]
+
+        self.assertEqual(6, rollup(None, "month", "2024-03-01"))
+        self.assertEqual(5, rollup(None, "day", "2024-03-18"))
+        self.assertEqual(3, rollup("0.0.1", "month", "2024-03-01"))
+        self.assertEqual(3, rollup("0.0.2", "week", "2024-03-18"))
+        print("test_download_rollups_backfill_resumed passed")
+
+    def test_download_flush_retries_failed_writes(self):
+        """
+        Test case to verify that a flush of the downloads retries only the writes which failed, so that no download is counted twice.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the download counts are not as expected.
+        """
 
         response = self.upload()
-        self.assertEqual(400, response["code"])
-        print("test_incorrect_version_upload passed")
+        self.assertEqual(200, response["code"])
+        package = client.testregistry.packages.find_one({"name": self.test_package_data["package_name"]})
+        oid = package["versions"][0]["oid"]
+        self.assertEqual(200, self.client.get(f"/tarballs/{oid}").status_code)
+
+        # The tarball stats are written, then the rollups fail.
+        rollups = client.testregistry.download_rollups
+
+        def failed_bulk_write(*args, **kwargs):
+            raise AutoReconnect("connection lost")
+
+        rollups.bulk_write = failed_bulk_write
+        try:
+            with self.assertRaises(AutoReconnect):
+                flush_downloads()
+        finally:
+            del rollups.bulk_write
+        self.assertEqual(1, client.testregistry.tarballs.files.find_one({"_id": oid})["downloads_stats"]["total_downloads"])
+        self.assertIsNone(rollups.find_one())
+
+        flush_downloads()
+        self.assertEqual(1, client.testregistry.tarballs.files.find_one({"_id": oid})["downloads_stats"]["total_downloads"])
+        self.assertEqual(1, rollups.find_one({"version": None, "period": "day"})["downloads"])
+        print("test_download_flush_retries_failed_writes passed")
+
+    def test_get_tarball_offload(self):
+        """
+        Test case to verify that tarball transfers are offloaded to nginx when configured.
 
-    def test_invalid_token_upload(self):
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the response received from the server is not as expected.
         """
-        Test case to verify the behaviour of the system if an invalid token is used to upload a package.
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+        package_url = f"/packages/{self.test_namespace_data['namespace']}/{self.test_package_data['package_name']}"
+        oid = self.client.get(package_url).json["data"]["latest_version_data"]["oid"]
+
+        try:
+            packages.TARBALL_OFFLOAD = "accel"
+            response = self.client.get(f"/tarballs/{oid}")
+            self.assertEqual(200, response.status_code)
+            self.assertEqual(b"", response.data)
+            self.assertTrue(response.headers["X-Accel-Redirect"].startswith("/internal/packages/"))
+            etag = response.headers["ETag"]
+            self.assertTrue(etag.startswith('"sha256-'))
+
+            # Revalidations and HEAD requests are neither offloaded nor counted.
+            response = self.client.get(f"/tarballs/{oid}", headers={"If-None-Match": etag})
+            self.assertEqual(304, response.status_code)
+            self.assertNotIn("X-Accel-Redirect", response.headers)
+            response = self.client.head(f"/tarballs/{oid}")
+            self.assertEqual(200, response.status_code)
+
+            packages.TARBALL_OFFLOAD = "secure_link"
+            response = self.client.get(f"/tarballs/{oid}", headers={"If-None-Match": etag})
+            self.assertEqual(304, response.status_code)
+            self.assertNotIn("Location", response.headers)
+            response = self.client.get(f"/tarballs/{oid}")
+            self.assertEqual(302, response.status_code)
+            self.assertIn("/secure/packages/", response.headers["Location"])
+            self.assertIn("md5=", response.headers["Location"])
+        finally:
+            packages.TARBALL_OFFLOAD = ""
+
+        flush_downloads()
+        response = self.client.get(package_url)
+        self.assertEqual(2, response.json["data"]["downloads"]["total_downloads"])
+        print("test_get_tarball_offload passed")
+
+    def test_get_tarball_range(self):
+        """
+        Test case to verify that interrupted tarball downloads can be resumed with range requests,
+        and are counted once.
 
         Parameters:
         None
@@ -196,15 +1254,37 @@ class TestPackages(BaseTestClass):
         AssertionError: If the response received from the server is not as expected.
         """
 
-        self.test_package_data["upload_token"] = "somerandomtoken123"
-        self.test_package_data["package_version"] = "0.0.1"
         response = self.upload()
-        self.assertEqual(401, response["code"])
-        print("test_invalid_token_upload passed")
+        self.assertEqual(200, response["code"])
+        package_url = f"/packages/{self.test_namespace_data['namespace']}/{self.test_package_data['package_name']}"
+        oid = self.client.get(package_url).json["data"]["latest_version_data"]["oid"]
 
-    def test_search_package(self):
+        response = self.client.get(f"/tarballs/{oid}")
+        self.assertEqual(200, response.status_code)
+        tarball = response.data
+        etag = response.headers["ETag"]
+        self.assertIn("Last-Modified", response.headers)
+        self.assertEqual("bytes", response.headers["Accept-Ranges"])
+
+        response = self.client.get(f"/tarballs/{oid}", headers={"Range": "bytes=0-9", "If-Range": etag})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(tarball[:10], response.data)
+
+        response = self.client.get(f"/tarballs/{oid}", headers={"Range": "bytes=10-", "If-Range": etag})
+        self.assertEqual(206, response.status_code)
+        self.assertEqual(tarball[10:], response.data)
+
+        response = self.client.get(f"/tarballs/{oid}", headers={"If-None-Match": etag})
+        self.assertEqual(304, response.status_code)
+
+        flush_downloads()
+        response = self.client.get(package_url)
+        self.assertEqual(2, response.json["data"]["downloads"]["total_downloads"])
+        print("test_get_tarball_range passed")
+
+    def test_upload_tarball_deduplication(self):
         """
-        Test case to verify the behaviour of the system while searching for a package.
+        Test case to verify that identical tarballs are stored once and served with immutable caching.
 
         Parameters:
         None
@@ -216,25 +1296,65 @@ class TestPackages(BaseTestClass):
         AssertionError: If the response received from the server is not as expected.
         """
 
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+        self.test_package_data["package_version"] = "0.0.2"
         response = self.upload()
         self.assertEqual(200, response["code"])
 
-        response = self.client.get(
-            "/packages", query_string={"query": self.test_package_data["package_name"]}
-        )
+        package_url = f"/packages/{self.test_namespace_data['namespace']}/{self.test_package_data['package_name']}"
+        version_history = self.client.get(package_url).json["data"]["version_history"]
+        digests = {i["sha256"] for i in version_history}
+        self.assertEqual(1, len(digests))
+        digest = digests.pop()
+        self.assertTrue(os.path.exists(f"static/packages/sha256/{digest[:2]}/{digest}.tar.gz"))
+
+        response = self.client.get(f"/tarballs/{version_history[-1]['oid']}")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(digest, hashlib.sha256(response.data).hexdigest())
+        self.assertEqual(f'"sha256-{digest}"', response.headers["ETag"])
+        self.assertIn("immutable", response.headers["Cache-Control"])
+        print("test_upload_tarball_deduplication passed")
+
+    def test_upload_tarball_spooled_once(self):
+        """
+        Test case to verify that the uploaded tarball is written by the request parser into the spool of the blob store, and read back from it.
 
-        self.assertEqual(200, response.json["code"])
+        Parameters:
+        None
 
-        response = self.client.get(
-            "/packages", query_string={"query": "somerandompackage"}
-        )
-        self.assertEqual(200, response.json["code"])
-        self.assertEqual([], response.json["packages"])
-        print("test_search_package passed")
+        Returns:
+        None
 
-    def test_get_exisiting_package(self):
+        Raises:
+        AssertionError: If the tarball is written to another temporary file, or the upload is not as expected.
         """
-        Test case to verify the behaviour of the system while trying to get a package.
+
+        streams = []
+        receive_tarball = packages.receive_tarball
+
+        def spooled_receive_tarball(stream, *args, **kwargs):
+            streams.append(stream)
+            return receive_tarball(stream, *args, **kwargs)
+
+        packages.receive_tarball = spooled_receive_tarball
+        try:
+            response = self.upload()
+        finally:
+            packages.receive_tarball = receive_tarball
+        self.assertEqual(200, response["code"])
+
+        self.assertEqual(1, len(streams))
+        self.assertIsInstance(streams[0], storage.UploadSpool)
+        self.assertEqual(os.path.abspath(storage.blob_store.spool_dir), os.path.dirname(streams[0].name))
+        # The spool is removed once the tarball is committed.
+        self.assertFalse(os.path.exists(streams[0].name))
+        self.assertEqual(packages.MAX_TARBALL_SIZE + packages.UPLOAD_FORM_SIZE, app.config["MAX_CONTENT_LENGTH"])
+        print("test_upload_tarball_spooled_once passed")
+
+    def test_gridfs_blob_store(self):
+        """
+        Test case to verify the upload and the download of tarballs stored in GridFS chunks.
 
         Parameters:
         None
@@ -246,13 +1366,116 @@ class TestPackages(BaseTestClass):
         AssertionError: If the response received from the server is not as expected.
         """
 
-        self.upload()
-        # Get the package.
-        response = self.client.get(
-            f"/packages/{self.test_namespace_data['namespace']}/{self.test_package_data['package_name']}"
+        local_store = storage.blob_store
+        try:
+            storage.blob_store = storage.GridFSBlobStore()
+            response = self.upload()
+            self.assertEqual(200, response["code"])
+
+            package_url = f"/packages/{self.test_namespace_data['namespace']}/{self.test_package_data['package_name']}"
+            version_data = self.client.get(package_url).json["data"]["latest_version_data"]
+            self.assertTrue(storage.blob_store.exists(storage.tarball_key(version_data["sha256"])))
+
+            response = self.client.get(f"/tarballs/{version_data['oid']}")
+            self.assertEqual(200, response.status_code)
+            tarball = response.data
+            self.assertEqual(version_data["sha256"], hashlib.sha256(tarball).hexdigest())
+
+            response = self.client.get(f"/tarballs/{version_data['oid']}", headers={"Range": "bytes=10-"})
+            self.assertEqual(206, response.status_code)
+            self.assertEqual(tarball[10:], response.data)
+        finally:
+            storage.blob_store = local_store
+        print("test_gridfs_blob_store passed")
+
+    def test_incomplete_blob_store(self):
+        """
+        Test case to verify that a blob store which does not implement the whole interface cannot be created.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the incomplete store is created.
+        """
+
+        class IncompleteBlobStore(storage.BlobStore):
+            def put(self, key, stream):
+                pass
+
+            def open(self, key):
+                pass
+
+            def size(self, key):
+                pass
+
+        with self.assertRaises(TypeError):
+            IncompleteBlobStore()
+        print("test_incomplete_blob_store passed")
+
+    def test_s3_blob_store(self):
+        """
+        Test case to verify the requests of the S3 blob store, against a stubbed S3 client.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the requests or the results of the store are not as expected.
+        """
+
+        s3 = boto3.client(
+            "s3", region_name="us-east-1", aws_access_key_id="test", aws_secret_access_key="test"
         )
-        self.assertEqual(200, response.json["code"])
-        print("test_get_exisiting_package passed")
+        key = "sha256/ab/abcdef.tar.gz"
+        blob = b"tarball bytes"
+
+        with Stubber(s3) as stubber, mock.patch("boto3.client", return_value=s3):
+            # The bucket is created when it does not exist.
+            stubber.add_client_error("head_bucket", "404", expected_params={"Bucket": "tarballs"})
+            stubber.add_response("create_bucket", {}, {"Bucket": "tarballs"})
+            store = storage.S3BlobStore(bucket="tarballs")
+
+            stubber.add_response(
+                "put_object", {}, {"Bucket": "tarballs", "Key": key, "Body": ANY, "ContentType": "application/gzip", "ChecksumAlgorithm": ANY}
+            )
+            store.put(key, io.BytesIO(blob))
+
+            stubber.add_response("head_object", {"ContentLength": len(blob)}, {"Bucket": "tarballs", "Key": key})
+            self.assertEqual(len(blob), store.size(key))
+
+            stubber.add_response(
+                "get_object", {"Body": io.BytesIO(blob)}, {"Bucket": "tarballs", "Key": key}
+            )
+            self.assertEqual(blob, store.open(key).read())
+
+            stubber.add_response("delete_object", {}, {"Bucket": "tarballs", "Key": key})
+            store.delete(key)
+
+            # A missing blob has no size.
+            stubber.add_client_error("head_object", "404", http_status_code=404)
+            self.assertIsNone(store.size(key))
+
+            # A denied request is an error of the store, not a missing blob, which would be
+            # reported as an incomplete tarball.
+            stubber.add_client_error("head_object", "403", http_status_code=403)
+            with self.assertRaises(ClientError):
+                store.size(key)
+
+            stubber.assert_no_pending_responses()
+
+        url = store.url(key, "package-0.1.0.tar.gz")
+        self.assertIn("tarballs", url)
+        self.assertIn("/sha256/ab/abcdef.tar.gz?", url)
+        self.assertIn("response-content-disposition=attachment", url)
+        self.assertIn("Signature=", url)
+        print("test_s3_blob_store passed")
 
     def test_get_nonexisting_package(self):
         """
@@ -566,3 +1789,53 @@ class TestPackages(BaseTestClass):
         response = self.client.get("/report/view",headers={"Authorization": f"Bearer {access_token}"})
         self.assertEqual(401, response.json["code"])
         print("test_unsuccessful_fetch_malicious_reports passed")
+
+    def test_search_index_backfill_runs_once(self):
+        """
+        Test case to verify that the search fields of the packages uploaded before they existed are backfilled once per database, and that an interrupted backfill is resumed.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the packages are not backfilled, or backfilled again.
+        """
+
+        package = {"name": "legacy_package", "description": "A legacy package", "versions": [{"version": "0.9.0"}, {"version": "0.10.0"}]}
+        package_id = client.testregistry.packages.insert_one(dict(package)).inserted_id
+        # The backfill completed when the module was imported is forgotten, as in a new database.
+        client.testregistry.registry.delete_one({"_id": "search_index"})
+
+        # The backfill is interrupted before the trigrams are indexed.
+        index_package_trigrams = search.index_package_trigrams
+
+        def interrupted_index_package_trigrams(package):
+            raise RuntimeError("interrupted")
+
+        search.index_package_trigrams = interrupted_index_package_trigrams
+        try:
+            with self.assertRaises(RuntimeError):
+                build_search_index()
+        finally:
+            search.index_package_trigrams = index_package_trigrams
+        self.assertIsNone(client.testregistry.registry.find_one({"_id": "search_index"}))
+
+        # The next start resumes it, without counting the package in the statistics again.
+        build_search_index()
+        package = client.testregistry.packages.find_one({"_id": package_id})
+        self.assertIn("legacy_package", package["term_frequencies"])
+        self.assertEqual("0.10.0", package["latest_version"])
+        self.assertIsNotNone(client.testregistry.package_trigrams.find_one({"_id": package_id}))
+        self.assertEqual(1, client.testregistry.registry.find_one({"_id": "search_corpus"})["documents"])
+        self.assertEqual(1, client.testregistry.search_statistics.find_one({"_id": "legacy_package"})["documents"])
+
+        # The backfill is done, later processes do not scan the packages again.
+        package_id = client.testregistry.packages.insert_one({"name": "other_package", "versions": [{"version": "0.1.0"}]}).inserted_id
+        build_search_index()
+        package = client.testregistry.packages.find_one({"_id": package_id})
+        self.assertNotIn("term_frequencies", package)
+        self.assertNotIn("latest_version", package)
+        print("test_search_index_backfill_runs_once passed")
@@ -0,0 +1,271 @@
+from base_case import BaseTestClass
+from mongo import client
+from concurrent.futures import ThreadPoolExecutor, Future
+import tempfile
+import tarfile
+import io
+import os
+import hashlib
+from package_checks import extract_package
+import test_packages
+import validate
+
+
+class TestValidate(BaseTestClass):
+    # The users, namespaces and packages are created as in the package tests.
+    setUp = test_packages.TestPackages.setUp
+    login = test_packages.TestPackages.login
+    upload = test_packages.TestPackages.upload
+
+    def test_concurrent_package_updates(self):
+        """
+        Test case to verify that the validations of two versions of a package do not overwrite each other's updates.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the package or the search statistics are not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+        self.test_package_data["package_version"] = "0.0.2"
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        package = client.testregistry.packages.find_one({"name": self.test_package_data["package_name"]})
+        versions = package["versions"]
+        package_update = validate.package_update
+        calls = []
+
+        def concurrent_package_update(*args):
+            # The second version is validated while the update of the first one is computed.
+            calls.append(args)
+            if len(calls) == 1:
+                validate.update_package(package, versions[1], "0.0.2", (True, {"keywords": ["second"]}, ""), None)
+            return package_update(*args)
+
+        validate.package_update = concurrent_package_update
+        try:
+            validate.update_package(package, versions[0], "0.0.1", (True, {"keywords": ["first"]}, ""), None)
+        finally:
+            validate.package_update = package_update
+
+        # The update of the first version is computed again from the package updated by the second.
+        self.assertEqual(3, len(calls))
+        package = client.testregistry.packages.find_one({"_id": package["_id"]})
+        self.assertTrue({"first", "second"} <= set(package["keywords"]))
+        self.assertEqual(2, package["revision"])
+
+        corpus = client.testregistry.registry.find_one({"_id": "search_corpus"})
+        self.assertEqual(1, corpus["documents"])
+        self.assertEqual(package["document_length"], corpus["total_length"])
+        for term in package["term_frequencies"]:
+            self.assertEqual(1, client.testregistry.search_statistics.find_one({"_id": term})["documents"])
+        print("test_concurrent_package_updates passed")
+
+    def test_validation_worker_pool(self):
+        """
+        Test case to verify that validation jobs run concurrently in the process pool, each in a workspace which is removed.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the jobs or the workspaces are not as expected.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+        self.test_package_data["package_version"] = "0.0.2"
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        jobs = [validate.claim_validation_job("worker"), validate.claim_validation_job("worker")]
+        self.assertIsNone(validate.claim_validation_job("worker"))
+
+        workspace_dir = validate.VALIDATION_WORKSPACE_DIR
+        pool = validate.create_process_pool(2)
+        with tempfile.TemporaryDirectory() as validate.VALIDATION_WORKSPACE_DIR:
+            try:
+                with ThreadPoolExecutor(2) as threads:
+                    list(threads.map(lambda job: validate.run_job(job, "worker", pool), jobs))
+                self.assertEqual([], os.listdir(validate.VALIDATION_WORKSPACE_DIR))
+            finally:
+                validate.VALIDATION_WORKSPACE_DIR = workspace_dir
+                pool.shutdown()
+
+        # The test tarball has no fpm.toml, the versions are validated as unable to verify.
+        for job in client.testregistry.validation_jobs.find():
+            self.assertEqual("done", job["status"])
+            self.assertEqual("Error parsing toml file", job["message"])
+        package = client.testregistry.packages.find_one({"name": self.test_package_data["package_name"]})
+        self.assertEqual([False, False], [i["is_verified"] for i in package["versions"]])
+        self.assertTrue(package["unable_to_verify"])
+        print("test_validation_worker_pool passed")
+
+    def test_validation_worker_once(self):
+        """
+        Test case to verify that the worker started with --once validates the queued versions and returns.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the queued jobs are not validated.
+        """
+
+        response = self.upload()
+        self.assertEqual(200, response["code"])
+
+        validate.run_worker(exit_when_idle=True)
+
+        job = client.testregistry.validation_jobs.find_one()
+        self.assertEqual("done", job["status"])
+        self.assertIsNone(validate.claim_validation_job("worker"))
+        print("test_validation_worker_once passed")
+
+    def test_extract_package_filters_members(self):
+        """
+        Test case to verify that only the regular files needed by the validation are extracted, inside the workspace.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If a file is written outside the workspace, or a skipped member is extracted.
+        """
+
+        with tempfile.TemporaryDirectory() as directory:
+            workspace = os.path.join(directory, "workspace")
+            os.makedirs(workspace)
+            outside = os.path.join(directory, "outside")
+            os.makedirs(outside)
+            tarball = os.path.join(directory, "package.tar.gz")
+
+            with tarfile.open(tarball, "w:gz") as tar:
+                def add(name, data=b"", type=tarfile.REGTYPE, linkname=""):
+                    member = tarfile.TarInfo(name)
+                    member.type = type
+                    member.linkname = linkname
+                    member.size = len(data) if type == tarfile.REGTYPE else 0
+                    tar.addfile(member, io.BytesIO(data) if type == tarfile.REGTYPE else None)
+
+                add("fpm.toml", b'name = "package"')
+                add("README.md", b"readme")
+                add("src/module.f90", b"module m\nend module")
+                add("docs/manual.pdf", b"pdf")
+                add("README_assets/blob.bin", b"asset")
+                add("fpm_model.json", b"{}")
+                add("../x.f90", b"escape")
+                add("src/../../y.f90", b"escape")
+                add(os.path.join(outside, "absolute.f90"), b"absolute")
+                # A link to a directory outside the workspace, then a file written through it.
+                add("app", type=tarfile.SYMTYPE, linkname=outside)
+                add("app/main.f90", b"program main\nend program")
+                add("src/passwd.f90", type=tarfile.SYMTYPE, linkname="/etc/passwd")
+                add("src/hard.f90", type=tarfile.LNKTYPE, linkname="/etc/passwd")
+
+            self.assertEqual(5, extract_package(tarball, workspace))
+
+            extracted = sorted(
+                os.path.relpath(os.path.join(root, name), workspace)
+                for root, _, names in os.walk(workspace)
+                for name in names
+            )
+            self.assertEqual(["README.md", "app/main.f90", "fpm.toml", "fpm_model.json", "src/module.f90"], extracted)
+            self.assertFalse(os.path.islink(os.path.join(workspace, "app")))
+            self.assertEqual([], os.listdir(outside))
+            self.assertEqual(["outside", "package.tar.gz", "workspace"], sorted(os.listdir(directory)))
+        print("test_extract_package_filters_members passed")
+
+    def test_validation_result_cache(self):
+        """
+        Test case to verify that identical tarballs are checked once per validator version, and that results depending on the environment are not cached.
+
+        Parameters:
+        None
+
+        Returns:
+        None
+
+        Raises:
+        AssertionError: If the contents are checked again, or the cache is not as expected.
+        """
+
+        data = io.BytesIO()
+        with tarfile.open(fileobj=data, mode="w:gz") as tar:
+            member = tarfile.TarInfo("fpm.toml")
+            member.size = len(b'name = "test_package"')
+            tar.addfile(member, io.BytesIO(b'name = "test_package"'))
+        data = data.getvalue()
+        sha256 = hashlib.sha256(data).hexdigest()
+
+        response = self.upload((io.BytesIO(data), "package.tar.gz"))
+        self.assertEqual(200, response["code"])
+        self.test_package_data["package_version"] = "0.0.2"
+        response = self.upload((io.BytesIO(data), "package.tar.gz"))
+        self.assertEqual(200, response["code"])
+        package = client.testregistry.packages.find_one({"name": self.test_package_data["package_name"]})
+
+        class InlinePool:
+            # Runs the checks in the test process, as if fpm generated the model (or failed to).
+            def __init__(self, generates_model):
+                self.generates_model = generates_model
+                self.calls = 0
+
+            def submit(self, function, workspace):
+                self.calls += 1
+                os.makedirs(os.path.join(workspace, "package"))
+                if self.generates_model:
+                    with open(os.path.join(workspace, "package", "fpm_model.json"), "w") as f:
+                        f.write('{"package-name": "test_package"}')
+                future = Future()
+                future.set_result((True, {"name": "test_package"}, "Package verified successfully."))
+                return future
+
+        # fpm could not run: the result depends on the environment and is not cached.
+        pool = InlinePool(generates_model=False)
+        validate.validate_version(package, package["versions"][0], pool)
+        self.assertEqual(1, pool.calls)
+        self.assertIsNone(validate.get_validation_result(sha256))
+
+        # Miss, then hit for the identical tarball of the second version.
+        pool = InlinePool(generates_model=True)
+        validate.validate_version(package, package["versions"][0], pool)
+        validate.validate_version(package, package["versions"][1], pool)
+        self.assertEqual(1, pool.calls)
+        result = client.testregistry.validation_results.find_one({"_id": f"{validate.VALIDATOR_VERSION}:{sha256}"})
+        self.assertTrue(result["success"])
+        self.assertEqual({"name": "test_package"}, result["fpm_toml"])
+        self.assertEqual('{"package-name": "test_package"}', result["fpm_model"])
+        package = client.testregistry.packages.find_one({"_id": package["_id"]})
+        self.assertEqual([True, True], [i["is_verified"] for i in package["versions"]])
+
+        # Results of the previous validator version are not used.
+        validator_version = validate.VALIDATOR_VERSION
+        validate.VALIDATOR_VERSION = "next"
+        try:
+            self.assertIsNone(validate.get_validation_result(sha256))
+            validate.validate_version(package, package["versions"][1], pool)
+        finally:
+            validate.VALIDATOR_VERSION = validator_version
+        self.assertEqual(2, pool.calls)
+        self.assertIsNotNone(client.testregistry.validation_results.find_one({"_id": f"next:{sha256}"}))
+
+        # Tarballs without a known digest are not cached.
+        self.assertIsNone(validate.get_validation_result(None))
+        print("test_validation_result_cache passed")
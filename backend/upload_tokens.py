@@ -0,0 +1,119 @@
+import hashlib
+from datetime import datetime, timedelta
+from mongo import db
+from pymongo import ASCENDING, UpdateOne
+from pymongo.errors import DuplicateKeyError
+from auth import generate_uuid
+
+# Upload tokens expire one week after their creation.
+UPLOAD_TOKEN_TTL = timedelta(weeks=1)
+
+
+def hash_upload_token(upload_token):
+    """
+    Function to hash an upload token. Only the hashes of the tokens are stored.
+
+    Parameters:
+    upload_token (str): The upload token.
+
+    Returns:
+    str: The hex SHA-256 digest of the token.
+    """
+    return hashlib.sha256(upload_token.encode("utf-8")).hexdigest()
+
+
+def issue_upload_token(user_id, namespace_id, package_id=None):
+    """
+    Function to create an upload token for a namespace, or for a single package of a namespace.
+
+    Parameters:
+    user_id (ObjectId): The id of the user creating the token.
+    namespace_id (ObjectId): The id of the namespace.
+    package_id (ObjectId): The id of the package, None for a namespace token.
+
+    Returns:
+    str: The upload token.
+    """
+    upload_token = generate_uuid()
+    db.upload_tokens.insert_one(
+        {
+            "_id": hash_upload_token(upload_token),
+            "namespace": namespace_id,
+            "package": package_id,
+            "created_at": datetime.utcnow(),
+            "created_by": user_id,
+        }
+    )
+    return upload_token
+
+
+def find_upload_token(upload_token):
+    """
+    Function to find an upload token, with a lookup on the unique index of the token hashes.
+    Expired tokens are removed by the TTL index, but may still be found until its next pass.
+
+    Parameters:
+    upload_token (str): The upload token.
+
+    Returns:
+    dict: The upload token document, or None if the token does not exist.
+    """
+    return db.upload_tokens.find_one({"_id": hash_upload_token(upload_token)})
+
+
+def migrate_upload_tokens():
+    """
+    Function to move the upload tokens embedded in the namespace and package documents to the
+    upload_tokens collection. Tokens which have already expired are dropped. A token is moved
+    before it is removed from its document, so a migration interrupted (e.g. by a crash) is
+    resumed by the next start. Once it has completed, it is marked as done in the registry and
+    later starts skip it.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    if db.registry.find_one({"_id": "upload_tokens"}):
+        return
+
+    expired_before = datetime.utcnow() - UPLOAD_TOKEN_TTL
+    for collection, owner in [(db.namespaces, "namespace"), (db.packages, "package")]:
+        documents = collection.find(
+            {"upload_tokens": {"$exists": True}}, {"upload_tokens": 1, "namespace": 1}
+        )
+        for document in documents:
+            updates = []
+            for token in document["upload_tokens"]:
+                # Namespace tokens used camel case field names.
+                created_at = token.get("created_at", token.get("createdAt"))
+                if not token.get("token") or not created_at or created_at < expired_before:
+                    continue
+                updates.append(UpdateOne(
+                    {"_id": hash_upload_token(token["token"])},
+                    {
+                        "$setOnInsert": {
+                            "namespace": document["_id"] if owner == "namespace" else document["namespace"],
+                            "package": document["_id"] if owner == "package" else None,
+                            "created_at": created_at,
+                            "created_by": token.get("created_by", token.get("createdBy")),
+                        }
+                    },
+                    upsert=True,
+                ))
+            if updates:
+                db.upload_tokens.bulk_write(updates, ordered=False)
+            collection.update_one({"_id": document["_id"]}, {"$unset": {"upload_tokens": ""}})
+
+    try:
+        db.registry.insert_one({"_id": "upload_tokens", "migrated_at": datetime.utcnow()})
+    except DuplicateKeyError:
+        # Another process completed the migration concurrently.
+        pass
+
+
+# The tokens are identified by their hash, which is the (unique) _id of their documents.
+db.upload_tokens.create_index("created_at", expireAfterSeconds=int(UPLOAD_TOKEN_TTL.total_seconds()))
+db.upload_tokens.create_index([("namespace", ASCENDING), ("package", ASCENDING)])
+migrate_upload_tokens()
@@ -0,0 +1,278 @@
+import io
+import hmac
+import hashlib
+from datetime import datetime, timedelta
+from app import app
+from mongo import db
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from flask import request, jsonify
+from flasgger.utils import swag_from
+from pymongo import ReturnDocument
+import storage
+from storage import MAX_TARBALL_SIZE, BlobsReader
+from packages import authorize_upload, publish_package
+from upload_tokens import hash_upload_token
+
+# Maximum size and number of the chunks of a resumable upload, and the chunk size suggested to the clients.
+MAX_UPLOAD_CHUNK_SIZE = 16 * 1024 * 1024
+MAX_UPLOAD_CHUNKS = 10000
+UPLOAD_CHUNK_SIZE = 8 * 1024 * 1024
+
+# How long an upload session can be resumed after it has been initiated.
+UPLOAD_SESSION_TTL = timedelta(days=1)
+
+
+def chunk_key(upload_id, number, digest):
+    # A chunk sent again is stored under a new key, the one being finalized is never overwritten.
+    return f"uploads/{upload_id}/{number:06d}-{digest}"
+
+
+def get_upload_session(upload_id):
+    """
+    Function to get an upload session that has not expired, if the request has its upload token.
+
+    Parameters:
+    upload_id (str): The id of the upload session.
+
+    Returns:
+    tuple: The error response (None if the session is found) and the upload session document.
+    """
+    upload_token = request.headers.get("X-Upload-Token")
+    if not upload_token:
+        return (jsonify({"code": 400, "message": "Upload token missing"}), 400), None
+
+    try:
+        upload_session = db.upload_sessions.find_one(
+            {"_id": ObjectId(upload_id), "expires_at": {"$gt": datetime.utcnow()}}
+        )
+    except InvalidId:
+        upload_session = None
+
+    if not upload_session:
+        return (jsonify({"code": 404, "message": "Upload session not found"}), 404), None
+
+    if not hmac.compare_digest(upload_session["token_digest"], hash_upload_token(upload_token)):
+        return (jsonify({"code": 401, "message": "Invalid upload token"}), 401), None
+
+    return None, upload_session
+
+
+def delete_upload_session(upload_session):
+    for number, chunk in upload_session.get("chunks", {}).items():
+        storage.blob_store.delete(chunk_key(upload_session["_id"], int(number), chunk["sha256"]))
+    db.upload_sessions.delete_one({"_id": upload_session["_id"]})
+
+
+def expire_upload_sessions(limit=10):
+    """
+    Function to delete a few expired upload sessions and their chunks.
+
+    Parameters:
+    limit (int): The maximum number of sessions deleted.
+
+    Returns:
+    None
+    """
+    expired_sessions = db.upload_sessions.find(
+        {"expires_at": {"$lte": datetime.utcnow()}}, {"chunks": 1}
+    ).limit(limit)
+    for upload_session in expired_sessions:
+        delete_upload_session(upload_session)
+
+
+def format_chunks(upload_session):
+    return [
+        {"number": int(number), **chunk}
+        for number, chunk in sorted(upload_session.get("chunks", {}).items(), key=lambda x: int(x[0]))
+    ]
+
+
+db.upload_sessions.create_index("expires_at")
+
+
+@app.route("/uploads", methods=["POST"])
+@swag_from("documentation/create_upload_session.yaml", methods=["POST"])
+def create_upload_session():
+    upload_token = request.form.get("upload_token")
+    package_name = request.form.get("package_name")
+    package_version = request.form.get("package_version")
+    package_license = request.form.get("package_license")
+    dry_run = request.form.get("dry_run")
+    size = request.form.get("size")
+    sha256 = request.form.get("sha256")
+
+    dry_run = True if dry_run == "true" else False
+
+    error, upload_context = authorize_upload(upload_token, package_name, package_version, package_license)
+    if error:
+        return error
+
+    try:
+        size = int(size) if size else None
+    except ValueError:
+        return jsonify({"code": 400, "message": "Size should be an integer"}), 400
+
+    if size is not None and (size <= 0 or size > MAX_TARBALL_SIZE):
+        return jsonify({"code": 413, "message": f"Tarball is larger than {MAX_TARBALL_SIZE} bytes"}), 413
+
+    expire_upload_sessions()
+
+    created_at = datetime.utcnow()
+    upload_id = db.upload_sessions.insert_one(
+        {
+            "token_digest": hash_upload_token(upload_token),
+            "package_name": package_name,
+            "package_version": package_version,
+            "package_license": package_license,
+            "dry_run": dry_run,
+            "size": size,
+            "sha256": sha256.lower() if sha256 else None,
+            "chunks": {},
+            "created_at": created_at,
+            "expires_at": created_at + UPLOAD_SESSION_TTL,
+        }
+    ).inserted_id
+
+    return jsonify(
+        {
+            "code": 200,
+            "message": "Upload session created",
+            "upload_id": str(upload_id),
+            "chunk_size": UPLOAD_CHUNK_SIZE,
+            "max_chunk_size": MAX_UPLOAD_CHUNK_SIZE,
+            "expires_at": created_at + UPLOAD_SESSION_TTL,
+        }
+    ), 200
+
+
+@app.route("/uploads/<upload_id>", methods=["GET"])
+@swag_from("documentation/get_upload_session.yaml", methods=["GET"])
+def get_upload_session_status(upload_id):
+    error, upload_session = get_upload_session(upload_id)
+    if error:
+        return error
+
+    return jsonify(
+        {
+            "code": 200,
+            "upload_id": upload_id,
+            "size": upload_session["size"],
+            "chunks": format_chunks(upload_session),
+            "expires_at": upload_session["expires_at"],
+        }
+    ), 200
+
+
+@app.route("/uploads/<upload_id>/chunks/<int:number>", methods=["PUT"])
+@swag_from("documentation/put_upload_chunk.yaml", methods=["PUT"])
+def put_upload_chunk(upload_id, number):
+    error, upload_session = get_upload_session(upload_id)
+    if error:
+        return error
+
+    if upload_session.get("finalizing"):
+        return jsonify({"code": 409, "message": "Upload session is being finalized"}), 409
+
+    if number >= MAX_UPLOAD_CHUNKS:
+        return jsonify({"code": 400, "message": "Invalid chunk number"}), 400
+
+    # Chunks are bounded, so they are read in memory before being stored.
+    if request.content_length is None or request.content_length > MAX_UPLOAD_CHUNK_SIZE:
+        return jsonify({"code": 413, "message": f"Chunks should be at most {MAX_UPLOAD_CHUNK_SIZE} bytes"}), 413
+
+    chunk_sha256 = request.headers.get("X-Chunk-SHA256")
+    if not chunk_sha256:
+        return jsonify({"code": 400, "message": "Chunk SHA-256 digest is missing"}), 400
+
+    data = request.get_data(cache=False)
+    digest = hashlib.sha256(data).hexdigest()
+    if not data or digest != chunk_sha256.lower():
+        return jsonify({"code": 400, "message": "Chunk SHA-256 digest does not match"}), 400
+
+    other_chunks_size = sum(
+        chunk["size"] for n, chunk in upload_session["chunks"].items() if int(n) != number
+    )
+    if other_chunks_size + len(data) > (upload_session["size"] or MAX_TARBALL_SIZE):
+        return jsonify({"code": 413, "message": "Chunks are larger than the tarball"}), 413
+
+    # A chunk sent again with the same bytes (e.g. after a timeout) is already stored.
+    previous_chunk = upload_session["chunks"].get(str(number))
+    if previous_chunk and previous_chunk["sha256"] == digest:
+        return jsonify({"code": 200, "message": "Chunk uploaded", "number": number, "size": len(data)}), 200
+
+    # Otherwise it replaces the previous one, unless the session started being finalized meanwhile.
+    key = chunk_key(upload_session["_id"], number, digest)
+    storage.blob_store.put(key, io.BytesIO(data))
+    previous_session = db.upload_sessions.find_one_and_update(
+        {"_id": upload_session["_id"], "finalizing": {"$ne": True}},
+        {"$set": {f"chunks.{number}": {"size": len(data), "sha256": digest}}},
+        projection={f"chunks.{number}": 1},
+        return_document=ReturnDocument.BEFORE,
+    )
+    if not previous_session:
+        # The chunks of the session no longer change, the chunk is kept only if it was sent concurrently.
+        upload_session = db.upload_sessions.find_one({"_id": upload_session["_id"]}, {f"chunks.{number}": 1})
+        if not upload_session or upload_session.get("chunks", {}).get(str(number), {}).get("sha256") != digest:
+            storage.blob_store.delete(key)
+        return jsonify({"code": 409, "message": "Upload session is being finalized"}), 409
+
+    previous_chunk = previous_session.get("chunks", {}).get(str(number))
+    if previous_chunk and previous_chunk["sha256"] != digest:
+        storage.blob_store.delete(chunk_key(upload_session["_id"], number, previous_chunk["sha256"]))
+
+    return jsonify({"code": 200, "message": "Chunk uploaded", "number": number, "size": len(data)}), 200
+
+
+@app.route("/uploads/<upload_id>/finalize", methods=["POST"])
+@swag_from("documentation/finalize_upload_session.yaml", methods=["POST"])
+def finalize_upload_session(upload_id):
+    error, upload_session = get_upload_session(upload_id)
+    if error:
+        return error
+
+    # The upload token is checked again, it may have expired or been revoked since the upload started.
+    error, upload_context = authorize_upload(
+        request.headers.get("X-Upload-Token"),
+        upload_session["package_name"],
+        upload_session["package_version"],
+        upload_session["package_license"],
+    )
+    if error:
+        return error
+
+    # Only one request can finalize the session at a time, and no chunk is accepted meanwhile.
+    upload_session = db.upload_sessions.find_one_and_update(
+        {"_id": upload_session["_id"], "finalizing": {"$ne": True}},
+        {"$set": {"finalizing": True}},
+        return_document=ReturnDocument.AFTER,
+    )
+    if not upload_session:
+        return jsonify({"code": 409, "message": "Upload session is already being finalized"}), 409
+
+    chunks = format_chunks(upload_session)
+    if [i["number"] for i in chunks] != list(range(len(chunks))) or not chunks:
+        db.upload_sessions.update_one({"_id": upload_session["_id"]}, {"$unset": {"finalizing": ""}})
+        return jsonify({"code": 400, "message": "Chunks are missing", "chunks": chunks}), 400
+
+    if upload_session["size"] is not None and sum(i["size"] for i in chunks) != upload_session["size"]:
+        db.upload_sessions.update_one({"_id": upload_session["_id"]}, {"$unset": {"finalizing": ""}})
+        return jsonify({"code": 400, "message": "Chunks do not add up to the tarball size", "chunks": chunks}), 400
+
+    # The chunks go through the same single pass validation as a tarball uploaded at once.
+    stream = BlobsReader(
+        storage.blob_store, [chunk_key(upload_session["_id"], i["number"], i["sha256"]) for i in chunks]
+    )
+    try:
+        response = publish_package(
+            stream, upload_context, upload_session["dry_run"], sha256=upload_session["sha256"]
+        )
+    finally:
+        stream.close()
+
+    body, status = response if isinstance(response, tuple) else (response, response.status_code)
+    if status == 200 and body.json.get("code", 200) == 200:
+        delete_upload_session(upload_session)
+    else:
+        db.upload_sessions.update_one({"_id": upload_session["_id"]}, {"$unset": {"finalizing": ""}})
+    return response
@@ -1,34 +1,31 @@
 from app import app
-import subprocess
-import toml
 import os
+import sys
+import shutil
+import contextlib
+from datetime import datetime
+import multiprocessing
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 from mongo import db
 from mongo import file_storage
 from bson.objectid import ObjectId
 from gridfs.errors import NoFile
-import toml
-from check_digests import check_digests
+from package_checks import process_package
+from search import search_index_fields, update_search_statistics, index_package_trigrams
+from cache import bump_registry_generation
+from storage import blob_store, BLOB_CHUNK_SIZE
+from validation_jobs import claim_validation_job, renew_validation_lease, complete_validation_job
+from validation_jobs import fail_validation_job, VALIDATION_HEARTBEAT_INTERVAL
 from bson.objectid import ObjectId
 from typing import Union,List, Tuple, Dict, Any
 
 
-def run_command(command: str) -> Union[str, None]:
-    """
-    Execute a shell command and return its output.
-
-    Args:
-        command (str): The command to execute.
-
-    Returns:
-        Union[str, None]: The standard output of the command if successful,
-                          otherwise standard error.
-    """
-    result = subprocess.run(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
-    if result.returncode != 0:
-        print(f"Error executing command: {command}")
-        print(result.stderr)
-    return result.stdout if result.stdout else result.stderr
-
 def extract_dependencies(parsed_toml: Dict[str, List[Dict[str, Any]]]) -> List[Tuple[str, str, str]]:
     """
     Extracts dependencies from a parsed TOML file.
@@ -50,120 +47,353 @@ def extract_dependencies(parsed_toml: Dict[str, List[Dict[str, Any]]]) -> List[T
     return dependencies
 
 
-def process_package(packagename: str) -> Tuple[bool, Union[dict, None], str]:
+# How long (in seconds) an idle worker waits before looking for a new job.
+VALIDATION_POLL_INTERVAL = float(os.getenv("VALIDATION_POLL_INTERVAL", 1))
+
+# Number of versions validated concurrently by a worker, in as many processes.
+VALIDATION_CONCURRENCY = int(os.getenv("VALIDATION_CONCURRENCY", os.cpu_count() or 1))
+
+# Number of times the update of a package is computed again when another validation of the
+# package updated it concurrently.
+PACKAGE_UPDATE_ATTEMPTS = 10
+
+# Directory of the temporary workspaces of the jobs, the system one by default. It can be
+# a tmpfs mount, so that the packages are extracted and built in memory.
+VALIDATION_WORKSPACE_DIR = os.getenv("VALIDATION_WORKSPACE_DIR")
+
+# Version of the checks of process_package. The validation results are cached per tarball
+# content and validator version: bump it whenever the checks change, so that the tarballs
+# validated by the previous checks are validated again.
+VALIDATOR_VERSION = "1"
+
+# fpm models larger than this (in bytes) are not cached, to keep the cache documents small.
+MAX_CACHED_MODEL_SIZE = 4 * 1024 * 1024
+
+
+def validation_result_key(sha256: str) -> str:
+    return f"{VALIDATOR_VERSION}:{sha256}"
+
+
+def get_validation_result(sha256: Union[str, None]) -> Union[Dict[str, Any], None]:
     """
-    This function creates a directory, extracts package contents, reads and parses 'fpm.toml',
-    checks digests, and cleans up temporary files.
+    This function finds the cached validation result of a tarball content.
 
     Args:
-        packagename (str): The name of the package.
+        sha256 (Union[str, None]): The SHA-256 digest of the tarball, None if unknown.
 
     Returns:
-        Tuple[bool, Union[dict, None], str]: A tuple containing:
-            - bool: Whether the package processing was successful.
-            - Union[dict, None]: Parsed 'fpm.toml' content if successful, None otherwise.
-            - str: Message describing the result of the package processing.
-    """
-    create_dir_command = f'mkdir -p static/temp/{packagename}'
-    run_command(create_dir_command)
-    extract_command = f'tar -xzf static/temp/{packagename}.tar.gz -C static/temp/{packagename}/'
-    run_command(extract_command)
-
-    generate_model = f"cd static/temp/{packagename} && fpm build --dump=fpm_model.json" # TODO: interim bug fix, disable after fpm v0.10.2
-    run_command(generate_model)
-    
-    # Read fpm.toml
-    toml_path = f'static/temp/{packagename}/fpm.toml'
+        Union[Dict[str, Any], None]: The cached result, None if the content has not been validated yet.
+    """
+    if not sha256:
+        return None
+    return db.validation_results.find_one({"_id": validation_result_key(sha256)})
+
+
+def store_validation_result(sha256: Union[str, None], workspace: str,
+                            result: Tuple[bool, Union[dict, None], str], readme: Union[str, None]) -> None:
+    """
+    This function caches the validation result of a tarball content, with its parsed fpm.toml,
+    README and fpm model. Results which depend on the environment rather than on the content
+    (e.g. fpm failed to run and no model was generated) are not cached.
+
+    Args:
+        sha256 (Union[str, None]): The SHA-256 digest of the tarball, None if unknown.
+        workspace (str): The workspace directory the tarball has been validated in.
+        result (Tuple[bool, Union[dict, None], str]): The result of process_package.
+        readme (Union[str, None]): The README of the package, None if it has none.
+
+    Returns:
+        None
+    """
+    if not sha256:
+        return
+    model_path = os.path.join(workspace, 'package', 'fpm_model.json')
+    if result[1] is not None and not os.path.isfile(model_path):
+        return
+
+    model = None
+    if os.path.isfile(model_path) and os.path.getsize(model_path) <= MAX_CACHED_MODEL_SIZE:
+        # The model is kept as JSON text, its keys are file names which may contain dots.
+        with open(model_path, 'r') as f:
+            model = f.read()
+
+    db.validation_results.update_one(
+        {"_id": validation_result_key(sha256)},
+        {
+            "$setOnInsert": {
+                "sha256": sha256,
+                "validator_version": VALIDATOR_VERSION,
+                "success": result[0],
+                "fpm_toml": result[1],
+                "message": result[2],
+                "readme": readme,
+                "fpm_model": model,
+                "created_at": datetime.utcnow(),
+            }
+        },
+        upsert=True,
+    )
+
+
+def validate_version(package: Dict[str, Any], version: Dict[str, Any], pool: ProcessPoolExecutor) -> str:
+    """
+    This function verifies the contents of a package version, updates the package information,
+    and ensures dependencies are present in the database. The contents are checked in the
+    process pool, in a temporary workspace which is removed once the version is validated,
+    unless the result of an identical tarball is cached.
+
+    Args:
+        package (Dict[str, Any]): The package document.
+        version (Dict[str, Any]): The version document of the package.
+        pool (ProcessPoolExecutor): The process pool running process_package.
+
+    Returns:
+        str: Message describing the result of the validation.
+    """
     try:
-        with open(toml_path, 'r') as file:
-            file_content = file.read()
-        parsed_toml = toml.loads(file_content) # handle toml parsing errors
-    except:
-        return False, None,"Error parsing toml file"
+        tarball = file_storage.get(ObjectId(version['oid']))
+    except NoFile:
+        print("No tarball found for " + package['name'] + " " + version['version'])
+        return "No tarball found."
+    packagename = package['name'] + '-' + version['version']
+
+    # Identical contents (re-uploads, forks, retried jobs) are validated once.
+    sha256 = version.get('sha256') or (tarball.metadata or {}).get('sha256')
+    cached = get_validation_result(sha256)
+    if cached:
+        print(f"Using the cached validation result of {packagename}")
+        result = (cached['success'], cached['fpm_toml'], cached['message'])
+        return update_package(package, version, packagename, result, cached['readme'])
+
+    if VALIDATION_WORKSPACE_DIR:
+        os.makedirs(VALIDATION_WORKSPACE_DIR, exist_ok=True)
+    with tempfile.TemporaryDirectory(dir=VALIDATION_WORKSPACE_DIR, prefix="validate-") as workspace:
+        # The GridFS file only holds the key of the tarball bytes in the blob store.
+        with contextlib.closing(blob_store.open(tarball.metadata['url'])) as blob:
+            with open(os.path.join(workspace, "package.tar.gz"), "wb") as f:
+                shutil.copyfileobj(blob, f, BLOB_CHUNK_SIZE)
+        result = pool.submit(process_package, workspace).result()
+        try:
+            with open(os.path.join(workspace, "package", "README.md"), "r") as f:
+                readme = f.read()
+        except OSError:
+            readme = None
+        store_validation_result(sha256, workspace, result, readme)
+        return update_package(package, version, packagename, result, readme)
+
+
+def package_update(package: Dict[str, Any], result: Tuple[bool, Union[dict, None], str],
+                   readme: Union[str, None], dependencies_found: bool) -> Dict[str, Any]:
+    """
+    This function builds the fields of a package updated from the result of process_package.
+
+    Args:
+        package (Dict[str, Any]): The current package document.
+        result (Tuple[bool, Union[dict, None], str]): The result of process_package, with the parsed fpm.toml.
+        readme (Union[str, None]): The README of the package, None if it has none.
+        dependencies_found (bool): Whether the dependencies of the package are in the database.
+
+    Returns:
+        Dict[str, Any]: The updated fields, including the search index fields.
+    """
+    update_data = {'is_verified': result[0] and dependencies_found, 'unable_to_verify': not result[0]}
+    if readme is not None:
+        update_data['registry_description'] = readme
+    else:
+        update_data['registry_description'] = result[1].get('description', "description not provided.")
     
-    result = check_digests(f'static/temp/{packagename}/')
-    # print(result)
+    for key in ['repository', 'copyright', 'description',"homepage", 'categories', 'keywords']:
+        if key in result[1] and package[key] != result[1][key]:
+            if key in ['categories', 'keywords']:
+                update_data[key] = list(set(package[key] + list(map(str.strip, result[1][key]))))
+            else:
+                update_data[key] = result[1][key]
+
+    for k,v in package.items():
+        if v == "Package Under Verification" and k not in update_data.keys():
+            update_data[k] = f"{k} not provided."
+
+    update_data.update(search_index_fields({**package, **update_data}))
+    return update_data
+
 
-    if result[0]==-1:
-        # Package verification failed 
-        return False, parsed_toml, "Digests do not match or file not found."
+def update_package(package: Dict[str, Any], version: Dict[str, Any], packagename: str,
+                   result: Tuple[bool, Union[dict, None], str], readme: Union[str, None]) -> str:
+    """
+    This function updates the package information from the result of process_package.
+
+    Several versions of a package may be validated concurrently, so the update is computed
+    from the current package document and applied only if the package has not been updated
+    by another validation in the meantime (its revision is unchanged), or computed again.
+    The search statistics are then updated from the exact previous state of the package.
+
+    Args:
+        package (Dict[str, Any]): The package document.
+        version (Dict[str, Any]): The version document of the package.
+        packagename (str): The name of the package version.
+        result (Tuple[bool, Union[dict, None], str]): The result of process_package.
+        readme (Union[str, None]): The README of the package, None if it has none.
+
+    Returns:
+        str: Message describing the result of the validation.
+    """
+    if result[0] == False:
+        print("Package tests failed for " + packagename)
+        print(result)
     else:
-        # Package verification success
-        return True, parsed_toml, "Package verified successfully."
+        print("Package tests success for " + packagename)
+
+    version_query = {"_id": package['_id'], "versions.version": version['version']}
+
+    if result[1] is None:
+        # The tarball could not be extracted or its fpm.toml parsed.
+        update_data = {'is_verified': False, 'unable_to_verify': True, 'versions.$.is_verified': False}
+        db.packages.update_one(version_query, {"$set": update_data})
+        bump_registry_generation()
+        return result[2]
 
+    dependencies_found = True
+    for i in extract_dependencies(result[1]):
+        namespace = db.namespaces.find_one({"namespace": i[0]})
+        query = {"name": i[1], "namespace": namespace['_id'] if namespace else None}
+        if i[2] is not None:
+            query['versions.version'] = i[2]
+        dependency_package = db.packages.find_one(query)
+        if dependency_package is None:
+            print(f"Dependency {i[0]}/{i[1]} not found in the database")
+            dependencies_found = False
+
+    for _ in range(PACKAGE_UPDATE_ATTEMPTS):
+        package = db.packages.find_one(version_query)
+        if package is None:
+            return "Package version not found."
+
+        update_data = package_update(package, result, readme, dependencies_found)
+        update_data['versions.$.is_verified'] = update_data['is_verified']
+        updated = db.packages.update_one(
+            {**version_query, "revision": package.get("revision")},
+            {"$set": update_data, "$inc": {"revision": 1}},
+        )
+        if updated.matched_count == 1:
+            break
+    else:
+        raise RuntimeError(f"Package {packagename} is being updated concurrently, try again later.")
 
-def validate() -> None:
+    update_search_statistics(package, update_data)
+    index_package_trigrams({**package, **update_data})
+    bump_registry_generation()
+    print(f"Package {packagename} verified successfully.")
+    return result[2]
+
+
+def run_job(job: Dict[str, Any], worker_id: str, pool: ProcessPoolExecutor) -> None:
     """
-    This function checks the verification status of packages, verifies their contents,
-    updates package information, and ensures dependencies are present in the database.
+    This function runs a validation job, renewing its lease from a heartbeat thread while
+    the version is validated. Jobs which raise an error are retried with a backoff.
 
     Args:
+        job (Dict[str, Any]): The claimed job.
+        worker_id (str): The id of the worker.
+        pool (ProcessPoolExecutor): The process pool running process_package.
+
+    Returns:
         None
+    """
+    done = threading.Event()
+
+    def heartbeat():
+        while not done.wait(VALIDATION_HEARTBEAT_INTERVAL):
+            if not renew_validation_lease(job, worker_id):
+                print(f"Lost the lease of the validation job {job['_id']}")
+                return
+
+    heartbeat_thread = threading.Thread(target=heartbeat, daemon=True)
+    heartbeat_thread.start()
+    try:
+        package = db.packages.find_one({"_id": job['package']})
+        versions = [i for i in package['versions'] if i['version'] == job['version']] if package else []
+        if not versions:
+            # The package or the version has been deleted since the upload.
+            complete_validation_job(job, worker_id, "Package version not found.")
+            return
+        message = validate_version(package, versions[0], pool)
+    except Exception as e:
+        print(f"Validation job {job['_id']} failed: {e}")
+        fail_validation_job(job, worker_id, str(e))
+        if isinstance(e, BrokenProcessPool):
+            raise
+    else:
+        complete_validation_job(job, worker_id, message)
+    finally:
+        done.set()
+        heartbeat_thread.join()
+
+
+def create_process_pool(workers: int = VALIDATION_CONCURRENCY) -> ProcessPoolExecutor:
+    """
+    This function creates the process pool running process_package.
+
+    The worker runs database, heartbeat and job threads, which a forked process would inherit
+    in an arbitrary state (e.g. holding a lock). The pool processes are forked instead from a
+    fork server started without threads, which only imports package_checks: this module
+    (whose import connects to the database) is not imported in the pool processes.
+
+    Args:
+        workers (int): The number of processes.
+
+    Returns:
+        ProcessPoolExecutor: The process pool.
+    """
+    context = multiprocessing.get_context("forkserver")
+    context.set_forkserver_preload(["package_checks"])
+    return ProcessPoolExecutor(workers, mp_context=context)
+
+
+def run_worker(exit_when_idle: bool = False) -> None:
+    """
+    This function runs the validation worker: it claims the validation jobs queued by the
+    uploads and runs up to VALIDATION_CONCURRENCY of them concurrently. Several workers can
+    run on different nodes, a job is leased to a single worker at a time.
+
+    Args:
+        exit_when_idle (bool): Whether to return once no job is available and the running
+            jobs are finished, instead of waiting for new jobs.
 
     Returns:
         None
     """
-    packages = db.packages.find({"is_verified": False})
-    packages = list(packages)
-    for  package in packages:
-        for i in package['versions']:
-            if 'is_verified' in i.keys() and i['is_verified'] == False:
-                try:
-                    tarball = file_storage.get(ObjectId(i['oid']))
-                except NoFile:
-                    print("No tarball found for " + package['name'] + " " + i['version'])
-                    continue
-                packagename = package['name'] + '-' + i['version']
-                with open(f"static/temp/{packagename}.tar.gz", "wb") as f:
-                    f.write(tarball.read())
-                result = process_package(packagename)
-                update_data = {}
-                if result[0] == False:
-                    update_data['is_verified'] = False
-                    update_data['unable_to_verify'] = True
-                    print("Package tests failed for " + packagename)
-                    print(result)
+    worker_id = f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+    print(f"Validation worker {worker_id} started with {VALIDATION_CONCURRENCY} processes.")
+    # The jobs are run by threads, which only wait on the database and on the process pool.
+    pool = create_process_pool()
+    with ThreadPoolExecutor(VALIDATION_CONCURRENCY) as threads:
+        running = set()
+        while True:
+            finished = {i for i in running if i.done()}
+            running -= finished
+            if any(isinstance(i.exception(), BrokenProcessPool) for i in finished):
+                # A process of the pool died (e.g. killed for using too much memory).
+                pool.shutdown(wait=False)
+                pool = create_process_pool()
+
+            # Jobs are claimed only when they can be started, so that they are not leased while waiting.
+            if len(running) >= VALIDATION_CONCURRENCY:
+                wait(running, return_when=FIRST_COMPLETED)
+                continue
+
+            job = claim_validation_job(worker_id)
+            if job is None:
+                if not exit_when_idle:
+                    time.sleep(VALIDATION_POLL_INTERVAL)
+                elif running:
+                    wait(running, return_when=FIRST_COMPLETED)
                 else:
-                    print("Package tests success for " + packagename)
-                    update_data['is_verified'] = True
-                    update_data['unable_to_verify'] = False
-
-                if result[2] == "Error parsing toml file":
-                    db.packages.update_one({"name": package['name'],"namespace":package['namespace']}, {"$set": update_data})
-                    pass
-                try:
-                    update_data['registry_description'] = open(f"static/temp/{packagename}/README.md", "r").read()     
-                except:
-                    update_data['registry_description'] = result[1].get('description', "description not provided.")
-                
-                for key in ['repository', 'copyright', 'description',"homepage", 'categories', 'keywords']:
-                    if key in result[1] and package[key] != result[1][key]:
-                        if key in ['categories', 'keywords']:
-                            update_data[key] = list(set(package[key] + list(map(str.strip, result[1][key]))))
-                        else:
-                            update_data[key] = result[1][key]
-
-                dependencies = extract_dependencies(result[1])
-
-                for i in dependencies:
-                    namespace = db.namespaces.find_one({"namespace": i[0]})
-                    query = {"name": i[1], "namespace": ObjectId(str(namespace['_id']))}
-                    if i[2] is not None:
-                        query['versions.version'] = i[2]
-                    dependency_package = db.packages.find_one(query)
-                    if dependency_package is None:
-                        print(f"Dependency {i[0]}/{i[1]} not found in the database")
-                        update_data['is_verified'] = False    
-
-                for k,v in package.items():
-                    if v == "Package Under Verification" and k not in update_data.keys():
-                        update_data[k] = f"{k} not provided."
-
-                db.packages.update_one({"name": package['name'],"namespace":package['namespace']}, {"$set": update_data})
-                print(f"Package {packagename} verified successfully.")
-                # Clean up
-                cleanup_command = f'rm -rf static/temp/{packagename} static/temp/{packagename}.tar.gz'
-                run_command(cleanup_command)
-
-
-validate()
\ No newline at end of file
+                    break
+                continue
+            running.add(threads.submit(run_job, job, worker_id, pool))
+    pool.shutdown()
+
+
+if __name__ == "__main__":
+    # The processes of the pool import the main module, which must not be this one.
+    sys.exit("Run the validation worker with: python validate_worker.py")
@@ -0,0 +1,12 @@
+import argparse
+
+# Entry point of the validation worker. The processes of the validation pool import the main
+# module, so validate (whose import connects to the database) is only imported under the guard.
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Validate the uploaded package versions.")
+    parser.add_argument("--once", action="store_true", help="exit once the queued jobs are validated")
+    args = parser.parse_args()
+
+    from validate import run_worker
+
+    run_worker(exit_when_idle=args.once)
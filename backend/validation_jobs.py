@@ -0,0 +1,182 @@
+import os
+from datetime import datetime, timedelta
+from mongo import db
+from pymongo import ASCENDING, ReturnDocument
+from pymongo.errors import DuplicateKeyError
+
+# A claimed job is leased to its worker for VALIDATION_LEASE_TIME seconds, and the lease is
+# renewed by heartbeats every VALIDATION_HEARTBEAT_INTERVAL seconds. The job of a worker that
+# stopped renewing its lease (e.g. it crashed) can be claimed again once the lease expires.
+VALIDATION_LEASE_TIME = float(os.getenv("VALIDATION_LEASE_TIME", 300))
+VALIDATION_HEARTBEAT_INTERVAL = float(os.getenv("VALIDATION_HEARTBEAT_INTERVAL", 30))
+
+# Failed jobs are retried up to VALIDATION_MAX_ATTEMPTS times, with an exponential backoff
+# starting at VALIDATION_RETRY_BACKOFF seconds and capped at VALIDATION_MAX_RETRY_BACKOFF seconds.
+VALIDATION_MAX_ATTEMPTS = int(os.getenv("VALIDATION_MAX_ATTEMPTS", 5))
+VALIDATION_RETRY_BACKOFF = float(os.getenv("VALIDATION_RETRY_BACKOFF", 30))
+VALIDATION_MAX_RETRY_BACKOFF = float(os.getenv("VALIDATION_MAX_RETRY_BACKOFF", 3600))
+
+# Finished (done or failed) jobs are kept for a week.
+VALIDATION_JOB_RETENTION = timedelta(weeks=1)
+
+
+def enqueue_validation(package_id, version, tarball_id, reset=True):
+    """
+    Function to add the validation job of an uploaded package version to the queue. There is
+    one job per version: enqueueing a version again (e.g. uploaded again after being deleted)
+    resets its job.
+
+    Parameters:
+    package_id (ObjectId): The id of the package.
+    version (str): The version of the package.
+    tarball_id (ObjectId): The id of the GridFS file of the tarball of the version.
+    reset (bool): Whether an existing job of the version is reset, or left as it is.
+
+    Returns:
+    None
+    """
+    now = datetime.utcnow()
+    job = {
+        "tarball": tarball_id,
+        "status": "queued",
+        "attempts": 0,
+        "available_at": now,
+        "created_at": now,
+        "worker": None,
+    }
+    if reset:
+        update = {"$set": job, "$unset": {"error": "", "message": "", "started_at": "", "finished_at": ""}}
+    else:
+        update = {"$setOnInsert": job}
+    db.validation_jobs.update_one({"package": package_id, "version": version}, update, upsert=True)
+
+
+def claim_validation_job(worker_id):
+    """
+    Function to claim the next validation job available. The job is either queued, and its
+    retry backoff has elapsed, or running with an expired lease.
+
+    Parameters:
+    worker_id (str): The id of the worker claiming the job.
+
+    Returns:
+    dict: The claimed job, or None if no job is available.
+    """
+    now = datetime.utcnow()
+    # available_at is the end of the backoff of queued jobs and the end of the lease of running ones.
+    return db.validation_jobs.find_one_and_update(
+        {"status": {"$in": ["queued", "running"]}, "available_at": {"$lte": now}},
+        {
+            "$set": {
+                "status": "running",
+                "worker": worker_id,
+                "started_at": now,
+                "available_at": now + timedelta(seconds=VALIDATION_LEASE_TIME),
+            },
+            "$inc": {"attempts": 1},
+        },
+        sort=[("available_at", ASCENDING)],
+        return_document=ReturnDocument.AFTER,
+    )
+
+
+def renew_validation_lease(job, worker_id):
+    """
+    Function to renew the lease of a running job (heartbeat).
+
+    Parameters:
+    job (dict): The job.
+    worker_id (str): The id of the worker running the job.
+
+    Returns:
+    bool: Whether the worker still holds the lease of the job.
+    """
+    result = db.validation_jobs.update_one(
+        {"_id": job["_id"], "status": "running", "worker": worker_id},
+        {"$set": {"available_at": datetime.utcnow() + timedelta(seconds=VALIDATION_LEASE_TIME)}},
+    )
+    return result.matched_count == 1
+
+
+def complete_validation_job(job, worker_id, message=None):
+    """
+    Function to mark a job as done, if the worker still holds its lease.
+
+    Parameters:
+    job (dict): The job.
+    worker_id (str): The id of the worker running the job.
+    message (str): The outcome of the validation.
+
+    Returns:
+    None
+    """
+    db.validation_jobs.update_one(
+        {"_id": job["_id"], "status": "running", "worker": worker_id},
+        {"$set": {"status": "done", "message": message, "finished_at": datetime.utcnow()}},
+    )
+
+
+def fail_validation_job(job, worker_id, error):
+    """
+    Function to record the failure of a job. The job is queued again after a backoff, or
+    marked as failed once it has been attempted VALIDATION_MAX_ATTEMPTS times.
+
+    Parameters:
+    job (dict): The job.
+    worker_id (str): The id of the worker running the job.
+    error (str): The error of the attempt.
+
+    Returns:
+    None
+    """
+    now = datetime.utcnow()
+    if job["attempts"] >= VALIDATION_MAX_ATTEMPTS:
+        update = {"status": "failed", "error": error, "finished_at": now}
+    else:
+        backoff = min(VALIDATION_RETRY_BACKOFF * 2 ** (job["attempts"] - 1), VALIDATION_MAX_RETRY_BACKOFF)
+        update = {
+            "status": "queued",
+            "error": error,
+            "worker": None,
+            "available_at": now + timedelta(seconds=backoff),
+        }
+    db.validation_jobs.update_one(
+        {"_id": job["_id"], "status": "running", "worker": worker_id}, {"$set": update}
+    )
+
+
+def enqueue_unverified_versions():
+    """
+    Function to queue the versions left unverified by the batch validation which ran before
+    the queue existed. The versions which already have a job are left as they are, so that an
+    interruption (e.g. a crash) is resumed by the next start. Once it has completed, it is marked
+    as done in the registry and later starts skip it.
+
+    Parameters:
+    None
+
+    Returns:
+    None
+    """
+    if db.registry.find_one({"_id": "validation_jobs"}):
+        return
+
+    packages = db.packages.find({"is_verified": False}, {"versions.version": 1, "versions.oid": 1, "versions.is_verified": 1})
+    for package in packages:
+        for version in package.get("versions", []):
+            if version.get("is_verified") == False:
+                enqueue_validation(package["_id"], version["version"], version["oid"], reset=False)
+
+    try:
+        db.registry.insert_one({"_id": "validation_jobs", "enqueued_at": datetime.utcnow()})
+    except DuplicateKeyError:
+        # Another process completed it concurrently.
+        pass
+
+
+db.validation_jobs.create_index([("package", ASCENDING), ("version", ASCENDING)], unique=True)
+db.validation_jobs.create_index([("status", ASCENDING), ("available_at", ASCENDING)])
+db.validation_jobs.create_index(
+    "finished_at", expireAfterSeconds=int(VALIDATION_JOB_RETENTION.total_seconds())
+)
+enqueue_unverified_versions()